@@ -1,11 +1,65 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, g, has_request_context, send_from_directory
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timedelta, date
+from flask_sqlalchemy.session import Session as FlaskSQLAlchemySession
+from sqlalchemy import (
+    func, extract, event, text, bindparam, case, cast, literal, null, and_, or_,
+    select, insert, update, Insert, Update, Delete
+)
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool, QueuePool
+from sqlalchemy.orm import aliased
+from werkzeug.datastructures import MultiDict
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+from datetime import datetime, timedelta, timezone, date, time as dt_time
+from decimal import Decimal
+from dataclasses import dataclass
+from functools import wraps
+from contextlib import contextmanager
+from collections import deque, OrderedDict
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from logging.handlers import QueueHandler, QueueListener
 import os
 import secrets
 import requests
 import logging
+import threading
+import time
+import re
+import io
+import json
+import random
+import cProfile
+import pstats
+import gzip
+import hashlib
+import heapq
+import queue
+import atexit
+import hmac
+import ipaddress
+
+# Optional speedups: orjson for JSON encoding, brotli for br responses
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Optional shared backend for the response cache
+try:
+    import redis
+except ImportError:
+    redis = None
+import prometheus_client
+from prometheus_client import Counter, Gauge, Histogram
 
 app = Flask(__name__)
 
@@ -20,12 +74,390 @@ app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 app.config['SESSION_COOKIE_SECURE'] = True
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=2)
 
-db = SQLAlchemy(app)
+# Seconds a cached identity may be served before it is reloaded
+app.config['IDENTITY_CACHE_TTL'] = int(os.environ.get('IDENTITY_CACHE_TTL', 300))
+
+# Seconds a cached position catalog (built-ins plus custom icons) may be served
+app.config['POSITION_CATALOG_TTL'] = int(os.environ.get('POSITION_CATALOG_TTL', 300))
+
+# Password hashing: Werkzeug method string, worker threads and admission limits.
+# Changing the method rehashes each user's password on their next login.
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+app.config['PASSWORD_HASH_QUEUE_LIMIT'] = int(os.environ.get('PASSWORD_HASH_QUEUE_LIMIT', 8))
+app.config['PASSWORD_HASH_TIMEOUT'] = float(os.environ.get('PASSWORD_HASH_TIMEOUT', 10))
+
+# Per-request SQL statistics in X-Query-Count / Server-Timing headers, and a
+# warning for a statement repeated more than the threshold in one request (N+1).
+# A development aid: off unless FLASK_ENV=development, FLASK_DEBUG=1 or
+# QUERY_STATS_ENABLED=1. Query counts still go into the request log line.
+_development = os.environ.get('FLASK_ENV') == 'development' or os.environ.get('FLASK_DEBUG') == '1'
+app.config['QUERY_STATS_ENABLED'] = os.environ.get('QUERY_STATS_ENABLED', '1' if _development else '0') == '1'
+app.config['QUERY_REPEAT_WARN_THRESHOLD'] = int(os.environ.get('QUERY_REPEAT_WARN_THRESHOLD', 5))
+
+# Login throttling: failed logins (and registrations) per IP and failed logins
+# per username per window. LOGIN_THROTTLE_URL (redis://..., defaulting to
+# RESPONSE_CACHE_URL) shares the counts between workers; otherwise each
+# process counts on its own.
+app.config['LOGIN_THROTTLE_WINDOW'] = int(os.environ.get('LOGIN_THROTTLE_WINDOW', 300))
+app.config['LOGIN_IP_LIMIT'] = int(os.environ.get('LOGIN_IP_LIMIT', 20))
+app.config['LOGIN_USERNAME_LIMIT'] = int(os.environ.get('LOGIN_USERNAME_LIMIT', 5))
+app.config['LOGIN_THROTTLE_URL'] = os.environ.get('LOGIN_THROTTLE_URL', os.environ.get('RESPONSE_CACHE_URL'))
+
+# Reverse proxies in front of the app (Caddy/nginx) whose X-Forwarded-For and
+# X-Forwarded-Proto are trusted for the client address and scheme. Set 0 when
+# clients reach the app directly, or they could forge their address.
+app.config['TRUSTED_PROXY_COUNT'] = int(os.environ.get('TRUSTED_PROXY_COUNT', 1))
+if app.config['TRUSTED_PROXY_COUNT']:
+    app.wsgi_app = ProxyFix(
+        app.wsgi_app, x_for=app.config['TRUSTED_PROXY_COUNT'], x_proto=app.config['TRUSTED_PROXY_COUNT']
+    )
+
+# Opt-in request profiling: a sampled fraction of requests runs under cProfile
+# and any slower than the threshold is saved, oldest first out past the limits
+app.config['PROFILING_ENABLED'] = os.environ.get('PROFILING_ENABLED', '0') == '1'
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 1.0))
+app.config['PROFILE_THRESHOLD_MS'] = float(os.environ.get('PROFILE_THRESHOLD_MS', 1000))
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', os.path.join(app.root_path, 'profiles'))
+app.config['PROFILE_MAX_FILES'] = int(os.environ.get('PROFILE_MAX_FILES', 50))
+app.config['PROFILE_MAX_BYTES'] = int(os.environ.get('PROFILE_MAX_BYTES', 50 * 1024 * 1024))
+
+# Compress text responses at least this many bytes when the client accepts it
+app.config['COMPRESSION_ENABLED'] = os.environ.get('COMPRESSION_ENABLED', '1') == '1'
+app.config['COMPRESSION_MIN_SIZE'] = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+app.config['COMPRESSION_LEVEL'] = int(os.environ.get('COMPRESSION_LEVEL', 6))
+
+# Optional read replicas (comma-separated URLs). GET requests read from one of
+# them; a session that wrote reads from the primary for the sticky window so
+# it always sees its own changes despite replication lag.
+app.config['REPLICA_DATABASE_URLS'] = [
+    url.strip() for url in os.environ.get('REPLICA_DATABASE_URL', '').split(',') if url.strip()
+]
+app.config['REPLICA_STICKY_SECONDS'] = float(os.environ.get('REPLICA_STICKY_SECONDS', 10))
+app.config['SQLALCHEMY_BINDS'] = {
+    f'replica_{i}': url for i, url in enumerate(app.config['REPLICA_DATABASE_URLS'])
+}
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Per-couple response cache. RESPONSE_CACHE_URL (redis://...) shares entries
+# between workers; otherwise each process keeps its own LRU.
+app.config['RESPONSE_CACHE_ENABLED'] = os.environ.get('RESPONSE_CACHE_ENABLED', '1') == '1'
+app.config['RESPONSE_CACHE_URL'] = os.environ.get('RESPONSE_CACHE_URL')
+app.config['RESPONSE_CACHE_TTL'] = int(os.environ.get('RESPONSE_CACHE_TTL', 300))
+app.config['RESPONSE_CACHE_MAX_ENTRIES'] = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 4096))
+
+# Rows deleted per statement (and per transaction) when purging encounters or accounts
+app.config['PURGE_BATCH_SIZE'] = int(os.environ.get('PURGE_BATCH_SIZE', 500))
+
+# Proposal scheduler: expire pending proposals once their time passes and remind
+# both partners this many minutes before an accepted one. The in-memory queue
+# covers the next SCHEDULER_HORIZON_HOURS and is reloaded from the database
+# every SCHEDULER_REFILL_SECONDS, which picks up proposals made in other workers.
+app.config['SCHEDULER_ENABLED'] = os.environ.get('SCHEDULER_ENABLED', '1') == '1'
+app.config['PROPOSAL_REMINDER_LEAD_MINUTES'] = int(os.environ.get('PROPOSAL_REMINDER_LEAD_MINUTES', 60))
+app.config['SCHEDULER_HORIZON_HOURS'] = float(os.environ.get('SCHEDULER_HORIZON_HOURS', 24))
+app.config['SCHEDULER_REFILL_SECONDS'] = int(os.environ.get('SCHEDULER_REFILL_SECONDS', 60))
+app.config['SCHEDULER_BATCH_SIZE'] = int(os.environ.get('SCHEDULER_BATCH_SIZE', 200))
+
+# Nightly stats maintenance at this server-local hour: decay streaks that were
+# not kept up and rewrite counters that drifted from the source tables
+app.config['STATS_MAINTENANCE_ENABLED'] = os.environ.get('STATS_MAINTENANCE_ENABLED', '1') == '1'
+app.config['STATS_MAINTENANCE_HOUR'] = int(os.environ.get('STATS_MAINTENANCE_HOUR', 3))
+app.config['STATS_RECONCILE_BATCH_SIZE'] = int(os.environ.get('STATS_RECONCILE_BATCH_SIZE', 500))
+
+# Most (encounter, rating) pairs accepted by one POST /api/encounters/ratings
+app.config['RATING_BATCH_LIMIT'] = int(os.environ.get('RATING_BATCH_LIMIT', 200))
+
+# Days of encounter history included in each user's .ics calendar feed, and how
+# many rendered events each worker keeps for rebuilding feeds after a write
+app.config['CALENDAR_FEED_DAYS'] = int(os.environ.get('CALENDAR_FEED_DAYS', 365))
+app.config['CALENDAR_EVENT_CACHE_SIZE'] = int(os.environ.get('CALENDAR_EVENT_CACHE_SIZE', 20000))
+
+# Delta sync: seconds each /api/sync request reaches back before its token to
+# catch rows that committed late, and days deletes are remembered for
+app.config['SYNC_OVERLAP_SECONDS'] = int(os.environ.get('SYNC_OVERLAP_SECONDS', 5))
+app.config['TOMBSTONE_RETENTION_DAYS'] = int(os.environ.get('TOMBSTONE_RETENTION_DAYS', 90))
+
+# Cross-worker cache invalidation over PostgreSQL LISTEN/NOTIFY
+app.config['INVALIDATION_BUS_ENABLED'] = os.environ.get('INVALIDATION_BUS_ENABLED', '1') == '1'
+app.config['INVALIDATION_CHANNEL'] = os.environ.get('INVALIDATION_CHANNEL', 'stracker_invalidation')
+
+# Logging: LOG_FORMAT is json (one object per line) or text. At LOG_LEVEL=DEBUG
+# only LOG_DEBUG_SAMPLE_RATE of requests keep their debug records. At most
+# LOG_QUEUE_SIZE records wait for the writer thread; past that they are dropped.
+app.config['LOG_LEVEL'] = os.environ.get('LOG_LEVEL', 'INFO').upper()
+app.config['LOG_FORMAT'] = os.environ.get('LOG_FORMAT', 'json')
+app.config['LOG_DEBUG_SAMPLE_RATE'] = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', 0.01))
+app.config['LOG_QUEUE_SIZE'] = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+
+# Bearer token required to scrape /metrics; when unset only loopback clients may scrape
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+# ============================================================================
+# METRICS
+# ============================================================================
+
+# With PROMETHEUS_MULTIPROC_DIR set, prometheus_client keeps each worker's
+# values in memory-mapped files and /metrics sums them across processes.
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'Request latency by route',
+    ['method', 'endpoint']
+)
+REQUEST_COUNT = Counter(
+    'http_requests_total', 'Requests by route and status',
+    ['method', 'endpoint', 'status']
+)
+DB_POOL_CHECKOUT_WAIT = Histogram(
+    'db_pool_checkout_wait_seconds', 'Time spent waiting for a pooled connection',
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+)
+DB_POOL_IN_USE = Gauge(
+    'db_pool_connections_in_use', 'Connections currently checked out of the pool',
+    multiprocess_mode='livesum'
+)
+NOTIFICATION_LATENCY = Histogram(
+    'notification_send_duration_seconds', 'External notification send latency',
+    ['channel']
+)
+NOTIFICATION_FAILURES = Counter(
+    'notification_send_failures_total', 'External notification sends that failed',
+    ['channel']
+)
+ACHIEVEMENT_EVALUATION = Histogram(
+    'achievement_evaluation_duration_seconds', 'Time spent in check_achievements()'
+)
+LOG_RECORDS_DROPPED = Counter(
+    'log_records_dropped_total', 'Log records dropped because the log queue was full'
+)
+STATS_MAINTENANCE_ROWS = Counter(
+    'stats_maintenance_rows_total', 'UserStats rows changed by the nightly maintenance job',
+    ['kind']
+)
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long callers wait for a connection"""
+    
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started)
+
+@event.listens_for(Pool, 'checkout')
+def _pool_checkout(dbapi_connection, connection_record, connection_proxy):
+    DB_POOL_IN_USE.inc()
+
+@event.listens_for(Pool, 'checkin')
+def _pool_checkin(dbapi_connection, connection_record):
+    DB_POOL_IN_USE.dec()
+
+# SQLite keeps Flask-SQLAlchemy's own pool choice
+if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'poolclass': TimedQueuePool}
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_started = time.perf_counter()
+
+def record_request_metrics(status):
+    if g.get('metrics_recorded') or 'metrics_started' not in g:
+        return
+    g.metrics_recorded = True
+    endpoint = request.endpoint or 'unmatched'
+    REQUEST_LATENCY.labels(request.method, endpoint).observe(time.perf_counter() - g.metrics_started)
+    REQUEST_COUNT.labels(request.method, endpoint, str(status)).inc()
+
+@app.after_request
+def finish_request_metrics(response):
+    record_request_metrics(response.status_code)
+    return response
+
+@app.teardown_request
+def finish_failed_request_metrics(exception):
+    # after_request is skipped when a view raises
+    if exception is not None:
+        record_request_metrics(500)
+
+def is_loopback(address):
+    try:
+        return ipaddress.ip_address(address or '').is_loopback
+    except ValueError:
+        return False
+
+@app.route('/metrics')
+def metrics():
+    token = app.config['METRICS_TOKEN']
+    if token:
+        supplied = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(supplied.encode(), f'Bearer {token}'.encode()):
+            return jsonify({'error': 'Not authenticated'}), 401
+    elif not is_loopback(request.remote_addr):
+        return jsonify({'error': 'Access denied'}), 403
+    
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = prometheus_client.CollectorRegistry()
+        from prometheus_client import multiprocess
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    
+    return prometheus_client.generate_latest(registry), 200, {
+        'Content-Type': prometheus_client.CONTENT_TYPE_LATEST
+    }
+
+# ============================================================================
+# DATABASE ROUTING
+# ============================================================================
+
+_replica_bind_keys = list(app.config['SQLALCHEMY_BINDS'])
+_read_methods = {'GET', 'HEAD', 'OPTIONS'}
+
+class RoutingSession(FlaskSQLAlchemySession):
+    """Session that sends reads in safe requests to a replica, everything else to the primary"""
+    
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is not None or not _replica_bind_keys:
+            return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        
+        # Once anything is written, the rest of the unit of work stays on the primary
+        if self._flushing or isinstance(clause, (Insert, Update, Delete)):
+            self.info['wrote'] = True
+        if self.info.get('wrote') or self.info.get('primary') or not use_replica():
+            return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        
+        if 'replica' not in self.info:
+            self.info['replica'] = random.choice(_replica_bind_keys)
+        return self._db.engines[self.info['replica']]
+
+def use_replica():
+    """True when this request may read from a replica"""
+    if not has_request_context() or request.method not in _read_methods:
+        return False
+    return session.get('primary_until', 0) <= time.time()
+
+@contextmanager
+def reading_from_primary():
+    """Send this session's reads to the primary inside the block"""
+    previous = db.session.info.get('primary', False)
+    db.session.info['primary'] = True
+    try:
+        yield
+    finally:
+        db.session.info['primary'] = previous
+
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+
+@app.after_request
+def stick_to_primary(response):
+    # Keep this browser session on the primary until replicas have caught up
+    if _replica_bind_keys and db.session.info.get('wrote'):
+        session['primary_until'] = time.time() + app.config['REPLICA_STICKY_SECONDS']
+    return response
+
+# ============================================================================
+# LOGGING
+# ============================================================================
+
+# Request threads only put records on a queue; a listener thread formats and
+# writes them. Messages use %-style arguments that are rendered on that thread,
+# so pass plain values rather than ORM objects.
+
+_request_id_pattern = re.compile(r'^[\w.-]{1,64}$')
+
+def log_fields(**fields):
+    """extra= for a log call: fields added to the JSON record"""
+    return {'fields': fields}
+
+class RequestContextFilter(logging.Filter):
+    """Stamps records with the request's correlation id and samples DEBUG records"""
+    
+    def filter(self, record):
+        in_request = has_request_context()
+        record.request_id = g.get('request_id', '-') if in_request else '-'
+        if record.levelno > logging.DEBUG:
+            return True
+        
+        # Sampled per request, so a kept request has its whole debug trail
+        rate = app.config['LOG_DEBUG_SAMPLE_RATE']
+        if not in_request:
+            return random.random() < rate
+        if 'log_debug' not in g:
+            g.log_debug = random.random() < rate
+        return g.log_debug
+
+class DeferredQueueHandler(QueueHandler):
+    """QueueHandler that leaves formatting to the listener and never blocks"""
+    
+    def prepare(self, record):
+        # The stock prepare() formats the message here, on the caller's thread
+        return record
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line with the record's fields merged in"""
+    
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', '-'),
+            'message': record.getMessage()
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+_log_queue = queue.Queue(app.config['LOG_QUEUE_SIZE'])
+_log_listener = None
+_log_listener_pid = None
+
+def start_log_listener():
+    """Start this process's log writer thread once"""
+    global _log_listener, _log_listener_pid
+    if _log_listener_pid == os.getpid():
+        return
+    _log_listener_pid = os.getpid()
+    
+    handler = logging.StreamHandler()
+    if app.config['LOG_FORMAT'] == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s'))
+    _log_listener = QueueListener(_log_queue, handler)
+    _log_listener.start()
+
+@atexit.register
+def stop_log_listener():
+    # Writes out whatever is still queued
+    if _log_listener is not None and _log_listener_pid == os.getpid():
+        _log_listener.stop()
+
+_log_handler = DeferredQueueHandler(_log_queue)
+_log_handler.addFilter(RequestContextFilter())
+logging.root.handlers = [_log_handler]
+logging.root.setLevel(app.config['LOG_LEVEL'])
+start_log_listener()
 logger = logging.getLogger(__name__)
 
+@app.before_request
+def assign_request_id():
+    # Keep the proxy's id when it sends one so both logs line up
+    incoming = request.headers.get('X-Request-ID', '')
+    g.request_id = incoming if _request_id_pattern.match(incoming) else secrets.token_hex(8)
+
+@app.after_request
+def echo_request_id(response):
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
 # ============================================================================
 # DATABASE MODELS
 # ============================================================================
@@ -40,6 +472,7 @@ class User(db.Model):
     phone_number = db.Column(db.String(20))
     sms_notifications = db.Column(db.Boolean, default=False)
     is_admin = db.Column(db.Boolean, default=False)
+    calendar_token = db.Column(db.String(64), unique=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class Encounter(db.Model):
@@ -52,6 +485,12 @@ class Encounter(db.Model):
     rating = db.Column(db.Integer)
     notes = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    __table_args__ = (
+        # Couple history by date, and the position filter within it
+        db.Index('idx_encounter_user_date', 'user_id', 'date'),
+        db.Index('idx_encounter_user_position_date', 'user_id', 'position', 'date'),
+    )
 
 class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -60,6 +499,7 @@ class Comment(db.Model):
     text = db.Column(db.Text, nullable=False)
     rating = db.Column(db.Integer)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
 class Notification(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -70,6 +510,7 @@ class Notification(db.Model):
     encounter_id = db.Column(db.Integer, db.ForeignKey('encounter.id'))
     proposed_encounter_id = db.Column(db.Integer)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
 class ProposedEncounter(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -79,7 +520,12 @@ class ProposedEncounter(db.Model):
     position = db.Column(db.String(50))
     notes = db.Column(db.Text)
     status = db.Column(db.String(20), default='pending')
+    reminder_sent_at = db.Column(db.DateTime)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    __table_args__ = (
+        db.Index('idx_proposed_encounter_status_date', 'status', 'proposed_date'),
+    )
 
 class CustomIcon(db.Model):
     __tablename__ = 'custom_icon'
@@ -100,6 +546,7 @@ class Message(db.Model):
     message_text = db.Column(db.Text, nullable=False)
     read = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
 class EncounterRating(db.Model):
     __tablename__ = 'encounter_rating'
@@ -108,6 +555,20 @@ class EncounterRating(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     rating = db.Column(db.Integer, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    __table_args__ = (
+        db.Index('idx_encounter_rating_encounter_rating', 'encounter_id', 'rating'),
+        db.Index('uq_encounter_rating_encounter_user', 'encounter_id', 'user_id', unique=True),
+    )
+
+# A deleted row, kept so /api/sync can tell clients to drop their copy
+class Tombstone(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(20), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    other_user_id = db.Column(db.Integer)
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
 
 class Achievement(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -123,8 +584,12 @@ class UserAchievement(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     achievement_id = db.Column(db.Integer, db.ForeignKey('achievement.id'), nullable=False)
+    # Rows with no unlocked_at are locked and only track progress
     unlocked_at = db.Column(db.DateTime, default=datetime.utcnow)
     progress = db.Column(db.Integer, default=100)
+    __table_args__ = (
+        db.Index('uq_user_achievement_user_achievement', 'user_id', 'achievement_id', unique=True),
+    )
 
 class Challenge(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -146,6 +611,13 @@ class UserChallenge(db.Model):
     completed = db.Column(db.Boolean, default=False)
     completed_at = db.Column(db.DateTime)
 
+class JobRun(db.Model):
+    __tablename__ = 'job_run'
+    job = db.Column(db.String(50), primary_key=True)
+    last_run_on = db.Column(db.Date)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
 class UserStats(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
     total_points = db.Column(db.Integer, default=0)
@@ -156,31 +628,93 @@ class UserStats(db.Model):
     total_encounters = db.Column(db.Integer, default=0)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+# ============================================================================
+# DELETE TOMBSTONES
+# ============================================================================
+
+# Rows visible to the whole couple are scoped by the encounter owner; the
+# others by the one or two users they belong to
+COUPLE_SYNC_ENTITIES = ('encounters', 'comments', 'ratings')
+
+def tombstone_scope(model):
+    """Select of (entity, id, user_id, other_user_id) for rows of model; None if deletes aren't tracked"""
+    no_user = cast(null(), db.Integer)
+    if model is Encounter:
+        return select(literal('encounters'), Encounter.id, Encounter.user_id, no_user)
+    if model is Comment:
+        return select(literal('comments'), Comment.id, Encounter.user_id, no_user).select_from(Comment).join(
+            Encounter, Encounter.id == Comment.encounter_id
+        )
+    if model is EncounterRating:
+        return select(literal('ratings'), EncounterRating.id, Encounter.user_id, no_user).select_from(
+            EncounterRating
+        ).join(Encounter, Encounter.id == EncounterRating.encounter_id)
+    if model is Message:
+        return select(literal('messages'), Message.id, Message.sender_id, Message.recipient_id)
+    if model is Notification:
+        return select(literal('notifications'), Notification.id, Notification.user_id, no_user)
+    if model is ProposedEncounter:
+        return select(
+            literal('proposals'), ProposedEncounter.id, ProposedEncounter.proposer_id, ProposedEncounter.recipient_id
+        )
+    return None
+
+def record_tombstones(session, scope):
+    session.execute(insert(Tombstone).from_select(
+        ['entity', 'entity_id', 'user_id', 'other_user_id', 'deleted_at'],
+        scope.add_columns(literal(datetime.utcnow(), db.DateTime))
+    ))
+
+# Both delete paths are covered here, so no call site can forget a tombstone
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def tombstone_bulk_deletes(orm_execute_state):
+    """Copy the rows a bulk DELETE is about to remove into tombstones first"""
+    if not orm_execute_state.is_delete or orm_execute_state.bind_mapper is None:
+        return
+    scope = tombstone_scope(orm_execute_state.bind_mapper.class_)
+    if scope is None:
+        return
+    where = orm_execute_state.statement.whereclause
+    record_tombstones(orm_execute_state.session, scope if where is None else scope.where(where))
+
+@event.listens_for(RoutingSession, 'before_flush')
+def tombstone_instance_deletes(session, flush_context, instances):
+    """Tombstone objects passed to session.delete()"""
+    for obj in session.deleted:
+        scope = tombstone_scope(type(obj))
+        if scope is not None:
+            record_tombstones(session, scope.where(type(obj).id == obj.id))
+
 # ============================================================================
 # HELPER FUNCTIONS
 # ============================================================================
 
 def send_notification_message(phone_number, message):
     """Send notification via Signal or Twilio"""
+    channel = None
     try:
         # Try Signal first
         signal_url = os.environ.get('SIGNAL_API_URL', 'http://signal:8080')
         signal_number = os.environ.get('SIGNAL_NUMBER')
         
         if signal_number:
-            response = requests.post(
-                f'{signal_url}/v2/send',
-                json={
-                    'number': signal_number,
-                    'recipients': [phone_number],
-                    'message': message
-                },
-                timeout=5
-            )
+            channel = 'signal'
+            with NOTIFICATION_LATENCY.labels(channel).time():
+                response = requests.post(
+                    f'{signal_url}/v2/send',
+                    json={
+                        'number': signal_number,
+                        'recipients': [phone_number],
+                        'message': message
+                    },
+                    timeout=5
+                )
             
             if response.status_code == 201:
-                logger.info(f"✅ Signal notification sent to {phone_number}")
+                logger.info("Signal notification sent to %s", phone_number, extra=log_fields(event='notification_sent', channel=channel))
                 return True
+            
+            NOTIFICATION_FAILURES.labels(channel).inc()
         
         # Fallback to Twilio
         twilio_sid = os.environ.get('TWILIO_ACCOUNT_SID')
@@ -188,23 +722,38 @@ def send_notification_message(phone_number, message):
         twilio_number = os.environ.get('TWILIO_PHONE_NUMBER')
         
         if twilio_sid and twilio_token and twilio_number:
+            channel = 'twilio'
             import twilio.rest
             client = twilio.rest.Client(twilio_sid, twilio_token)
             
-            client.messages.create(
-                to=phone_number,
-                from_=twilio_number,
-                body=message
-            )
+            with NOTIFICATION_LATENCY.labels(channel).time():
+                client.messages.create(
+                    to=phone_number,
+                    from_=twilio_number,
+                    body=message
+                )
             
-            logger.info(f"✅ Twilio SMS sent to {phone_number}")
+            logger.info("Twilio SMS sent to %s", phone_number, extra=log_fields(event='notification_sent', channel=channel))
             return True
             
     except Exception as e:
-        logger.error(f"❌ Failed to send notification: {e}")
+        if channel:
+            NOTIFICATION_FAILURES.labels(channel).inc()
+        logger.error("Failed to send notification: %s", e, extra=log_fields(event='notification_failed', channel=channel))
     
     return False
 
+def is_postgres():
+    """True when the primary database is PostgreSQL"""
+    return db.engine.dialect.name == 'postgresql'
+
+def couple_user_ids(user):
+    """User ids whose encounters are shared with this user"""
+    user_ids = [user.id]
+    if user.partner_id:
+        user_ids.append(user.partner_id)
+    return user_ids
+
 def create_notification(user_id, notification_type, message, encounter_id=None):
     """Create a notification for a user"""
     notification = Notification(
@@ -229,55 +778,89 @@ def calculate_level(points):
     """Calculate level based on points (100 points per level)"""
     return (points // 100) + 1
 
+def clamp_at_zero(expression):
+    return case((expression > 0, expression), else_=0)
+
+def update_user_stats(user_id, returning, **values):
+    """Run one UPDATE on the user's stats row and return the returning columns"""
+    # SET expressions read the row as it was before this statement, and the row
+    # lock makes concurrent updates queue instead of overwriting each other
+    statement = update(UserStats).where(UserStats.user_id == user_id).values(
+        updated_at=datetime.utcnow(), **values
+    ).returning(*returning)
+    row = db.session.execute(statement).first()
+    if row is None:
+        # First write for this user; a concurrent insert of the same row is ignored
+        dialect_insert = postgresql_insert if is_postgres() else sqlite_insert
+        db.session.execute(dialect_insert(UserStats).values(
+            user_id=user_id, total_points=0, level=1, current_streak=0,
+            longest_streak=0, total_encounters=0, updated_at=datetime.utcnow()
+        ).on_conflict_do_nothing(index_elements=['user_id']))
+        row = db.session.execute(statement).first()
+    return row
+
+def adjust_user_stats(user_id, points=0, encounters=0):
+    """Apply point and encounter-count deltas in one UPDATE, never going below zero"""
+    total_points = clamp_at_zero(UserStats.total_points + points)
+    return update_user_stats(
+        user_id,
+        (UserStats.total_points, UserStats.level),
+        total_points=total_points,
+        level=total_points // 100 + 1,
+        total_encounters=clamp_at_zero(UserStats.total_encounters + encounters)
+    )
+
 def award_points(user_id, points, reason=None):
     """Award points to user and update level"""
-    stats = get_or_create_user_stats(user_id)
-    old_level = stats.level
-    stats.total_points += points
-    stats.level = calculate_level(stats.total_points)
-    stats.updated_at = datetime.utcnow()
+    total_points, level = adjust_user_stats(user_id, points=points)
+    invalidate_responses(user_id, endpoints=('user-stats',))
     db.session.commit()
     
-    # Notify if leveled up
-    if stats.level > old_level:
+    # Notify if leveled up; only the update that crossed the boundary sees it
+    if level > calculate_level(max(total_points - points, 0)):
         create_notification(
             user_id,
             'level_up',
-            f"🎉 Level Up! You've reached level {stats.level}!"
+            f"🎉 Level Up! You've reached level {level}!"
         )
     
-    logger.info(f"Awarded {points} points to user {user_id} - {reason}")
-    return stats
+    logger.debug(
+        "Awarded %d points to user %d: %s", points, user_id, reason,
+        extra=log_fields(event='points_awarded', user_id=user_id, points=points, total_points=total_points)
+    )
+    return total_points, level
 
 def update_streak(user_id, encounter_date):
     """Update user's streak based on encounter date"""
-    stats = get_or_create_user_stats(user_id)
-    
-    if not stats.last_encounter_date:
-        # First encounter
-        stats.current_streak = 1
-        stats.longest_streak = 1
-    else:
-        days_diff = (encounter_date - stats.last_encounter_date).days
-        
-        if days_diff == 0:
-            # Same day, no change to streak
-            pass
-        elif days_diff == 1:
-            # Consecutive day
-            stats.current_streak += 1
-            if stats.current_streak > stats.longest_streak:
-                stats.longest_streak = stats.current_streak
-        elif days_diff > 1:
-            # Streak broken
-            stats.current_streak = 1
-    
-    stats.last_encounter_date = encounter_date
-    stats.total_encounters += 1
-    stats.updated_at = datetime.utcnow()
+    last = UserStats.last_encounter_date
+    day_before = encounter_date - timedelta(days=1)
+    
+    # First encounter or a broken streak starts over; the same day or an
+    # earlier (backdated) one leaves it alone
+    current_streak = case(
+        (last.is_(None), 1),
+        (last == day_before, UserStats.current_streak + 1),
+        (last < day_before, 1),
+        else_=UserStats.current_streak
+    )
+    row = update_user_stats(
+        user_id,
+        (UserStats.current_streak, UserStats.longest_streak),
+        current_streak=current_streak,
+        longest_streak=case(
+            (current_streak > UserStats.longest_streak, current_streak),
+            else_=UserStats.longest_streak
+        ),
+        last_encounter_date=case(
+            (or_(last.is_(None), last < encounter_date), encounter_date),
+            else_=last
+        ),
+        total_encounters=UserStats.total_encounters + 1
+    )
+    invalidate_responses(user_id, endpoints=('user-stats',))
     db.session.commit()
     
-    return stats
+    return row
 
 def unlock_achievement(user_id, achievement_code):
     """Unlock an achievement for a user"""
@@ -285,25 +868,24 @@ def unlock_achievement(user_id, achievement_code):
     if not achievement:
         return False
     
-    # Check if already unlocked
-    existing = UserAchievement.query.filter_by(
-        user_id=user_id,
-        achievement_id=achievement.id
-    ).first()
-    
-    if existing:
+    # Claim the unlock in one statement: insert the row, or flip a locked
+    # progress row; an already unlocked row returns nothing
+    now = datetime.utcnow()
+    target = ACHIEVEMENT_TARGETS.get(achievement_code, (None, 100))[1]
+    dialect_insert = postgresql_insert if is_postgres() else sqlite_insert
+    claimed = db.session.execute(dialect_insert(UserAchievement).values(
+        user_id=user_id, achievement_id=achievement.id, unlocked_at=now, progress=target
+    ).on_conflict_do_update(
+        index_elements=['user_id', 'achievement_id'],
+        set_={'unlocked_at': now, 'progress': target},
+        where=UserAchievement.unlocked_at.is_(None)
+    ).returning(UserAchievement.id)).first()
+    
+    if claimed is None:
         return False
     
-    # Unlock achievement
-    user_achievement = UserAchievement(
-        user_id=user_id,
-        achievement_id=achievement.id
-    )
-    db.session.add(user_achievement)
-    
     # Award points based on tier
-    points_map = {'bronze': 10, 'silver': 25, 'gold': 50, 'platinum': 100}
-    points = points_map.get(achievement.tier, 10)
+    points = TIER_POINTS.get(achievement.tier, 10)
     award_points(user_id, points, f"Achievement: {achievement.name}")
     
     # Notify user
@@ -312,141 +894,1686 @@ def unlock_achievement(user_id, achievement_code):
         'achievement_unlocked',
         f"🏆 Achievement Unlocked: {achievement.icon} {achievement.name}!"
     )
-    
-    db.session.commit()
-    logger.info(f"User {user_id} unlocked achievement: {achievement.name}")
-    return True
+    
+    invalidate_responses(user_id, endpoints=USER_ENDPOINTS)
+    db.session.commit()
+    logger.info(
+        "User %d unlocked achievement %s", user_id, achievement_code,
+        extra=log_fields(event='achievement_unlocked', user_id=user_id, achievement=achievement_code)
+    )
+    return True
+
+# Points granted by each kind of write, reversed when the row is purged
+ENCOUNTER_POINTS = 5
+RATING_POINTS = 2
+COMMENT_POINTS = 1
+TIER_POINTS = {'bronze': 10, 'silver': 25, 'gold': 50, 'platinum': 100}
+
+# (achievement code, metric from achievement_metrics(), threshold)
+ACHIEVEMENT_RULES = [
+    ('first_timer', 'encounters', 1),
+    ('milestone_10', 'encounters', 10),
+    ('milestone_25', 'encounters', 25),
+    ('milestone_50', 'encounters', 50),
+    ('century_club', 'encounters', 100),
+    ('dedication', 'encounters', 365),
+    ('hot_streak', 'streak', 3),
+    ('on_fire', 'streak', 7),
+    ('week_streak', 'streak', 7),
+    ('unstoppable', 'streak', 30),
+    ('legend', 'streak', 100),
+    ('explorer', 'positions', 5),
+    ('adventurer', 'positions', 9),
+    ('position_master', 'top_position', 10),
+    ('five_star', 'five_star_ratings', 10),
+    ('consistency', 'high_ratings', 20),
+    ('rated_all', 'ratings', 25),
+    ('connector', 'partner', 1),
+    ('team_player', 'partner_ratings', 10),
+    ('commenter', 'comments', 1),
+    ('communicator', 'comments', 50),
+    ('night_owl', 'night', 10),
+    ('early_bird', 'morning', 10),
+    ('weekend_warrior', 'weekend', 20),
+    ('weekday_wonder', 'weekday', 20),
+    ('data_lover', 'with_duration', 20),
+    ('detailed', 'with_notes', 25),
+    ('custom_lover', 'custom', 1),
+]
+ACHIEVEMENT_TARGETS = {code: (metric, threshold) for code, metric, threshold in ACHIEVEMENT_RULES}
+
+# What each metric counts, for "37/50 encounters" style progress
+METRIC_UNITS = {
+    'encounters': 'encounters',
+    'positions': 'positions',
+    'night': 'night encounters',
+    'morning': 'morning encounters',
+    'weekend': 'weekend encounters',
+    'weekday': 'weekday encounters',
+    'with_duration': 'encounters with a duration',
+    'with_notes': 'encounters with notes',
+    'custom': 'custom positions',
+    'top_position': 'times in one position',
+    'streak': 'streak days',
+    'ratings': 'ratings',
+    'five_star_ratings': 'five-star ratings',
+    'high_ratings': 'ratings of 4+',
+    'partner': 'partner',
+    'partner_ratings': 'partner ratings',
+    'comments': 'comments'
+}
+
+def achievement_metrics(user_id):
+    """Every value ACHIEVEMENT_RULES compares against, from aggregate queries"""
+    identity = load_identity(user_id)
+    stats = get_or_create_user_stats(user_id)
+    
+    def count_where(condition):
+        return func.coalesce(func.sum(case((condition, 1), else_=0)), 0)
+    
+    hour = extract('hour', Encounter.time)
+    weekday = extract('dow', Encounter.date)  # 0 = Sunday
+    encounters = db.session.query(
+        func.count(Encounter.id),
+        func.count(func.distinct(Encounter.position)),
+        count_where(hour < 6),
+        count_where(and_(hour >= 6, hour < 12)),
+        count_where(weekday.in_([0, 6])),
+        count_where(Encounter.duration.isnot(None) & (Encounter.duration != 0)),
+        count_where(Encounter.notes.isnot(None) & (Encounter.notes != '')),
+        count_where(Encounter.position.notin_(list(BUILTIN_POSITIONS)))
+    ).filter(Encounter.user_id == user_id).one()
+    
+    top_position = db.session.query(func.count(Encounter.id)).filter(
+        Encounter.user_id == user_id
+    ).group_by(Encounter.position).order_by(func.count(Encounter.id).desc()).limit(1).scalar()
+    
+    ratings = db.session.query(
+        func.count(EncounterRating.id),
+        count_where(EncounterRating.rating == 5),
+        count_where(EncounterRating.rating >= 4)
+    ).filter(EncounterRating.user_id == user_id).one()
+    
+    partner_ratings = 0
+    if identity and identity.partner_id:
+        partner_ratings = EncounterRating.query.filter_by(user_id=identity.partner_id).count()
+    
+    return {
+        'encounters': encounters[0],
+        'positions': encounters[1],
+        'night': int(encounters[2]),
+        'morning': int(encounters[3]),
+        'weekend': int(encounters[4]),
+        'weekday': encounters[0] - int(encounters[4]),
+        'with_duration': int(encounters[5]),
+        'with_notes': int(encounters[6]),
+        'custom': int(encounters[7]),
+        'top_position': top_position or 0,
+        # longest_streak >= current_streak, and keeps streak awards earned in the past
+        'streak': stats.longest_streak or 0,
+        'ratings': ratings[0],
+        'five_star_ratings': int(ratings[1]),
+        'high_ratings': int(ratings[2]),
+        'partner': 1 if identity and identity.partner_id else 0,
+        'partner_ratings': partner_ratings,
+        'comments': Comment.query.filter_by(commenter_id=user_id).count()
+    }
+
+def save_achievement_progress(user_id, metrics):
+    """Store progress toward each locked achievement on its UserAchievement row"""
+    # Written where the metrics are computed anyway, so reading progress is
+    # part of the one query /api/achievements already makes
+    achievement_ids = dict(db.session.query(Achievement.code, Achievement.id).filter(
+        Achievement.code.in_(list(ACHIEVEMENT_TARGETS))
+    ))
+    rows = [{
+        'user_id': user_id,
+        'achievement_id': achievement_ids[code],
+        'unlocked_at': None,
+        'progress': min(metrics[metric], threshold)
+    } for code, metric, threshold in ACHIEVEMENT_RULES if code in achievement_ids]
+    if not rows:
+        return
+    
+    dialect_insert = postgresql_insert if is_postgres() else sqlite_insert
+    statement = dialect_insert(UserAchievement).values(rows)
+    changed = db.session.execute(statement.on_conflict_do_update(
+        index_elements=['user_id', 'achievement_id'],
+        set_={'progress': statement.excluded.progress},
+        where=and_(
+            UserAchievement.unlocked_at.is_(None),
+            UserAchievement.progress.is_distinct_from(statement.excluded.progress)
+        )
+    ).returning(UserAchievement.id)).all()
+    if changed:
+        invalidate_responses(user_id, endpoints=('achievements',))
+    db.session.commit()
+
+@ACHIEVEMENT_EVALUATION.time()
+def check_achievements(user_id):
+    """Check and unlock achievements for a user"""
+    metrics = achievement_metrics(user_id)
+    save_achievement_progress(user_id, metrics)
+    unlocked = {
+        code for (code,) in db.session.query(Achievement.code).join(
+            UserAchievement, UserAchievement.achievement_id == Achievement.id
+        ).filter(UserAchievement.user_id == user_id, UserAchievement.unlocked_at.isnot(None))
+    }
+    
+    for code, metric, threshold in ACHIEVEMENT_RULES:
+        if code not in unlocked and metrics[metric] >= threshold:
+            unlock_achievement(user_id, code)
+
+# ============================================================================
+# PURGE
+# ============================================================================
+
+def recompute_streaks(user_ids, today=None):
+    """Rebuild current/longest streak from the distinct encounter dates left"""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    yesterday = (today or date.today()) - timedelta(days=1)
+    
+    # Gaps and islands: consecutive dates minus their position share one key
+    days = select(Encounter.user_id, Encounter.date).where(
+        Encounter.user_id.in_(user_ids)
+    ).distinct().subquery()
+    position = func.row_number().over(partition_by=days.c.user_id, order_by=days.c.date)
+    if is_postgres():
+        island_key = days.c.date - cast(position, db.Integer)
+    else:
+        island_key = func.julianday(days.c.date) - position
+    numbered = select(days.c.user_id, days.c.date, island_key.label('island')).subquery()
+    islands = select(
+        numbered.c.user_id,
+        func.count().label('length'),
+        func.max(numbered.c.date).label('last_day'),
+        func.max(func.max(numbered.c.date)).over(partition_by=numbered.c.user_id).label('user_last_day')
+    ).group_by(numbered.c.user_id, numbered.c.island).subquery()
+    # Only the island ending on the latest date is current, and only if that
+    # date is no older than yesterday
+    streaks = select(
+        islands.c.user_id,
+        func.max(islands.c.length).label('longest'),
+        func.max(case(
+            (and_(islands.c.last_day == islands.c.user_last_day, islands.c.last_day >= yesterday), islands.c.length),
+            else_=0
+        )).label('current'),
+        func.max(islands.c.last_day).label('last_day')
+    ).group_by(islands.c.user_id).subquery()
+    
+    now = datetime.utcnow()
+    updated = {row[0] for row in db.session.execute(
+        update(UserStats).where(UserStats.user_id == streaks.c.user_id).values(
+            current_streak=streaks.c.current,
+            longest_streak=streaks.c.longest,
+            last_encounter_date=streaks.c.last_day,
+            updated_at=now
+        ).returning(UserStats.user_id).execution_options(synchronize_session=False)
+    )}
+    # No encounters left at all
+    emptied = [user_id for user_id in user_ids if user_id not in updated]
+    if emptied:
+        db.session.execute(
+            update(UserStats).where(UserStats.user_id.in_(emptied)).values(
+                current_streak=0, longest_streak=0, last_encounter_date=None, updated_at=now
+            ).execution_options(synchronize_session=False)
+        )
+
+def revoke_unearned_achievements(user_id):
+    """Take back achievements whose rule is no longer met, with their points"""
+    metrics = achievement_metrics(user_id)
+    # Having once connected a partner stays earned
+    unmet = [
+        code for code, metric, threshold in ACHIEVEMENT_RULES
+        if metric != 'partner' and metrics[metric] < threshold
+    ]
+    
+    rows = db.session.query(UserAchievement.id, Achievement.tier).join(
+        Achievement, UserAchievement.achievement_id == Achievement.id
+    ).filter(
+        UserAchievement.user_id == user_id,
+        UserAchievement.unlocked_at.isnot(None),
+        Achievement.code.in_(unmet)
+    ).all()
+    if rows:
+        # Back to locked; save_achievement_progress sets their progress
+        db.session.query(UserAchievement).filter(
+            UserAchievement.id.in_([row[0] for row in rows])
+        ).update({'unlocked_at': None}, synchronize_session=False)
+        adjust_user_stats(user_id, points=-sum(TIER_POINTS.get(row[1], 10) for row in rows))
+    save_achievement_progress(user_id, metrics)
+    return len(rows)
+
+def purge_encounters(encounter_ids, departing=()):
+    """Delete encounters with their comments, ratings and notifications, taking back what they earned"""
+    # Users in departing are about to be deleted, so their stats are left alone
+    encounter_ids = list(encounter_ids)
+    batch_size = app.config['PURGE_BATCH_SIZE']
+    owners = set()
+    raters = set()
+    affected = set()
+    
+    for start in range(0, len(encounter_ids), batch_size):
+        batch = encounter_ids[start:start + batch_size]
+        
+        # Tally what each user earned from these rows before they go
+        deltas = {}
+        for model, user_column, points in (
+            (Encounter, Encounter.user_id, ENCOUNTER_POINTS),
+            (EncounterRating, EncounterRating.user_id, RATING_POINTS),
+            (Comment, Comment.commenter_id, COMMENT_POINTS),
+        ):
+            id_column = model.id if model is Encounter else model.encounter_id
+            for user_id, count in db.session.query(user_column, func.count()).filter(
+                id_column.in_(batch)
+            ).group_by(user_column):
+                delta = deltas.setdefault(user_id, {'points': 0, 'encounters': 0})
+                delta['points'] -= points * count
+                if model is Encounter:
+                    delta['encounters'] -= count
+                    owners.add(user_id)
+                elif model is EncounterRating:
+                    raters.add(user_id)
+        
+        for model, column in (
+            (Notification, Notification.encounter_id),
+            (Comment, Comment.encounter_id),
+            (EncounterRating, EncounterRating.encounter_id),
+            (Encounter, Encounter.id),
+        ):
+            db.session.query(model).filter(column.in_(batch)).delete(synchronize_session=False)
+        
+        for user_id, delta in deltas.items():
+            if user_id not in departing:
+                adjust_user_stats(user_id, **delta)
+        affected.update(deltas)
+        
+        # Commit per batch so no single transaction holds locks for long
+        db.session.commit()
+    
+    # A rater's partner counts their ratings toward partner_ratings
+    if raters:
+        affected.update(partner_id for (partner_id,) in db.session.query(User.partner_id).filter(
+            User.id.in_(raters), User.partner_id.isnot(None)
+        ))
+    affected.difference_update(departing)
+    recompute_streaks(owners - set(departing))
+    for user_id in affected:
+        revoke_unearned_achievements(user_id)
+    invalidate_responses(*affected, *departing, endpoints=COUPLE_ENDPOINTS + USER_ENDPOINTS)
+    db.session.commit()
+    return len(encounter_ids)
+
+def delete_in_batches(model, condition):
+    """DELETE matching rows a batch of primary keys at a time"""
+    batch_size = app.config['PURGE_BATCH_SIZE']
+    deleted = 0
+    while True:
+        ids = [row[0] for row in db.session.query(model.id).filter(condition).limit(batch_size)]
+        if not ids:
+            return deleted
+        deleted += db.session.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+
+def purge_users(user_ids):
+    """Delete accounts and everything they own; their partners keep their own history"""
+    user_ids = set(user_ids)
+    partner_ids = {
+        row[0] for row in db.session.query(User.id).filter(User.partner_id.in_(user_ids))
+    } - user_ids
+    
+    encounter_ids = [row[0] for row in db.session.query(Encounter.id).filter(Encounter.user_id.in_(user_ids))]
+    purge_encounters(encounter_ids, departing=user_ids)
+    
+    for model, condition in (
+        # Ratings and comments they left on their partner's encounters
+        (EncounterRating, EncounterRating.user_id.in_(user_ids)),
+        (Comment, Comment.commenter_id.in_(user_ids)),
+        (Notification, Notification.user_id.in_(user_ids)),
+        (Message, Message.sender_id.in_(user_ids) | Message.recipient_id.in_(user_ids)),
+        (ProposedEncounter, ProposedEncounter.proposer_id.in_(user_ids) | ProposedEncounter.recipient_id.in_(user_ids)),
+        (CustomIcon, CustomIcon.user_id.in_(user_ids)),
+        (UserAchievement, UserAchievement.user_id.in_(user_ids)),
+        (UserChallenge, UserChallenge.user_id.in_(user_ids)),
+    ):
+        delete_in_batches(model, condition)
+    
+    db.session.query(UserStats).filter(UserStats.user_id.in_(user_ids)).delete(synchronize_session=False)
+    db.session.query(User).filter(User.partner_id.in_(user_ids)).update(
+        {'partner_id': None}, synchronize_session=False
+    )
+    db.session.query(User).filter(User.id.in_(user_ids)).delete(synchronize_session=False)
+    invalidate_identity(*user_ids, *partner_ids)
+    publish_invalidation('positions', *user_ids)
+    db.session.commit()
+    
+    # Former partners lose awards that counted the departed partner's ratings
+    for user_id in partner_ids:
+        revoke_unearned_achievements(user_id)
+    invalidate_responses(*user_ids, *partner_ids, endpoints=COUPLE_ENDPOINTS + USER_ENDPOINTS)
+    db.session.commit()
+    
+    logger.info(
+        "Purged users %s and %d encounters", sorted(user_ids), len(encounter_ids),
+        extra=log_fields(event='users_purged', user_ids=sorted(user_ids), encounters=len(encounter_ids))
+    )
+
+# ============================================================================
+# INVALIDATION BUS
+# ============================================================================
+
+# Every worker keeps its own caches. On PostgreSQL the evictions queued in a
+# transaction are also sent with one NOTIFY, and a listener thread in every
+# worker applies the evictions published by the others.
+_invalidation_handlers = {}
+_broadcast_topics = set()
+_invalidation_token = secrets.token_hex(8)
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+def register_invalidation_handler(topic, handler, broadcast=True):
+    """handler(keys) evicts keys from a local cache; keys=None means everything"""
+    # broadcast=False for caches every worker already shares
+    _invalidation_handlers[topic] = handler
+    if broadcast:
+        _broadcast_topics.add(topic)
+
+def invalidation_origin():
+    # The pid keeps workers forked from a preloaded app apart
+    return f'{_invalidation_token}:{os.getpid()}'
+
+def invalidation_bus_enabled():
+    return app.config['INVALIDATION_BUS_ENABLED'] and is_postgres()
+
+def publish_invalidation(topic, *keys):
+    """Evict keys for topic from this worker's cache and every other's once the session commits"""
+    # Keys queued inside a transaction go out with its commit as one NOTIFY, so
+    # no worker evicts before the write is visible or for a write rolled back
+    keys = [key for key in keys if key is not None]
+    if not keys:
+        return
+    session = db.session()
+    session.info.setdefault('invalidations', {}).setdefault(topic, set()).update(keys)
+    if session.in_transaction():
+        return
+    
+    # Nothing left to commit; publish right away
+    invalidations = session.info.pop('invalidations')
+    apply_local_invalidations(invalidations)
+    if not should_broadcast(invalidations):
+        return
+    try:
+        with db.engine.begin() as connection:
+            notify_invalidations(connection, invalidations)
+    except Exception as e:
+        logger.error("Failed to publish invalidations for %s: %s", sorted(invalidations), e)
+
+def notify_invalidations(connection, invalidations):
+    """Send every queued topic's keys in a single NOTIFY on connection"""
+    topics = {topic: sorted(keys) for topic, keys in invalidations.items() if topic in _broadcast_topics}
+    payload = json.dumps({'origin': invalidation_origin(), 'topics': topics})
+    if len(payload) > 7900:
+        # NOTIFY payloads are capped at 8000 bytes; evict the whole topics instead
+        payload = json.dumps({'origin': invalidation_origin(), 'topics': dict.fromkeys(topics)})
+    connection.execute(
+        text('SELECT pg_notify(:channel, :payload)'),
+        {'channel': app.config['INVALIDATION_CHANNEL'], 'payload': payload}
+    )
+
+def should_broadcast(invalidations):
+    return invalidation_bus_enabled() and not _broadcast_topics.isdisjoint(invalidations)
+
+def apply_local_invalidations(invalidations):
+    for topic, keys in invalidations.items():
+        _invalidation_handlers[topic](list(keys))
+
+@event.listens_for(RoutingSession, 'before_commit')
+def _send_invalidations(session):
+    invalidations = session.info.get('invalidations')
+    if invalidations and should_broadcast(invalidations):
+        # PostgreSQL delivers it only if and when this transaction commits
+        notify_invalidations(session.connection(bind_arguments={'bind': db.engine}), invalidations)
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _apply_invalidations(session):
+    invalidations = session.info.pop('invalidations', None)
+    if invalidations:
+        apply_local_invalidations(invalidations)
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _discard_invalidations(session):
+    # The writes they were queued for never happened
+    session.info.pop('invalidations', None)
+
+def apply_invalidation(payload):
+    """Apply an invalidation received from another worker"""
+    try:
+        message = json.loads(payload)
+    except ValueError:
+        logger.warning("Ignoring malformed invalidation: %s", payload[:100])
+        return
+    
+    if message.get('origin') == invalidation_origin():
+        return
+    for topic, keys in message.get('topics', {}).items():
+        handler = _invalidation_handlers.get(topic)
+        if handler:
+            handler(keys)
+
+def clear_local_caches():
+    for handler in _invalidation_handlers.values():
+        handler(None)
+
+def listen_for_invalidations(dsn, channel):
+    """Listener thread: LISTEN on the channel and apply what other workers publish"""
+    import select
+    import psycopg2
+    from psycopg2 import sql
+    
+    backoff = 1
+    while True:
+        connection = None
+        try:
+            connection = psycopg2.connect(dsn)
+            connection.autocommit = True
+            connection.cursor().execute(sql.SQL('LISTEN {}').format(sql.Identifier(channel)))
+            # Anything published while we were not listening is lost
+            clear_local_caches()
+            backoff = 1
+            logger.info("Listening for cache invalidations on %s", channel)
+            
+            while True:
+                if select.select([connection], [], [], 60) == ([], [], []):
+                    continue
+                connection.poll()
+                while connection.notifies:
+                    apply_invalidation(connection.notifies.pop(0).payload)
+        except Exception as e:
+            logger.error("Invalidation listener failed, retrying in %ds: %s", backoff, e)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+        finally:
+            if connection is not None:
+                connection.close()
+
+def start_invalidation_listener():
+    """Start this process's listener thread once; safe to call on every request"""
+    global _listener_pid
+    if not invalidation_bus_enabled():
+        return
+    with _listener_lock:
+        if _listener_pid == os.getpid():
+            return
+        _listener_pid = os.getpid()
+    
+    dsn = db.engine.url.set(drivername='postgresql').render_as_string(hide_password=False)
+    threading.Thread(
+        target=listen_for_invalidations,
+        args=(dsn, app.config['INVALIDATION_CHANNEL']),
+        name='invalidation-listener',
+        daemon=True
+    ).start()
+
+# ============================================================================
+# RESPONSE CACHE
+# ============================================================================
+
+# Responses a write by either partner can change, and those private to one user
+COUPLE_ENDPOINTS = ('encounters', 'stats', 'analytics', 'calendar-feed')
+USER_ENDPOINTS = ('user-stats', 'achievements')
+
+class LocalCacheBackend:
+    """In-process LRU cache with a per-entry TTL"""
+    
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generations = {}
+        # Added to every counter; clear() raises it so no counter ever goes back
+        # to a value an in-flight compute may still store its result under
+        self._epoch = 0
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+    
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def generations(self, names):
+        with self._lock:
+            return [self._epoch + self._generations.get(name, 0) for name in names]
+    
+    def bump(self, names):
+        with self._lock:
+            for name in names:
+                self._generations[name] = self._generations.get(name, 0) + 1
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._epoch += 1
+
+class RedisCacheBackend:
+    """Cache shared by every worker; values are stored as JSON"""
+    
+    def __init__(self, url, ttl, prefix='stracker:cache:'):
+        self.ttl = ttl
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url)
+    
+    def get(self, key):
+        raw = self._redis.get(self.prefix + key)
+        return None if raw is None else app.json.loads(raw)
+    
+    def set(self, key, value):
+        self._redis.set(self.prefix + key, app.json.dumps(value), ex=self.ttl)
+    
+    def generations(self, names):
+        return [int(value or 0) for value in self._redis.mget([self.prefix + name for name in names])]
+    
+    def bump(self, names):
+        pipeline = self._redis.pipeline()
+        for name in names:
+            pipeline.incr(self.prefix + name)
+        pipeline.execute()
+    
+    def clear(self):
+        keys = list(self._redis.scan_iter(f'{self.prefix}*'))
+        if keys:
+            self._redis.delete(*keys)
+
+def create_cache_backend():
+    """Shared backend when RESPONSE_CACHE_URL is set, otherwise in-process"""
+    url = app.config['RESPONSE_CACHE_URL']
+    if url:
+        if redis is None:
+            raise RuntimeError('RESPONSE_CACHE_URL is set but the redis package is not installed')
+        return RedisCacheBackend(url, app.config['RESPONSE_CACHE_TTL'])
+    return LocalCacheBackend(app.config['RESPONSE_CACHE_MAX_ENTRIES'], app.config['RESPONSE_CACHE_TTL'])
+
+response_cache = create_cache_backend()
+
+def cached_response(endpoint, compute, user_ids, viewer_id=None, variant=''):
+    """Return compute(), reused until one of user_ids writes something that affects endpoint"""
+    # The key embeds each user's generation counter, so invalidating is a counter
+    # bump and a result computed while a write commits lands under a dead key.
+    # variant tells apart differently parameterised results of one endpoint.
+    if not app.config['RESPONSE_CACHE_ENABLED']:
+        return compute()
+    
+    user_ids = sorted(user_ids)
+    generations = response_cache.generations([f'gen:{endpoint}:{uid}' for uid in user_ids])
+    key = f'{endpoint}:{viewer_id or "-"}:' + ','.join(
+        f'{uid}.{generation}' for uid, generation in zip(user_ids, generations)
+    ) + (f'?{variant}' if variant else '')
+    
+    value = response_cache.get(key)
+    if value is None:
+        # A lagging replica could still miss the write that bumped the
+        # generation, which would park a stale result under the new key
+        with reading_from_primary():
+            value = compute()
+        response_cache.set(key, value)
+    return value
+
+def invalidate_responses(*user_ids, endpoints=COUPLE_ENDPOINTS):
+    """Forget cached responses of these endpoints for every couple containing one of these users"""
+    names = [f'gen:{endpoint}:{uid}' for uid in user_ids if uid for endpoint in endpoints]
+    publish_invalidation('responses', *names)
+
+def evict_responses(names):
+    if names is not None:
+        response_cache.bump(names)
+    elif isinstance(response_cache, LocalCacheBackend):
+        response_cache.clear()
+
+# A shared backend is already seen by every worker
+register_invalidation_handler('responses', evict_responses, broadcast=isinstance(response_cache, LocalCacheBackend))
+
+# ============================================================================
+# POSITION CATALOG
+# ============================================================================
+
+# Built-in positions in display order: key -> name
+BUILTIN_POSITIONS = {
+    'missionary': 'Missionary',
+    'doggy': 'Doggy Style',
+    'cowgirl': 'Cowgirl',
+    'reverse_cowgirl': 'Reverse Cowgirl',
+    'spoon': 'Spooning',
+    'standing': 'Standing',
+    'oral': 'Oral',
+    '69': '69',
+    'other': 'Other'
+}
+_builtin_keys_by_name = {name: key for key, name in BUILTIN_POSITIONS.items()}
+
+@dataclass(frozen=True)
+class PositionCatalog:
+    """Built-in positions merged with one user's custom icons"""
+    version: str
+    names: dict
+    icons: dict
+    
+    def name_of(self, position):
+        return self.names.get(position, 'Other')
+    
+    def to_json(self):
+        return {
+            'version': self.version,
+            'positions': [{
+                'key': key,
+                'name': name,
+                'builtin': key in BUILTIN_POSITIONS,
+                'icon': self.icons.get(key)
+            } for key, name in self.names.items()]
+        }
+
+def position_key(position_name):
+    """Catalog key for a CustomIcon position_name, which may be a key or a display name"""
+    return _builtin_keys_by_name.get(position_name) or position_name.strip().lower().replace(' ', '_')
+
+# user_id -> (loaded_at, PositionCatalog)
+_position_catalog_cache = {}
+_position_catalog_lock = threading.Lock()
+
+def position_catalog(user_id):
+    """Return the user's PositionCatalog, from cache or with a single query"""
+    now = time.monotonic()
+    with _position_catalog_lock:
+        cached = _position_catalog_cache.get(user_id)
+    if cached and now - cached[0] < app.config['POSITION_CATALOG_TTL']:
+        return cached[1]
+    
+    names = dict(BUILTIN_POSITIONS)
+    icons = {}
+    for position_name, svg in db.session.query(CustomIcon.position_name, CustomIcon.svg_content).filter(
+        CustomIcon.user_id == user_id
+    ).order_by(CustomIcon.position_name):
+        key = position_key(position_name)
+        names.setdefault(key, position_name)
+        icons[key] = svg
+    
+    # Derived from the content, so every worker stamps the same catalog alike
+    version = hashlib.sha1(json.dumps([names, icons]).encode()).hexdigest()[:16]
+    catalog = PositionCatalog(version=version, names=names, icons=icons)
+    with _position_catalog_lock:
+        _position_catalog_cache[user_id] = (now, catalog)
+    return catalog
+
+def invalidate_positions(user_id):
+    """Drop a user's catalog and the listings that show its names; call before committing the change to their icons"""
+    publish_invalidation('positions', user_id)
+    invalidate_responses(user_id, endpoints=('encounters', 'calendar-feed', 'analytics'))
+
+def evict_position_catalogs(user_ids):
+    with _position_catalog_lock:
+        if user_ids is None:
+            _position_catalog_cache.clear()
+        else:
+            for user_id in user_ids:
+                _position_catalog_cache.pop(user_id, None)
+
+register_invalidation_handler('positions', evict_position_catalogs)
+
+# ============================================================================
+# PROPOSAL SCHEDULER
+# ============================================================================
+
+class ProposalScheduler:
+    """Expires overdue proposals and sends reminders before accepted ones"""
+    
+    # Due work sits in a heap ordered by due time and the thread sleeps until the
+    # earliest item. Only the next SCHEDULER_HORIZON_HOURS are held in memory,
+    # loaded with range scans on the (status, proposed_date) index and reloaded
+    # every SCHEDULER_REFILL_SECONDS, since schedule() only reaches the worker
+    # that made the change. Every action is a conditional UPDATE, so workers
+    # holding the same item act on it once.
+    
+    def __init__(self):
+        self._heap = []
+        self._queued = set()
+        self._sequence = 0
+        self._condition = threading.Condition()
+        self._loaded_until = None
+        self._next_refill = None
+        self._pid = None
+    
+    def schedule(self, due, kind, proposal_id):
+        """Queue kind ('expire' or 'remind') for proposal_id at due (server-local, like proposed_date)"""
+        with self._condition:
+            # Past the loaded window the next refill will find it in the table
+            if self._loaded_until is None or due > self._loaded_until:
+                return
+            if (kind, proposal_id) in self._queued:
+                return
+            self._queued.add((kind, proposal_id))
+            self._sequence += 1
+            heapq.heappush(self._heap, (due, self._sequence, kind, proposal_id))
+            self._condition.notify()
+    
+    def start(self):
+        """Start this process's scheduler thread once"""
+        with self._condition:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            # A forked worker inherits the parent's heap but not its thread
+            self._heap = []
+            self._queued = set()
+            self._loaded_until = None
+            self._next_refill = None
+        threading.Thread(target=self.run, name='proposal-scheduler', daemon=True).start()
+    
+    def run(self):
+        """Scheduler loop; runs until the process exits"""
+        while True:
+            try:
+                with app.app_context():
+                    self._tick()
+            except Exception as e:
+                logger.exception("Proposal scheduler failed: %s", e)
+                time.sleep(30)
+    
+    def _tick(self):
+        now = datetime.now()
+        if self._next_refill is None or now >= self._next_refill:
+            self._refill(now)
+        
+        due = {'expire': [], 'remind': []}
+        with self._condition:
+            while self._heap and self._heap[0][0] <= now:
+                _, _, kind, proposal_id = heapq.heappop(self._heap)
+                self._queued.discard((kind, proposal_id))
+                due[kind].append(proposal_id)
+        
+        batch_size = app.config['SCHEDULER_BATCH_SIZE']
+        for start in range(0, len(due['expire']), batch_size):
+            expire_proposals(due['expire'][start:start + batch_size], now)
+        for start in range(0, len(due['remind']), batch_size):
+            send_proposal_reminders(due['remind'][start:start + batch_size])
+        
+        with self._condition:
+            wake_at = self._next_refill
+            if self._heap:
+                wake_at = min(wake_at, self._heap[0][0])
+            self._condition.wait(timeout=max((wake_at - datetime.now()).total_seconds(), 0.05))
+    
+    def _refill(self, now):
+        """Expire what is overdue and queue everything due between now and now + horizon"""
+        lead = timedelta(minutes=app.config['PROPOSAL_REMINDER_LEAD_MINUTES'])
+        until = now + timedelta(hours=app.config['SCHEDULER_HORIZON_HOURS'])
+        
+        # Overdue pending proposals are expired in batches before anything else
+        while expire_overdue_batch(now):
+            pass
+        
+        # Widen the window before querying so proposals created meanwhile are
+        # pushed by schedule(); one already queued is skipped
+        with self._condition:
+            self._loaded_until = until
+            self._next_refill = now + timedelta(seconds=app.config['SCHEDULER_REFILL_SECONDS'])
+        
+        pending = ProposedEncounter.query.with_entities(
+            ProposedEncounter.id, ProposedEncounter.proposed_date
+        ).filter(
+            ProposedEncounter.status == 'pending',
+            ProposedEncounter.proposed_date <= until,
+            ProposedEncounter.proposed_date > now
+        ).all()
+        accepted = ProposedEncounter.query.with_entities(
+            ProposedEncounter.id, ProposedEncounter.proposed_date
+        ).filter(
+            ProposedEncounter.status == 'accepted',
+            ProposedEncounter.reminder_sent_at.is_(None),
+            ProposedEncounter.proposed_date <= until + lead,
+            ProposedEncounter.proposed_date > now
+        ).all()
+        
+        for proposal_id, proposed_date in pending:
+            self.schedule(proposed_date, 'expire', proposal_id)
+        for proposal_id, proposed_date in accepted:
+            self.schedule(proposed_date - lead, 'remind', proposal_id)
+
+proposal_scheduler = ProposalScheduler()
+
+def schedule_proposal(proposal):
+    """Queue expiry for a pending proposal or the reminder for an accepted one"""
+    if proposal.status == 'pending':
+        proposal_scheduler.schedule(proposal.proposed_date, 'expire', proposal.id)
+    elif proposal.status == 'accepted' and proposal.reminder_sent_at is None:
+        lead = timedelta(minutes=app.config['PROPOSAL_REMINDER_LEAD_MINUTES'])
+        proposal_scheduler.schedule(proposal.proposed_date - lead, 'remind', proposal.id)
+
+def expire_proposals(proposal_ids, now):
+    """Expire the given proposals that are still pending and overdue"""
+    if not proposal_ids:
+        return 0
+    expired = db.session.execute(
+        update(ProposedEncounter).where(
+            ProposedEncounter.id.in_(proposal_ids),
+            ProposedEncounter.status == 'pending',
+            ProposedEncounter.proposed_date <= now
+        ).values(status='expired').returning(
+            ProposedEncounter.proposer_id, ProposedEncounter.recipient_id, ProposedEncounter.proposed_date
+        )
+    ).all()
+    invalidate_responses(*{recipient_id for _, recipient_id, _ in expired}, endpoints=('stats',))
+    db.session.commit()
+    
+    for proposer_id, recipient_id, proposed_date in expired:
+        create_notification(
+            proposer_id,
+            'proposal_expired',
+            f"⌛ Your proposal for {proposed_date.strftime('%b %d')} expired without an answer"
+        )
+    if expired:
+        logger.info("Expired %d proposals", len(expired), extra=log_fields(event='proposals_expired', count=len(expired)))
+    return len(expired)
+
+def expire_overdue_batch(now):
+    """Expire one batch of overdue pending proposals; returns how many were expired"""
+    overdue = [row[0] for row in ProposedEncounter.query.with_entities(ProposedEncounter.id).filter(
+        ProposedEncounter.status == 'pending',
+        ProposedEncounter.proposed_date <= now
+    ).order_by(ProposedEncounter.proposed_date).limit(app.config['SCHEDULER_BATCH_SIZE'])]
+    return expire_proposals(overdue, now)
+
+def send_proposal_reminders(proposal_ids):
+    """Remind both partners of accepted proposals, claiming each reminder once"""
+    if not proposal_ids:
+        return
+    claimed = db.session.execute(
+        update(ProposedEncounter).where(
+            ProposedEncounter.id.in_(proposal_ids),
+            ProposedEncounter.status == 'accepted',
+            ProposedEncounter.reminder_sent_at.is_(None)
+        ).values(reminder_sent_at=datetime.utcnow()).returning(
+            ProposedEncounter.proposer_id, ProposedEncounter.recipient_id, ProposedEncounter.proposed_date
+        )
+    ).all()
+    db.session.commit()
+    
+    for proposer_id, recipient_id, proposed_date in claimed:
+        message = f"⏰ Reminder: your date is at {proposed_date.strftime('%H:%M on %b %d')}"
+        for user in User.query.filter(User.id.in_([proposer_id, recipient_id])):
+            create_notification(user.id, 'proposal_reminder', message)
+            if user.sms_notifications and user.phone_number:
+                send_notification_message(user.phone_number, message)
+
+@app.cli.command('scheduler')
+def scheduler_command():
+    """Run the proposal scheduler in the foreground (for a separate job runner)"""
+    # Web workers can then run with SCHEDULER_ENABLED=0
+    proposal_scheduler.run()
+
+_services_pid = None
+_services_lock = threading.Lock()
+
+def start_background_services():
+    """Start this process's listener, scheduler and maintenance threads once"""
+    global _services_pid
+    # Concurrent first requests in a threaded worker must not both get past this
+    with _services_lock:
+        if _services_pid == os.getpid():
+            return
+        _services_pid = os.getpid()
+    start_log_listener()
+    start_invalidation_listener()
+    if app.config['SCHEDULER_ENABLED']:
+        proposal_scheduler.start()
+    if app.config['STATS_MAINTENANCE_ENABLED']:
+        threading.Thread(target=stats_maintenance_loop, name='stats-maintenance', daemon=True).start()
+
+@app.before_request
+def ensure_background_services():
+    # Also started here so each forked worker gets its own threads
+    if _services_pid != os.getpid():
+        start_background_services()
+
+# ============================================================================
+# STATS MAINTENANCE
+# ============================================================================
+
+def claim_job_run(job, today):
+    """True for the one worker that gets to run job today"""
+    dialect_insert = postgresql_insert if is_postgres() else sqlite_insert
+    db.session.execute(dialect_insert(JobRun).values(job=job).on_conflict_do_nothing(index_elements=['job']))
+    claimed = db.session.execute(
+        update(JobRun).where(
+            JobRun.job == job,
+            or_(JobRun.last_run_on.is_(None), JobRun.last_run_on < today)
+        ).values(last_run_on=today, started_at=datetime.utcnow()).returning(JobRun.job)
+    ).first()
+    db.session.commit()
+    return claimed is not None
+
+def decay_streaks(today):
+    """Zero the current streak of everyone with no encounter since the day before yesterday"""
+    yesterday = today - timedelta(days=1)
+    user_ids = [row[0] for row in db.session.execute(
+        update(UserStats).where(
+            UserStats.current_streak > 0,
+            or_(UserStats.last_encounter_date.is_(None), UserStats.last_encounter_date < yesterday)
+        ).values(current_streak=0, updated_at=datetime.utcnow()).returning(
+            UserStats.user_id
+        ).execution_options(synchronize_session=False)
+    )]
+    invalidate_responses(*user_ids, endpoints=('user-stats',))
+    db.session.commit()
+    return len(user_ids)
+
+def reconcile_user_stats():
+    """Rewrite total_encounters, total_points and level that drifted from the source tables"""
+    # Correlated subqueries recount each row from what the points were awarded for
+    encounters = select(func.count(Encounter.id)).where(
+        Encounter.user_id == UserStats.user_id
+    ).scalar_subquery()
+    ratings = select(func.count(EncounterRating.id)).where(
+        EncounterRating.user_id == UserStats.user_id
+    ).scalar_subquery()
+    comments = select(func.count(Comment.id)).where(
+        Comment.commenter_id == UserStats.user_id
+    ).scalar_subquery()
+    achievement_points = select(
+        func.coalesce(func.sum(case(TIER_POINTS, value=Achievement.tier, else_=10)), 0)
+    ).select_from(UserAchievement).join(
+        Achievement, UserAchievement.achievement_id == Achievement.id
+    ).where(
+        UserAchievement.user_id == UserStats.user_id, UserAchievement.unlocked_at.isnot(None)
+    ).scalar_subquery()
+    total_points = (
+        encounters * ENCOUNTER_POINTS + ratings * RATING_POINTS
+        + comments * COMMENT_POINTS + achievement_points
+    )
+    
+    batch_size = app.config['STATS_RECONCILE_BATCH_SIZE']
+    last_user_id = None
+    reconciled = 0
+    while True:
+        # Keyset batches keep every statement and transaction short
+        batch = db.session.query(UserStats.user_id)
+        if last_user_id is not None:
+            batch = batch.filter(UserStats.user_id > last_user_id)
+        batch = [row[0] for row in batch.order_by(UserStats.user_id).limit(batch_size)]
+        if not batch:
+            return reconciled
+        last_user_id = batch[-1]
+        
+        changed = [row[0] for row in db.session.execute(
+            update(UserStats).where(
+                UserStats.user_id.in_(batch),
+                or_(
+                    UserStats.total_encounters.is_distinct_from(encounters),
+                    UserStats.total_points.is_distinct_from(total_points),
+                    UserStats.level.is_distinct_from(total_points // 100 + 1)
+                )
+            ).values(
+                total_encounters=encounters,
+                total_points=total_points,
+                level=total_points // 100 + 1,
+                updated_at=datetime.utcnow()
+            ).returning(UserStats.user_id).execution_options(synchronize_session=False)
+        )]
+        invalidate_responses(*changed, endpoints=('user-stats',))
+        db.session.commit()
+        if changed:
+            logger.warning("Reconciled drifted stats for users %s", changed, extra=log_fields(event='stats_reconciled', user_ids=changed))
+            reconciled += len(changed)
+
+def run_stats_maintenance(today=None):
+    """Nightly pass: decay stale streaks, reconcile counters and prune old tombstones"""
+    today = today or date.today()
+    decayed = decay_streaks(today)
+    reconciled = reconcile_user_stats()
+    # Sync tokens older than the retention get a full resync instead
+    pruned = delete_in_batches(
+        Tombstone, Tombstone.deleted_at < datetime.utcnow() - timedelta(days=app.config['TOMBSTONE_RETENTION_DAYS'])
+    )
+    STATS_MAINTENANCE_ROWS.labels('streak_decay').inc(decayed)
+    STATS_MAINTENANCE_ROWS.labels('reconciled').inc(reconciled)
+    db.session.query(JobRun).filter_by(job='stats_maintenance').update({'finished_at': datetime.utcnow()})
+    db.session.commit()
+    logger.info(
+        "Stats maintenance: %d streaks decayed, %d users reconciled, %d tombstones pruned", decayed, reconciled, pruned,
+        extra=log_fields(event='stats_maintenance', decayed=decayed, reconciled=reconciled, pruned=pruned)
+    )
+    return decayed, reconciled
+
+def stats_maintenance_loop():
+    """Thread body: once a day at STATS_MAINTENANCE_HOUR, the worker that claims the run does it"""
+    while True:
+        try:
+            now = datetime.now()
+            run_at = datetime.combine(now.date(), dt_time(hour=app.config['STATS_MAINTENANCE_HOUR']))
+            if now >= run_at:
+                # Also catches up on a run missed while no worker was up
+                with app.app_context():
+                    if claim_job_run('stats_maintenance', now.date()):
+                        run_stats_maintenance(now.date())
+                run_at += timedelta(days=1)
+            time.sleep(max((run_at - datetime.now()).total_seconds(), 1))
+        except Exception as e:
+            logger.exception("Stats maintenance failed: %s", e)
+            time.sleep(300)
+
+@app.cli.command('stats-maintenance')
+def stats_maintenance_command():
+    """Decay stale streaks and reconcile user stats now (for cron or by hand)"""
+    decayed, reconciled = run_stats_maintenance()
+    print(f"{decayed} streaks decayed, {reconciled} users reconciled")
+
+@app.cli.command('achievement-progress')
+def achievement_progress_command():
+    """Fill in achievement progress for every user (once, after migration 008)"""
+    user_ids = [row[0] for row in db.session.query(User.id).order_by(User.id)]
+    for user_id in user_ids:
+        save_achievement_progress(user_id, achievement_metrics(user_id))
+    print(f"Achievement progress saved for {len(user_ids)} users")
+
+# ============================================================================
+# REQUEST INSTRUMENTATION
+# ============================================================================
+
+# Collapses expanded IN lists so "IN (?, ?, ?)" and "IN (?)" share a fingerprint
+_in_list_pattern = re.compile(r'\(\s*(?:\?|%\(\w+\)s|%s)(?:\s*,\s*(?:\?|%\(\w+\)s|%s))*\s*\)')
+
+def statement_fingerprint(statement):
+    return _in_list_pattern.sub('(?)', ' '.join(statement.split()))
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_cursor_error(exception_context):
+    # A failed statement skips after_cursor_execute; drop its start time so the
+    # pooled connection's list doesn't grow with every error
+    connection = exception_context.connection
+    if connection is not None and exception_context.execution_context is not None and connection.info.get('query_start'):
+        connection.info['query_start'].pop()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_start'].pop()
+    if not has_request_context():
+        return
+    stats = g.get('query_stats')
+    if stats is None:
+        return
+    stats['count'] += 1
+    stats['db_time'] += time.perf_counter() - started
+    fingerprint = statement_fingerprint(statement)
+    stats['fingerprints'][fingerprint] = stats['fingerprints'].get(fingerprint, 0) + 1
+
+@app.before_request
+def start_query_stats():
+    g.request_started = time.perf_counter()
+    g.query_stats = {'count': 0, 'db_time': 0.0, 'fingerprints': {}}
+
+@app.after_request
+def report_query_stats(response):
+    stats = g.get('query_stats')
+    if stats is None:
+        return response
+    
+    total_ms = (time.perf_counter() - g.request_started) * 1000
+    db_ms = stats['db_time'] * 1000
+    repeated = {}
+    # Query counts and timings are not for every client in production
+    if app.config['QUERY_STATS_ENABLED']:
+        response.headers['X-Query-Count'] = str(stats['count'])
+        response.headers.add(
+            'Server-Timing', f'db;dur={db_ms:.1f};desc="{stats["count"]} queries", app;dur={total_ms:.1f}'
+        )
+        
+        threshold = app.config['QUERY_REPEAT_WARN_THRESHOLD']
+        repeated = {fp: n for fp, n in stats['fingerprints'].items() if n > threshold}
+        for fingerprint, count in repeated.items():
+            logger.warning(
+                "Repeated query on %s %s: %d executions of %s",
+                request.method, request.path, count, fingerprint[:200]
+            )
+    
+    logger.info(
+        "request method=%s path=%s endpoint=%s status=%s queries=%d db_ms=%.1f total_ms=%.1f repeated=%d",
+        request.method, request.path, request.endpoint, response.status_code,
+        stats['count'], db_ms, total_ms, len(repeated),
+        extra=log_fields(
+            event='request',
+            method=request.method,
+            path=request.path,
+            endpoint=request.endpoint,
+            status=response.status_code,
+            queries=stats['count'],
+            db_ms=round(db_ms, 1),
+            total_ms=round(total_ms, 1),
+            repeated_statements=repeated
+        )
+    )
+    return response
+
+# ============================================================================
+# JSON AND COMPRESSION
+# ============================================================================
+
+class IsoJSONProvider(DefaultJSONProvider):
+    """Stdlib JSON provider that writes dates and times as ISO 8601"""
+    
+    @staticmethod
+    def default(o):
+        if isinstance(o, (datetime, date, dt_time)):
+            return o.isoformat()
+        return DefaultJSONProvider.default(o)
+
+class OrjsonProvider(IsoJSONProvider):
+    """orjson-backed provider; dates, times and datetimes serialize natively"""
+    
+    @staticmethod
+    def _default(o):
+        if isinstance(o, Decimal):
+            return float(o)
+        if isinstance(o, (set, frozenset)):
+            return list(o)
+        raise TypeError(f'Object of type {type(o).__name__} is not JSON serializable')
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self._default, option=orjson.OPT_NON_STR_KEYS).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self._default, option=orjson.OPT_NON_STR_KEYS),
+            mimetype=self.mimetype
+        )
+
+app.json = OrjsonProvider(app) if orjson else IsoJSONProvider(app)
+
+_compressible_types = (
+    'application/json', 'text/html', 'text/plain', 'text/css', 'text/calendar',
+    'application/javascript', 'text/javascript', 'image/svg+xml', 'application/manifest+json'
+)
+
+@app.after_request
+def compress_response(response):
+    """gzip/brotli-encode text responses above COMPRESSION_MIN_SIZE"""
+    if not app.config['COMPRESSION_ENABLED']:
+        return response
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in _compressible_types):
+        return response
+    
+    response.vary.add('Accept-Encoding')
+    if len(response.get_data()) < app.config['COMPRESSION_MIN_SIZE']:
+        return response
+    
+    offered = ['br', 'gzip'] if brotli else ['gzip']
+    encoding = request.accept_encodings.best_match(offered)
+    if encoding is None:
+        return response
+    
+    data = response.get_data()
+    if encoding == 'br':
+        body = brotli.compress(data, quality=min(app.config['COMPRESSION_LEVEL'], 11))
+    else:
+        body = gzip.compress(data, compresslevel=app.config['COMPRESSION_LEVEL'])
+    
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    
+    # The encoded body is a different representation of the same resource
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+# ============================================================================
+# SLOW REQUEST PROFILING
+# ============================================================================
+
+_profile_dir_lock = threading.Lock()
+_profile_name_pattern = re.compile(r'^[\w.-]+\.prof$')
+
+@app.before_request
+def start_profiling():
+    if not app.config['PROFILING_ENABLED']:
+        return
+    if random.random() >= app.config['PROFILE_SAMPLE_RATE']:
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiler already owns this interpreter (Python 3.12+)
+        return
+    g.profiler = profiler
+    g.profile_started = time.perf_counter()
+
+@app.after_request
+def note_profiled_status(response):
+    if 'profiler' in g:
+        g.profile_status = response.status_code
+    return response
+
+@app.teardown_request
+def finish_profiling(exception):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return
+    profiler.disable()
+    
+    elapsed_ms = (time.perf_counter() - g.profile_started) * 1000
+    if elapsed_ms < app.config['PROFILE_THRESHOLD_MS']:
+        return
+    
+    identity = g.get('identity')
+    stats = g.get('query_stats')
+    endpoint = request.endpoint or 'unmatched'
+    name = f"{datetime.utcnow():%Y%m%dT%H%M%S%f}_{endpoint}_{int(elapsed_ms)}ms"
+    context = {
+        'name': f'{name}.prof',
+        'recorded_at': datetime.utcnow().isoformat(),
+        'method': request.method,
+        'path': request.path,
+        'endpoint': endpoint,
+        'status': g.get('profile_status', 500 if exception else None),
+        'elapsed_ms': round(elapsed_ms, 1),
+        'queries': stats['count'] if stats else None,
+        'user_id': identity.id if identity else None,
+        'username': identity.username if identity else None
+    }
+    
+    try:
+        directory = app.config['PROFILE_DIR']
+        os.makedirs(directory, exist_ok=True)
+        profiler.dump_stats(os.path.join(directory, f'{name}.prof'))
+        with open(os.path.join(directory, f'{name}.json'), 'w') as f:
+            json.dump(context, f)
+        prune_profiles()
+        logger.warning("Profiled slow request %s %s (%.0f ms) as %s.prof", request.method, request.path, elapsed_ms, name)
+    except OSError as e:
+        logger.error("Failed to save request profile: %s", e)
+
+def list_profiles():
+    """Saved profiles, newest first, with their request context"""
+    directory = app.config['PROFILE_DIR']
+    if not os.path.isdir(directory):
+        return []
+    
+    profiles = []
+    for filename in os.listdir(directory):
+        if not filename.endswith('.prof'):
+            continue
+        path = os.path.join(directory, filename)
+        try:
+            with open(path[:-len('.prof')] + '.json') as f:
+                context = json.load(f)
+        except (OSError, ValueError):
+            context = {'name': filename}
+        context['size'] = os.path.getsize(path)
+        profiles.append(context)
+    
+    profiles.sort(key=lambda p: p['name'], reverse=True)
+    return profiles
+
+def prune_profiles():
+    """Delete the oldest profiles until the count and byte limits hold"""
+    with _profile_dir_lock:
+        profiles = list_profiles()
+        total_bytes = sum(p['size'] for p in profiles)
+        while profiles and (
+            len(profiles) > app.config['PROFILE_MAX_FILES']
+            or total_bytes > app.config['PROFILE_MAX_BYTES']
+        ):
+            oldest = profiles.pop()
+            total_bytes -= oldest['size']
+            base = os.path.join(app.config['PROFILE_DIR'], oldest['name'][:-len('.prof')])
+            for suffix in ('.prof', '.json'):
+                try:
+                    os.remove(base + suffix)
+                except FileNotFoundError:
+                    pass
+
+# ============================================================================
+# PASSWORD HASHING AND LOGIN THROTTLING
+# ============================================================================
+
+class HashingBusy(Exception):
+    """Raised when the password hashing queue is full"""
+
+_hash_executor = ThreadPoolExecutor(
+    max_workers=app.config['PASSWORD_HASH_WORKERS'],
+    thread_name_prefix='password-hash'
+)
+# Caps running plus queued hashes; callers beyond it are turned away
+_hash_slots = threading.BoundedSemaphore(
+    app.config['PASSWORD_HASH_WORKERS'] + app.config['PASSWORD_HASH_QUEUE_LIMIT']
+)
+
+def run_hash_job(fn, *args):
+    """Run a CPU-heavy hashing call on the bounded executor and wait for it"""
+    if not _hash_slots.acquire(blocking=False):
+        raise HashingBusy()
+    try:
+        future = _hash_executor.submit(fn, *args)
+    except Exception:
+        _hash_slots.release()
+        raise
+    future.add_done_callback(lambda _: _hash_slots.release())
+    try:
+        return future.result(timeout=app.config['PASSWORD_HASH_TIMEOUT'])
+    except FutureTimeoutError:
+        raise HashingBusy()
+
+def hash_password(password):
+    """Hash a password with the configured method"""
+    return run_hash_job(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'])
+
+def verify_password(password_hash, password):
+    """Check a password against a stored hash"""
+    return run_hash_job(check_password_hash, password_hash, password)
+
+def parse_hash_method(method):
+    """(name, parameters) of a Werkzeug method string, with Werkzeug's defaults filled in"""
+    # Hashes store the full method ('pbkdf2:sha256:600000'), while the setting
+    # may leave parameters out ('pbkdf2:sha256'); compare the two filled in
+    name, *args = method.split(':')
+    if name == 'scrypt' and not args:
+        args = [2 ** 15, 8, 1]
+    elif name == 'pbkdf2':
+        args = [args[0] if args else 'sha256', args[1] if len(args) > 1 else DEFAULT_PBKDF2_ITERATIONS]
+    return name, tuple(int(arg) if str(arg).isdigit() else arg for arg in args)
+
+def password_needs_rehash(password_hash):
+    """True when a stored hash was made with different parameters than configured"""
+    stored = parse_hash_method(password_hash.split('$', 1)[0])
+    return stored != parse_hash_method(app.config['PASSWORD_HASH_METHOD'])
+
+def hashing_busy_response():
+    response = jsonify({'error': 'Server busy, please try again shortly'})
+    response.status_code = 503
+    response.headers['Retry-After'] = '5'
+    return response
+
+class LocalAttemptStore:
+    """Attempt timestamps per (scope, key), kept in this process"""
+    
+    def __init__(self):
+        self._attempts = {}
+        self._lock = threading.Lock()
+    
+    def recent(self, scope, key, window):
+        """(attempts within window, seconds since the oldest of them)"""
+        now = time.monotonic()
+        with self._lock:
+            attempts = self._attempts.get((scope, key))
+            while attempts and now - attempts[0] > window:
+                attempts.popleft()
+            if not attempts:
+                self._attempts.pop((scope, key), None)
+                return 0, 0
+            return len(attempts), now - attempts[0]
+    
+    def add(self, scope, key, window):
+        now = time.monotonic()
+        with self._lock:
+            if len(self._attempts) > 10000:
+                # Sweep expired entries so a spray of usernames can't grow this forever
+                for stale in [k for k, v in self._attempts.items() if now - v[-1] > window]:
+                    del self._attempts[stale]
+            self._attempts.setdefault((scope, key), deque()).append(now)
+    
+    def clear(self, scope, key):
+        with self._lock:
+            self._attempts.pop((scope, key), None)
+
+class RedisAttemptStore:
+    """Attempt timestamps in a Redis sorted set per (scope, key), shared by every worker"""
+    
+    def __init__(self, url, prefix='stracker:attempts:'):
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url)
+    
+    def recent(self, scope, key, window):
+        name = f'{self.prefix}{scope}:{key}'
+        now = time.time()
+        pipeline = self._redis.pipeline()
+        pipeline.zremrangebyscore(name, 0, now - window)
+        pipeline.zrange(name, 0, 0, withscores=True)
+        pipeline.zcard(name)
+        _, oldest, count = pipeline.execute()
+        return (count, now - oldest[0][1]) if oldest else (0, 0)
+    
+    def add(self, scope, key, window):
+        name = f'{self.prefix}{scope}:{key}'
+        now = time.time()
+        pipeline = self._redis.pipeline()
+        pipeline.zadd(name, {f'{now}:{secrets.token_hex(4)}': now})
+        pipeline.expire(name, window)
+        pipeline.execute()
+    
+    def clear(self, scope, key):
+        self._redis.delete(f'{self.prefix}{scope}:{key}')
+
+def create_attempt_store():
+    url = app.config['LOGIN_THROTTLE_URL']
+    if url:
+        if redis is None:
+            raise RuntimeError('LOGIN_THROTTLE_URL is set but the redis package is not installed')
+        return RedisAttemptStore(url)
+    return LocalAttemptStore()
+
+login_attempts = create_attempt_store()
+
+def throttle_retry_after(scope, key, limit):
+    """Seconds until another attempt is allowed, or 0 if under the limit"""
+    window = app.config['LOGIN_THROTTLE_WINDOW']
+    count, oldest_age = login_attempts.recent(scope, key, window)
+    if count < limit:
+        return 0
+    return int(window - oldest_age) + 1
+
+def record_attempt(scope, key):
+    login_attempts.add(scope, key, app.config['LOGIN_THROTTLE_WINDOW'])
+
+def clear_attempts(scope, key):
+    login_attempts.clear(scope, key)
+
+def throttled_response(retry_after):
+    response = jsonify({'error': 'Too many attempts, please try again later'})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+# ============================================================================
+# AUTHENTICATION HELPERS
+# ============================================================================
+
+@dataclass(frozen=True)
+class Identity:
+    """Compact view of the logged-in user and their partner"""
+    id: int
+    username: str
+    partner_id: int
+    partner_username: str
+    is_admin: bool
+    sms_notifications: bool
+    phone_number: str
+    partner_sms_notifications: bool
+    partner_phone_number: str
+    
+    @property
+    def partner_notifiable(self):
+        """True when the partner wants external notifications and has a number"""
+        return bool(self.partner_sms_notifications and self.partner_phone_number)
+    
+    def username_of(self, user_id):
+        """Username for this user or their partner, otherwise a lookup"""
+        if user_id == self.id:
+            return self.username
+        if user_id == self.partner_id:
+            return self.partner_username
+        other = User.query.get(user_id)
+        return other.username if other else None
+
+# user_id -> (loaded_at, Identity)
+_identity_cache = {}
+_identity_cache_lock = threading.Lock()
+
+def load_identity(user_id):
+    """Return the Identity for a user, from cache or with a single query"""
+    now = time.monotonic()
+    with _identity_cache_lock:
+        cached = _identity_cache.get(user_id)
+    if cached and now - cached[0] < app.config['IDENTITY_CACHE_TTL']:
+        return cached[1]
+    
+    partner = aliased(User)
+    row = db.session.query(
+        User.id, User.username, User.partner_id, User.is_admin,
+        User.sms_notifications, User.phone_number,
+        partner.username, partner.sms_notifications, partner.phone_number
+    ).outerjoin(partner, partner.id == User.partner_id).filter(User.id == user_id).first()
+    
+    if not row:
+        return None
+    
+    identity = Identity(
+        id=row[0],
+        username=row[1],
+        partner_id=row[2],
+        partner_username=row[6],
+        is_admin=bool(row[3]),
+        sms_notifications=bool(row[4]),
+        phone_number=row[5],
+        partner_sms_notifications=bool(row[7]),
+        partner_phone_number=row[8]
+    )
+    with _identity_cache_lock:
+        _identity_cache[user_id] = (now, identity)
+    return identity
 
-def check_achievements(user_id):
-    """Check and unlock achievements for a user"""
-    user = User.query.get(user_id)
-    stats = get_or_create_user_stats(user_id)
-    
-    # Get all user's encounters
-    encounters = Encounter.query.filter_by(user_id=user_id).all()
-    total_count = len(encounters)
-    
-    # Frequency achievements
-    if total_count >= 1:
-        unlock_achievement(user_id, 'first_timer')
-    if total_count >= 10:
-        unlock_achievement(user_id, 'milestone_10')
-    if total_count >= 25:
-        unlock_achievement(user_id, 'milestone_25')
-    if total_count >= 50:
-        unlock_achievement(user_id, 'milestone_50')
-    if total_count >= 100:
-        unlock_achievement(user_id, 'century_club')
-    if total_count >= 365:
-        unlock_achievement(user_id, 'dedication')
-    
-    # Streak achievements
-    if stats.current_streak >= 3:
-        unlock_achievement(user_id, 'hot_streak')
-    if stats.current_streak >= 7:
-        unlock_achievement(user_id, 'on_fire')
-        unlock_achievement(user_id, 'week_streak')
-    if stats.current_streak >= 30:
-        unlock_achievement(user_id, 'unstoppable')
-    if stats.current_streak >= 100:
-        unlock_achievement(user_id, 'legend')
-    
-    # Variety achievements
-    positions_used = set([e.position for e in encounters])
-    if len(positions_used) >= 5:
-        unlock_achievement(user_id, 'explorer')
-    if len(positions_used) >= 9:
-        unlock_achievement(user_id, 'adventurer')
-    
-    # Position master
-    from collections import Counter
-    position_counts = Counter([e.position for e in encounters])
-    if any(count >= 10 for count in position_counts.values()):
-        unlock_achievement(user_id, 'position_master')
-    
-    # Rating achievements
-    ratings = EncounterRating.query.filter_by(user_id=user_id).all()
-    five_star_count = sum(1 for r in ratings if r.rating == 5)
-    if five_star_count >= 10:
-        unlock_achievement(user_id, 'five_star')
-    
-    high_ratings = sum(1 for r in ratings if r.rating >= 4)
-    if high_ratings >= 20:
-        unlock_achievement(user_id, 'consistency')
-    
-    if len(ratings) >= 25:
-        unlock_achievement(user_id, 'rated_all')
-    
-    # Social achievements
-    if user.partner_id:
-        unlock_achievement(user_id, 'connector')
-        
-        # Partner ratings
-        partner_ratings = EncounterRating.query.filter_by(user_id=user.partner_id).count()
-        if partner_ratings >= 10:
-            unlock_achievement(user_id, 'team_player')
-    
-    # Comments
-    comments = Comment.query.filter_by(commenter_id=user_id).count()
-    if comments >= 1:
-        unlock_achievement(user_id, 'commenter')
-    if comments >= 50:
-        unlock_achievement(user_id, 'communicator')
-    
-    # Time-based achievements  
-    encounters_with_time = [e for e in encounters if e.time]
-    night_count = sum(1 for e in encounters_with_time if e.time.hour >= 0 and e.time.hour < 6)
-    morning_count = sum(1 for e in encounters_with_time if e.time.hour >= 6 and e.time.hour < 12)
-    
-    if night_count >= 10:
-        unlock_achievement(user_id, 'night_owl')
-    if morning_count >= 10:
-        unlock_achievement(user_id, 'early_bird')
-    
-    # Weekend/weekday
-    weekend_count = sum(1 for e in encounters if e.date.weekday() >= 5)
-    weekday_count = sum(1 for e in encounters if e.date.weekday() < 5)
-    
-    if weekend_count >= 20:
-        unlock_achievement(user_id, 'weekend_warrior')
-    if weekday_count >= 20:
-        unlock_achievement(user_id, 'weekday_wonder')
-    
-    # Special achievements
-    encounters_with_duration = sum(1 for e in encounters if e.duration)
-    if encounters_with_duration >= 20:
-        unlock_achievement(user_id, 'data_lover')
-    
-    encounters_with_notes = sum(1 for e in encounters if e.notes)
-    if encounters_with_notes >= 25:
-        unlock_achievement(user_id, 'detailed')
-    
-    # Custom icons
-    custom_encounters = sum(1 for e in encounters if e.position not in ['missionary', 'doggy', 'cowgirl', 'reverse_cowgirl', 'spoon', 'standing', 'oral', '69', 'other'])
-    if custom_encounters >= 1:
-        unlock_achievement(user_id, 'custom_lover')
+def invalidate_identity(*user_ids):
+    """Drop cached identities; call before committing a change to a user or their partner link"""
+    publish_invalidation('identity', *user_ids)
+
+def evict_identities(user_ids):
+    with _identity_cache_lock:
+        if user_ids is None:
+            _identity_cache.clear()
+        else:
+            for user_id in user_ids:
+                _identity_cache.pop(user_id, None)
+
+register_invalidation_handler('identity', evict_identities)
+
+@app.before_request
+def attach_identity():
+    """Load the session user's identity into g once per request"""
+    g.identity = None
+    if 'user_id' in session:
+        g.identity = load_identity(session['user_id'])
+        if g.identity is None:
+            # Account no longer exists
+            session.clear()
+
+def login_required(view):
+    """Redirect anonymous visitors of a page to the login screen"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if g.identity is None:
+            return redirect(url_for('login'))
+        return view(*args, **kwargs)
+    return wrapper
+
+def api_login_required(view):
+    """Reject anonymous API calls with 401"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if g.identity is None:
+            return jsonify({'error': 'Not authenticated'}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+def api_admin_required(view):
+    """Reject API calls from anyone but an authenticated admin"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if g.identity is None:
+            return jsonify({'error': 'Not authenticated'}), 401
+        if not g.identity.is_admin:
+            return jsonify({'error': 'Admin access required'}), 403
+        return view(*args, **kwargs)
+    return wrapper
 
 # ============================================================================
 # AUTHENTICATION ROUTES
 # ============================================================================
 
 @app.route('/')
+@login_required
 def index():
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
     return render_template('calendar.html')
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         data = request.get_json()
-        user = User.query.filter_by(username=data['username']).first()
+        username = data['username']
+        
+        retry_after = max(
+            throttle_retry_after('ip', request.remote_addr, app.config['LOGIN_IP_LIMIT']),
+            throttle_retry_after('username', username, app.config['LOGIN_USERNAME_LIMIT'])
+        )
+        if retry_after:
+            return throttled_response(retry_after)
         
-        if user and check_password_hash(user.password_hash, data['password']):
+        user = User.query.filter_by(username=username).first()
+        
+        try:
+            valid = user is not None and verify_password(user.password_hash, data['password'])
+        except HashingBusy:
+            return hashing_busy_response()
+        
+        if valid:
+            clear_attempts('username', username)
+            
+            # Upgrade hashes made with older parameters while we have the password
+            if password_needs_rehash(user.password_hash):
+                try:
+                    user.password_hash = hash_password(data['password'])
+                    db.session.commit()
+                except HashingBusy:
+                    pass
+            
             session.permanent = True
             session['user_id'] = user.id
             return jsonify({'success': True})
         
+        # Only failures count, so a busy NAT or proxy address isn't locked out
+        record_attempt('ip', request.remote_addr)
+        record_attempt('username', username)
         return jsonify({'error': 'Invalid credentials'}), 401
     
     return render_template('login.html')
@@ -455,14 +2582,25 @@ def login():
 def register():
     data = request.get_json()
     
+    # Registrations are counted apart from logins, every one of them
+    retry_after = throttle_retry_after('register', request.remote_addr, app.config['LOGIN_IP_LIMIT'])
+    if retry_after:
+        return throttled_response(retry_after)
+    record_attempt('register', request.remote_addr)
+    
     if User.query.filter_by(username=data['username']).first():
         return jsonify({'error': 'Username already exists'}), 400
     
     partner_code = secrets.token_hex(8)
     
+    try:
+        password_hash = hash_password(data['password'])
+    except HashingBusy:
+        return hashing_busy_response()
+    
     user = User(
         username=data['username'],
-        password_hash=generate_password_hash(data['password']),
+        password_hash=password_hash,
         partner_code=partner_code
     )
     
@@ -480,88 +2618,154 @@ def register():
 @app.route('/logout')
 def logout():
     session.clear()
-    return redirect(url_for('login'))
+    response = redirect(url_for('login'))
+    # Drops the service worker's cached pages, reads and queued writes too
+    response.headers['Clear-Site-Data'] = '"cache", "storage"'
+    return response
+
+@app.route('/api/session')
+@api_login_required
+def current_session():
+    """Who is signed in; the service worker checks it before replaying queued writes"""
+    return jsonify({'user_id': g.identity.id})
 
 # ============================================================================
 # PAGE ROUTES
 # ============================================================================
 
 @app.route('/profile')
+@login_required
 def profile():
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
-    user = User.query.get(session['user_id'])
-    partner = User.query.get(user.partner_id) if user.partner_id else None
+    user = User.query.get(g.identity.id)
+    partner = {'username': g.identity.partner_username} if g.identity.partner_id else None
     return render_template('profile.html', user=user, partner=partner)
 
 @app.route('/admin')
+@login_required
 def admin():
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
-    user = User.query.get(session['user_id'])
-    if not user.is_admin:
+    if not g.identity.is_admin:
         return redirect(url_for('index'))
     
     return render_template('admin.html')
 
 @app.route('/messages')
+@login_required
 def messages_page():
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
     return render_template('messages.html')
 
 @app.route('/proposals')
+@login_required
 def proposals_page():
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
     return render_template('proposals.html')
 
 @app.route('/achievements')
+@login_required
 def achievements_page():
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
     return render_template('achievements.html')
 
 @app.route('/challenges')
+@login_required
 def challenges_page():
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
     return render_template('challenges.html')
 
+@app.route('/analytics')
+@login_required
+def analytics_page():
+    return render_template('analytics.html')
+
 # Continue in next message...
 
+# ============================================================================
+# OFFLINE SUPPORT
+# ============================================================================
+
+# Page shells the service worker precaches; none of them render per-user data
+OFFLINE_PAGES = {
+    '/': 'calendar.html',
+    '/messages': 'messages.html',
+    '/proposals': 'proposals.html',
+    '/achievements': 'achievements.html',
+    '/challenges': 'challenges.html',
+    '/analytics': 'analytics.html',
+    '/search': 'search.html',
+}
+# Reads served stale-while-revalidate
+OFFLINE_READ_APIS = (
+    '/api/calendar/bootstrap',
+    '/api/encounters',
+    '/api/achievements',
+    '/api/challenges',
+    '/api/custom-icons',
+    '/api/positions',
+)
+
+_offline_version = None
+
+def offline_version():
+    """Hash of the precached templates, so a deploy that changes them ships a new worker"""
+    global _offline_version
+    if _offline_version is None or app.debug:
+        digest = hashlib.sha1()
+        for name in sorted(set(OFFLINE_PAGES.values())) + ['_offline.html', 'sw.js']:
+            digest.update(app.jinja_env.loader.get_source(app.jinja_env, name)[0].encode())
+        _offline_version = digest.hexdigest()[:12]
+    return _offline_version
+
+@app.route('/sw.js')
+def service_worker():
+    response = app.response_class(
+        render_template(
+            'sw.js',
+            version=offline_version(),
+            pages=list(OFFLINE_PAGES),
+            read_apis=list(OFFLINE_READ_APIS)
+        ),
+        mimetype='application/javascript'
+    )
+    # Browsers compare the script byte for byte; never serve them a stale copy
+    response.cache_control.no_cache = True
+    response.headers['Service-Worker-Allowed'] = '/'
+    return response
+
+@app.route('/manifest.webmanifest')
+def web_manifest():
+    manifest = {
+        'name': 'Intimate Tracker',
+        'short_name': 'Tracker',
+        'start_url': '/',
+        'scope': '/',
+        'display': 'standalone',
+        'background_color': '#667eea',
+        'theme_color': '#764ba2'
+    }
+    response = app.response_class(json.dumps(manifest), mimetype='application/manifest+json')
+    response.cache_control.max_age = 86400
+    return response
+
 # ============================================================================
 # API ROUTES - Profile
 # ============================================================================
 
 @app.route('/api/profile', methods=['POST'])
+@api_login_required
 def update_profile():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
-    user = User.query.get(session['user_id'])
+    user = User.query.get(g.identity.id)
     data = request.get_json()
     
     user.full_name = data.get('full_name', '')
     user.phone_number = data.get('phone_number', '')
     user.sms_notifications = data.get('sms_notifications', False)
     
+    # The partner's identity carries this user's notification settings
+    invalidate_identity(user.id, user.partner_id)
     db.session.commit()
     
     return jsonify({'success': True})
 
 @app.route('/api/connect-partner', methods=['POST'])
+@api_login_required
 def connect_partner():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
-    user = User.query.get(session['user_id'])
+    user = User.query.get(g.identity.id)
     data = request.get_json()
     partner_code = data.get('partner_code')
     
@@ -573,26 +2777,58 @@ def connect_partner():
     if partner.id == user.id:
         return jsonify({'error': 'Cannot connect to yourself'}), 400
     
+    previous_partner_ids = (user.partner_id, partner.partner_id)
     user.partner_id = partner.id
     partner.partner_id = user.id
     
+    invalidate_responses(user.id, partner.id, *previous_partner_ids)
+    invalidate_identity(user.id, partner.id, *previous_partner_ids)
     db.session.commit()
     
+    # The partner and partner_ratings metrics change for everyone involved
+    for user_id in {user.id, partner.id, *previous_partner_ids} - {None}:
+        check_achievements(user_id)
+    
     return jsonify({'success': True})
 
 @app.route('/api/disconnect-partner', methods=['POST'])
+@api_login_required
 def disconnect_partner():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
-    user = User.query.get(session['user_id'])
+    user = User.query.get(g.identity.id)
     
     if user.partner_id:
         partner = User.query.get(user.partner_id)
         if partner:
             partner.partner_id = None
+        previous_partner_id = user.partner_id
         user.partner_id = None
+        invalidate_responses(user.id, previous_partner_id)
+        invalidate_identity(user.id, previous_partner_id)
         db.session.commit()
+        
+        # Neither counts the other's ratings any more
+        check_achievements(user.id)
+        check_achievements(previous_partner_id)
+    
+    return jsonify({'success': True})
+
+@app.route('/api/account/delete', methods=['POST'])
+@api_login_required
+def delete_account():
+    """Permanently delete the current account and everything it owns"""
+    data = request.get_json() or {}
+    user = User.query.get(g.identity.id)
+    
+    try:
+        valid = verify_password(user.password_hash, data.get('password', ''))
+    except HashingBusy:
+        return hashing_busy_response()
+    
+    if not valid:
+        return jsonify({'error': 'Invalid password'}), 401
+    
+    purge_users([user.id])
+    session.clear()
     
     return jsonify({'success': True})
 
@@ -600,46 +2836,138 @@ def disconnect_partner():
 # API ROUTES - Encounters
 # ============================================================================
 
+# Fields a client may pick with ?fields=, each mapped to the columns it reads
+ENCOUNTER_FIELDS = {
+    'id': ('id',),
+    'date': ('date',),
+    'time': ('time',),
+    'position': ('position',),
+    'position_name': ('position', 'user_id'),
+    'duration': ('duration',),
+    'rating': ('rating',),
+    'notes': ('notes',),
+    'user_id': ('user_id',),
+    'is_own': ('user_id',),
+    'username': ('user_id',)
+}
+ENCOUNTER_QUERY_PARAMS = (
+    'position', 'min_rating', 'max_rating', 'from', 'to', 'month', 'year', 'has_notes', 'min_duration', 'fields'
+)
+
+def parse_encounter_query(args):
+    """Filter conditions and requested fields from /api/encounters parameters; raises ValueError"""
+    def whole_number(name, low, high):
+        value = args.get(name, '')
+        if value == '':
+            return None
+        if not value.isdigit() or not low <= int(value) <= high:
+            raise ValueError(f'{name} must be a whole number between {low} and {high}')
+        return int(value)
+    
+    def day(name):
+        value = args.get(name, '')
+        if value == '':
+            return None
+        try:
+            return date.fromisoformat(value)
+        except ValueError:
+            raise ValueError(f'{name} must be a date like 2024-01-31')
+    
+    conditions = []
+    
+    positions = [p for value in args.getlist('position') for p in value.split(',') if p]
+    if positions:
+        conditions.append(Encounter.position.in_(positions))
+    
+    min_rating = whole_number('min_rating', 1, 5)
+    max_rating = whole_number('max_rating', 1, 5)
+    if min_rating is not None or max_rating is not None:
+        # Matches when either partner's rating, or one given when logging it, is in range
+        low, high = min_rating or 1, max_rating or 5
+        conditions.append(or_(
+            Encounter.rating.between(low, high),
+            db.session.query(EncounterRating.id).filter(
+                EncounterRating.encounter_id == Encounter.id,
+                EncounterRating.rating.between(low, high)
+            ).exists()
+        ))
+    
+    start, end = day('from'), day('to')
+    month, year = whole_number('month', 1, 12), whole_number('year', 1, 9999)
+    if month and year:
+        # The calendar asks for one month at a time
+        month_start = date(year, month, 1)
+        month_end = date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+        start = max(start, month_start) if start else month_start
+        end = min(end, month_end) if end else month_end
+    if start:
+        conditions.append(Encounter.date >= start)
+    if end:
+        conditions.append(Encounter.date <= end)
+    
+    has_notes = args.get('has_notes', '').lower()
+    if has_notes in ('1', 'true'):
+        conditions.append(and_(Encounter.notes.isnot(None), Encounter.notes != ''))
+    elif has_notes in ('0', 'false'):
+        conditions.append(or_(Encounter.notes.is_(None), Encounter.notes == ''))
+    elif has_notes:
+        raise ValueError('has_notes must be true or false')
+    
+    min_duration = whole_number('min_duration', 0, 24 * 60)
+    if min_duration is not None:
+        conditions.append(Encounter.duration >= min_duration)
+    
+    requested = {f for f in args.get('fields', '').split(',') if f}
+    unknown = requested - ENCOUNTER_FIELDS.keys()
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    # id is always returned so rows can be opened; no fields means all of them
+    fields = tuple(f for f in ENCOUNTER_FIELDS if f in requested or f == 'id' or not requested)
+    
+    return conditions, fields
+
+def encounter_listing(identity, user_ids, args):
+    """Cached encounter rows for /api/encounters parameters; raises ValueError"""
+    conditions, fields = parse_encounter_query(args)
+    
+    def list_encounters():
+        return encounter_rows(identity, user_ids, conditions, fields)
+    
+    # Each distinct filter/field combination is cached separately, all
+    # under the couple's 'encounters' generation
+    variant = urlencode(sorted(
+        (key, value) for key, value in args.items(multi=True) if key in ENCOUNTER_QUERY_PARAMS
+    ))
+    return cached_response('encounters', list_encounters, user_ids, viewer_id=identity.id, variant=variant)
+
+def encounter_rows(identity, user_ids, conditions, fields):
+    """The couple's matching encounters, reading only the columns fields needs"""
+    # Each encounter is named from its owner's catalog
+    catalogs = {user_id: position_catalog(user_id) for user_id in user_ids}
+    columns = {column for field in fields for column in ENCOUNTER_FIELDS[field]}
+    rows = db.session.query(*(getattr(Encounter, column) for column in sorted(columns))).filter(
+        Encounter.user_id.in_(user_ids), *conditions
+    ).order_by(Encounter.date, Encounter.id)
+    
+    derived = {
+        'position_name': lambda e: catalogs[e['user_id']].name_of(e['position']),
+        'is_own': lambda e: e['user_id'] == identity.id,
+        'username': lambda e: identity.username_of(e['user_id'])
+    }
+    return [{
+        field: derived[field](e) if field in derived else e[field] for field in fields
+    } for e in (row._mapping for row in rows)]
+
 @app.route('/api/encounters', methods=['GET', 'POST'])
+@api_login_required
 def encounters():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
+    identity = g.identity
     
     if request.method == 'GET':
-        user = User.query.get(session['user_id'])
-        user_ids = [user.id]
-        if user.partner_id:
-            user_ids.append(user.partner_id)
-        
-        encounters = Encounter.query.filter(
-            Encounter.user_id.in_(user_ids)
-        ).all()
-        
-        positions_dict = {
-            'missionary': 'Missionary',
-            'doggy': 'Doggy Style',
-            'cowgirl': 'Cowgirl',
-            'reverse_cowgirl': 'Reverse Cowgirl',
-            'spoon': 'Spooning',
-            'standing': 'Standing',
-            'oral': 'Oral',
-            '69': '69',
-            'other': 'Other'
-        }
-        
-        return jsonify([{
-            'id': e.id,
-            'date': e.date.isoformat(),
-            'time': e.time.isoformat() if e.time else None,
-            'position': e.position,
-            'position_name': positions_dict.get(e.position, 'Other'),
-            'duration': e.duration,
-            'rating': e.rating,
-            'notes': e.notes,
-            'user_id': e.user_id,
-            'is_own': e.user_id == session['user_id'],
-            'username': User.query.get(e.user_id).username
-        } for e in encounters])
+        try:
+            return jsonify(encounter_listing(identity, couple_user_ids(identity), request.args))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
     
     else:  # POST
         data = request.get_json()
@@ -657,7 +2985,7 @@ def encounters():
         elif rating is not None:
             rating = int(rating)
         
-        current_user_id = session['user_id']
+        current_user_id = identity.id
         
         encounter = Encounter(
             user_id=current_user_id,
@@ -670,56 +2998,53 @@ def encounters():
         )
         
         db.session.add(encounter)
+        invalidate_responses(current_user_id)
         db.session.commit()
         
         # Update streak and stats
         update_streak(current_user_id, encounter.date)
         
         # Award points for encounter
-        award_points(current_user_id, 5, "New encounter")
+        award_points(current_user_id, ENCOUNTER_POINTS, "New encounter")
         
         # Check achievements
         check_achievements(current_user_id)
         
         # Notify partner if connected
-        user = User.query.get(current_user_id)
-        if user.partner_id:
-            partner = User.query.get(user.partner_id)
-            notification_msg = f"💕 {user.username} added a new intimate moment"
+        if identity.partner_id:
+            notification_msg = f"💕 {identity.username} added a new intimate moment"
             
             create_notification(
-                user.partner_id,
+                identity.partner_id,
                 'new_encounter',
                 notification_msg,
                 encounter.id
             )
             
             # Send external notification if enabled
-            if partner.sms_notifications and partner.phone_number:
-                send_notification_message(partner.phone_number, notification_msg)
+            if identity.partner_notifiable:
+                send_notification_message(identity.partner_phone_number, notification_msg)
             else:
-                logger.info(f"ℹ️ External notifications disabled for {partner.username}")
+                logger.info("External notifications disabled for user %d", identity.partner_id)
         
         return jsonify({'success': True, 'id': encounter.id})
 
 @app.route('/api/encounters/<int:encounter_id>', methods=['GET'])
+@api_login_required
 def get_encounter_details(encounter_id):
     """Get single encounter with all details, ratings, and comments"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
     encounter = Encounter.query.get(encounter_id)
     
     if not encounter:
         return jsonify({'error': 'Encounter not found'}), 404
     
-    user = User.query.get(session['user_id'])
+    identity = g.identity
     
     # Check access: owner or partner only
-    if encounter.user_id != session['user_id'] and user.partner_id != encounter.user_id:
+    if encounter.user_id != identity.id and identity.partner_id != encounter.user_id:
         return jsonify({'error': 'Access denied'}), 403
     
-    encounter_user = User.query.get(encounter.user_id)
+    encounter_username = identity.username_of(encounter.user_id)
     
     # Get both ratings
     creator_rating_obj = EncounterRating.query.filter_by(
@@ -728,145 +3053,156 @@ def get_encounter_details(encounter_id):
     ).first()
     
     partner_rating_obj = None
-    partner_username = None
-    if user.partner_id:
+    if identity.partner_id:
         partner_rating_obj = EncounterRating.query.filter_by(
             encounter_id=encounter_id,
-            user_id=user.partner_id
+            user_id=identity.partner_id
         ).first()
-        partner = User.query.get(user.partner_id)
-        partner_username = partner.username if partner else None
     
     # Get comments with usernames
     comments = Comment.query.filter_by(encounter_id=encounter_id).order_by(Comment.created_at.asc()).all()
     
-    # Position names mapping
-    positions_dict = {
-        'missionary': 'Missionary',
-        'doggy': 'Doggy Style',
-        'cowgirl': 'Cowgirl',
-        'reverse_cowgirl': 'Reverse Cowgirl',
-        'spoon': 'Spooning',
-        'standing': 'Standing',
-        'oral': 'Oral',
-        '69': '69',
-        'other': 'Other'
-    }
-    
     return jsonify({
         'id': encounter.id,
         'date': encounter.date.isoformat(),
         'time': encounter.time.isoformat() if encounter.time else None,
         'position': encounter.position,
-        'position_name': positions_dict.get(encounter.position, 'Other'),
+        'position_name': position_catalog(encounter.user_id).name_of(encounter.position),
         'duration': encounter.duration,
         'notes': encounter.notes,
-        'username': encounter_user.username,
-        'is_own': encounter.user_id == session['user_id'],
+        'username': encounter_username,
+        'is_own': encounter.user_id == identity.id,
         'creator_rating': {
             'value': creator_rating_obj.rating if creator_rating_obj else None,
-            'username': encounter_user.username,
+            'username': encounter_username,
             'user_id': encounter.user_id,
-            'can_edit': encounter.user_id == session['user_id']
+            'can_edit': encounter.user_id == identity.id
         },
         'partner_rating': {
             'value': partner_rating_obj.rating if partner_rating_obj else None,
-            'username': partner_username,
-            'user_id': user.partner_id,
-            'can_edit': user.partner_id == session['user_id']
-        } if user.partner_id else None,
+            'username': identity.partner_username,
+            'user_id': identity.partner_id,
+            'can_edit': identity.partner_id == identity.id
+        } if identity.partner_id else None,
         'comments': [{
             'id': c.id,
-            'user': User.query.get(c.commenter_id).username,
+            'user': identity.username_of(c.commenter_id),
             'user_id': c.commenter_id,
             'text': c.text,
             'rating': c.rating,
             'created_at': c.created_at.isoformat(),
-            'is_own': c.commenter_id == session['user_id']
+            'is_own': c.commenter_id == identity.id
         } for c in comments]
     })
 
+def valid_rating(value):
+    return isinstance(value, int) and not isinstance(value, bool) and 1 <= value <= 5
+
+def save_ratings(user_id, ratings, owner_ids):
+    """Upsert user_id's ratings ({encounter_id: rating}), then award points and check achievements once"""
+    now = datetime.utcnow()
+    dialect_insert = postgresql_insert if is_postgres() else sqlite_insert
+    statement = dialect_insert(EncounterRating).values([
+        {'encounter_id': encounter_id, 'user_id': user_id, 'rating': rating, 'created_at': now, 'updated_at': now}
+        for encounter_id, rating in ratings.items()
+    ])
+    # Rows that already existed keep their created_at, which tells new ratings apart
+    created = db.session.execute(statement.on_conflict_do_update(
+        index_elements=['encounter_id', 'user_id'],
+        set_={'rating': statement.excluded.rating, 'updated_at': now}
+    ).returning(EncounterRating.created_at)).scalars().all()
+    new_count = sum(1 for created_at in created if created_at == now)
+    invalidate_responses(*set(owner_ids))
+    db.session.commit()
+    
+    if new_count:
+        reason = "Rated encounter" if new_count == 1 else f"Rated {new_count} encounters"
+        award_points(user_id, RATING_POINTS * new_count, reason)
+    check_achievements(user_id)
+    # New ratings also count toward the partner's partner_ratings
+    identity = load_identity(user_id)
+    if new_count and identity and identity.partner_id:
+        check_achievements(identity.partner_id)
+    return new_count
+
 @app.route('/api/encounters/<int:encounter_id>/rating', methods=['POST'])
+@api_login_required
 def rate_encounter(encounter_id):
     """Add or update rating for an encounter"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
     encounter = Encounter.query.get(encounter_id)
     if not encounter:
         return jsonify({'error': 'Encounter not found'}), 404
     
-    user = User.query.get(session['user_id'])
-    
     # Check access: owner or partner only
-    if encounter.user_id != session['user_id'] and user.partner_id != encounter.user_id:
+    if encounter.user_id != g.identity.id and g.identity.partner_id != encounter.user_id:
         return jsonify({'error': 'Access denied'}), 403
     
     data = request.get_json()
     rating_value = data.get('rating')
     
-    if not rating_value or not (1 <= rating_value <= 5):
+    if not valid_rating(rating_value):
         return jsonify({'error': 'Rating must be between 1 and 5'}), 400
     
-    # Check if rating already exists
-    existing_rating = EncounterRating.query.filter_by(
-        encounter_id=encounter_id,
-        user_id=session['user_id']
-    ).first()
-    
-    if existing_rating:
-        existing_rating.rating = rating_value
-    else:
-        new_rating = EncounterRating(
-            encounter_id=encounter_id,
-            user_id=session['user_id'],
-            rating=rating_value
-        )
-        db.session.add(new_rating)
-        
-        # Award points for rating
-        award_points(session['user_id'], 2, "Rated encounter")
-    
-    db.session.commit()
-    
-    # Check achievements
-    check_achievements(session['user_id'])
+    save_ratings(g.identity.id, {encounter_id: rating_value}, [encounter.user_id])
     
     return jsonify({'success': True})
 
+@app.route('/api/encounters/ratings', methods=['POST'])
+@api_login_required
+def rate_encounters():
+    """Add or update ratings for many encounters: {"ratings": [{"encounter_id", "rating"}, ...]}"""
+    data = request.get_json(silent=True) or {}
+    pairs = data.get('ratings')
+    limit = app.config['RATING_BATCH_LIMIT']
+    if not isinstance(pairs, list) or not pairs:
+        return jsonify({'error': 'ratings must be a non-empty list'}), 400
+    if len(pairs) > limit:
+        return jsonify({'error': f'At most {limit} ratings per request'}), 400
+    
+    # A later pair for the same encounter wins
+    ratings = {}
+    for pair in pairs:
+        encounter_id = pair.get('encounter_id') if isinstance(pair, dict) else None
+        rating = pair.get('rating') if isinstance(pair, dict) else None
+        # bool is an int subclass; JSON true must not pass as encounter 1
+        if type(encounter_id) is not int or not valid_rating(rating):
+            return jsonify({'error': 'Each rating needs an encounter_id and a rating between 1 and 5'}), 400
+        ratings[encounter_id] = rating
+    
+    # Owner or partner only, checked for the whole batch in one query
+    owners = dict(db.session.query(Encounter.id, Encounter.user_id).filter(
+        Encounter.id.in_(list(ratings)),
+        Encounter.user_id.in_(couple_user_ids(g.identity))
+    ).all())
+    missing = sorted(set(ratings) - set(owners))
+    if missing:
+        return jsonify({'error': 'Encounters not found', 'encounter_ids': missing}), 404
+    
+    new_count = save_ratings(g.identity.id, ratings, owners.values())
+    
+    return jsonify({'success': True, 'rated': len(ratings), 'new': new_count})
+
 @app.route('/api/encounters/<int:encounter_id>', methods=['DELETE'])
+@api_login_required
 def delete_encounter(encounter_id):
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
     encounter = Encounter.query.get(encounter_id)
     
-    if not encounter or encounter.user_id != session['user_id']:
+    if not encounter or encounter.user_id != g.identity.id:
         return jsonify({'error': 'Encounter not found'}), 404
     
-    # Delete associated notifications first
-    Notification.query.filter_by(encounter_id=encounter_id).delete()
-    
-    db.session.delete(encounter)
-    db.session.commit()
-    
-    # Recalculate stats and achievements
-    stats = get_or_create_user_stats(session['user_id'])
-    stats.total_encounters = Encounter.query.filter_by(user_id=session['user_id']).count()
-    db.session.commit()
+    # Removes comments, ratings and notifications and reverses points, streak and achievements
+    purge_encounters([encounter_id])
     
     return jsonify({'success': True})
 
 @app.route('/api/encounters/<int:encounter_id>/comments', methods=['POST'])
+@api_login_required
 def add_comment(encounter_id):
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
     data = request.get_json()
     
     comment = Comment(
         encounter_id=encounter_id,
-        commenter_id=session['user_id'],
+        commenter_id=g.identity.id,
         text=data['text'],
         rating=data.get('rating')
     )
@@ -875,16 +3211,15 @@ def add_comment(encounter_id):
     db.session.commit()
     
     # Award points for commenting
-    award_points(session['user_id'], 1, "Added comment")
+    award_points(g.identity.id, COMMENT_POINTS, "Added comment")
     
     # Check achievements
-    check_achievements(session['user_id'])
+    check_achievements(g.identity.id)
     
     # Notify the encounter owner
     encounter = Encounter.query.get(encounter_id)
-    if encounter and encounter.user_id != session['user_id']:
-        user = User.query.get(session['user_id'])
-        notification_msg = f"💬 {user.username} commented on your encounter"
+    if encounter and encounter.user_id != g.identity.id:
+        notification_msg = f"💬 {g.identity.username} commented on your encounter"
         
         create_notification(
             encounter.user_id,
@@ -894,9 +3229,13 @@ def add_comment(encounter_id):
         )
         
         # Send external notification if enabled
-        owner = User.query.get(encounter.user_id)
-        if owner.sms_notifications and owner.phone_number:
-            send_notification_message(owner.phone_number, notification_msg)
+        if encounter.user_id == g.identity.partner_id:
+            if g.identity.partner_notifiable:
+                send_notification_message(g.identity.partner_phone_number, notification_msg)
+        else:
+            owner = User.query.get(encounter.user_id)
+            if owner.sms_notifications and owner.phone_number:
+                send_notification_message(owner.phone_number, notification_msg)
     
     return jsonify({'success': True})
 
@@ -904,91 +3243,208 @@ def add_comment(encounter_id):
 # API ROUTES - Stats
 # ============================================================================
 
+def couple_stats(identity, user_ids):
+    """Cached totals for the calendar header"""
+    def compute_stats():
+        total = Encounter.query.filter(Encounter.user_id.in_(user_ids)).count()
+        
+        now = datetime.now()
+        this_month = Encounter.query.filter(
+            Encounter.user_id.in_(user_ids),
+            Encounter.date >= datetime(now.year, now.month, 1).date()
+        ).count()
+        
+        # Calculate average rating from encounter_rating table
+        ratings = db.session.query(EncounterRating.rating).join(
+            Encounter, EncounterRating.encounter_id == Encounter.id
+        ).filter(Encounter.user_id.in_(user_ids)).all()
+        
+        avg_rating = sum(r[0] for r in ratings) / len(ratings) if ratings else 0
+        
+        # Passed proposals the scheduler has not expired yet don't count
+        pending = ProposedEncounter.query.filter(
+            ProposedEncounter.recipient_id == identity.id,
+            ProposedEncounter.status == 'pending',
+            ProposedEncounter.proposed_date > datetime.now()
+        ).count()
+        
+        return {
+            'total': total,
+            'this_month': this_month,
+            'average_rating': avg_rating,
+            'pending_proposals': pending
+        }
+    
+    return cached_response('stats', compute_stats, user_ids, viewer_id=identity.id)
+
 @app.route('/api/stats')
+@api_login_required
 def stats():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
-    user = User.query.get(session['user_id'])
-    user_ids = [user.id]
-    if user.partner_id:
-        user_ids.append(user.partner_id)
-    
-    total = Encounter.query.filter(Encounter.user_id.in_(user_ids)).count()
-    
-    now = datetime.now()
-    this_month = Encounter.query.filter(
-        Encounter.user_id.in_(user_ids),
-        Encounter.date >= datetime(now.year, now.month, 1).date()
-    ).count()
-    
-    # Calculate average rating from encounter_rating table
-    ratings = db.session.query(EncounterRating.rating).join(
+    return jsonify(couple_stats(g.identity, couple_user_ids(g.identity)))
+
+# ============================================================================
+# API ROUTES - Analytics
+# ============================================================================
+
+def compute_analytics(user_ids):
+    """Aggregate a couple's history with GROUP BY queries; no raw rows are loaded"""
+    in_couple = Encounter.user_id.in_(user_ids)
+    
+    # Position distribution, named from each owner's catalog like the calendar;
+    # the stored position is free text and never shown as is
+    positions = {}
+    for owner_id, position, count in db.session.query(
+        Encounter.user_id, Encounter.position, func.count(Encounter.id)
+    ).filter(in_couple).group_by(Encounter.user_id, Encounter.position):
+        name = position_catalog(owner_id).name_of(position)
+        # Free text outside the catalog all counts as 'Other'
+        row = positions.setdefault(name, {'position': position, 'position_name': name, 'count': 0})
+        row['count'] += count
+    position_rows = sorted(positions.values(), key=lambda row: -row['count'])
+    
+    # Rating histogram per rater (EncounterRating) on the couple's encounters
+    rating_rows = db.session.query(
+        EncounterRating.user_id, EncounterRating.rating, func.count(EncounterRating.id)
+    ).join(
         Encounter, EncounterRating.encounter_id == Encounter.id
-    ).filter(Encounter.user_id.in_(user_ids)).all()
-    
-    avg_rating = sum(r[0] for r in ratings) / len(ratings) if ratings else 0
-    
-    pending = ProposedEncounter.query.filter_by(
-        recipient_id=session['user_id'],
-        status='pending'
-    ).count()
-    
-    return jsonify({
-        'total': total,
-        'this_month': this_month,
-        'average_rating': avg_rating,
-        'pending_proposals': pending
-    })
+    ).filter(in_couple).group_by(EncounterRating.user_id, EncounterRating.rating).all()
+    
+    usernames = dict(db.session.query(User.id, User.username).filter(User.id.in_(user_ids)).all())
+    histogram = {str(value): 0 for value in range(1, 6)}
+    by_user = {}
+    rating_total = 0
+    rating_count = 0
+    for rater_id, value, count in rating_rows:
+        key = str(value)
+        histogram[key] = histogram.get(key, 0) + count
+        user_histogram = by_user.setdefault(
+            usernames.get(rater_id, 'Unknown'), {str(v): 0 for v in range(1, 6)}
+        )
+        user_histogram[key] = user_histogram.get(key, 0) + count
+        rating_total += value * count
+        rating_count += count
+    
+    # Weekday counts (0 = Sunday) and weekday x hour heatmap
+    weekday = extract('dow', Encounter.date)
+    weekday_rows = db.session.query(
+        weekday, func.count(Encounter.id)
+    ).filter(in_couple).group_by(weekday).all()
+    weekdays = [0] * 7
+    for day, count in weekday_rows:
+        weekdays[int(day)] = count
+    
+    hour = extract('hour', Encounter.time)
+    heatmap_rows = db.session.query(
+        weekday, hour, func.count(Encounter.id)
+    ).filter(in_couple, Encounter.time.isnot(None)).group_by(weekday, hour).all()
+    heatmap = [[0] * 24 for _ in range(7)]
+    for day, hour_of_day, count in heatmap_rows:
+        heatmap[int(day)][int(hour_of_day)] = count
+    
+    # Duration summary; percentiles need PostgreSQL's ordered-set aggregates
+    duration_columns = [
+        func.count(Encounter.duration),
+        func.min(Encounter.duration),
+        func.max(Encounter.duration),
+        func.avg(Encounter.duration)
+    ]
+    percentiles = (0.25, 0.5, 0.75, 0.9)
+    if is_postgres():
+        duration_columns.extend(
+            func.percentile_cont(p).within_group(Encounter.duration) for p in percentiles
+        )
+    duration_row = db.session.query(*duration_columns).filter(
+        in_couple, Encounter.duration.isnot(None)
+    ).one()
+    percentile_values = duration_row[4:] or [None] * len(percentiles)
+    
+    return {
+        'total': sum(row['count'] for row in position_rows),
+        'positions': position_rows,
+        'ratings': {
+            'histogram': histogram,
+            'by_user': by_user,
+            'count': rating_count,
+            'average': rating_total / rating_count if rating_count else 0
+        },
+        'weekdays': weekdays,
+        'heatmap': heatmap,
+        'duration': {
+            'count': duration_row[0],
+            'min': duration_row[1],
+            'max': duration_row[2],
+            'average': float(duration_row[3]) if duration_row[3] is not None else None,
+            'percentiles': {
+                f'p{int(p * 100)}': float(value) if value is not None else None
+                for p, value in zip(percentiles, percentile_values)
+            }
+        }
+    }
+
+@app.route('/api/analytics')
+@api_login_required
+def analytics():
+    """Position, rating, time-of-day and duration distributions for the couple"""
+    user_ids = couple_user_ids(g.identity)
+    return jsonify(cached_response('analytics', lambda: compute_analytics(user_ids), user_ids))
 
 # ============================================================================
 # API ROUTES - Gamification
 # ============================================================================
 
 @app.route('/api/achievements')
+@api_login_required
 def get_achievements():
-    """Get all achievements with unlock status"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
-    all_achievements = Achievement.query.all()
-    user_achievements = UserAchievement.query.filter_by(user_id=session['user_id']).all()
-    unlocked_ids = {ua.achievement_id for ua in user_achievements}
-    
-    achievements_data = []
-    for achievement in all_achievements:
-        achievements_data.append({
-            'id': achievement.id,
-            'code': achievement.code,
-            'name': achievement.name,
-            'description': achievement.description,
-            'icon': achievement.icon,
-            'category': achievement.category,
-            'tier': achievement.tier,
-            'unlocked': achievement.id in unlocked_ids,
-            'unlocked_at': next(
-                (ua.unlocked_at.isoformat() for ua in user_achievements if ua.achievement_id == achievement.id),
-                None
-            )
-        })
-    
-    return jsonify(achievements_data)
+    """Get all achievements with unlock status and progress toward locked ones"""
+    user_id = g.identity.id
+    
+    def list_achievements():
+        all_achievements = Achievement.query.all()
+        user_achievements = {
+            ua.achievement_id: ua
+            for ua in UserAchievement.query.filter_by(user_id=user_id).all()
+        }
+        
+        achievements_data = []
+        for achievement in all_achievements:
+            user_achievement = user_achievements.get(achievement.id)
+            unlocked_at = user_achievement.unlocked_at if user_achievement else None
+            metric, target = ACHIEVEMENT_TARGETS.get(achievement.code, (None, None))
+            if unlocked_at or target is None:
+                progress = target
+            else:
+                progress = user_achievement.progress if user_achievement else 0
+            achievements_data.append({
+                'id': achievement.id,
+                'code': achievement.code,
+                'name': achievement.name,
+                'description': achievement.description,
+                'icon': achievement.icon,
+                'category': achievement.category,
+                'tier': achievement.tier,
+                'unlocked': unlocked_at is not None,
+                'unlocked_at': unlocked_at,
+                'progress': progress,
+                'target': target,
+                'unit': METRIC_UNITS.get(metric)
+            })
+        return achievements_data
+    
+    return jsonify(cached_response('achievements', list_achievements, [user_id]))
 
 @app.route('/api/challenges')
+@api_login_required
 def get_challenges():
     """Get all active challenges with user progress"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
     active_challenges = Challenge.query.filter_by(active=True).all()
-    user_challenges = UserChallenge.query.filter_by(user_id=session['user_id']).all()
+    user_challenges = {
+        uc.challenge_id: uc
+        for uc in UserChallenge.query.filter_by(user_id=g.identity.id).all()
+    }
     
     challenges_data = []
     for challenge in active_challenges:
-        user_challenge = next(
-            (uc for uc in user_challenges if uc.challenge_id == challenge.id),
-            None
-        )
+        user_challenge = user_challenges.get(challenge.id)
         
         challenges_data.append({
             'id': challenge.id,
@@ -1009,27 +3465,18 @@ def get_challenges():
 # Add these routes to your app.py file (after the existing /api/challenges route)
 
 @app.route('/admin/challenges')
+@login_required
 def admin_challenges():
     """Admin page for managing challenges"""
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
-    user = User.query.get(session['user_id'])
-    if not user.is_admin:
+    if not g.identity.is_admin:
         return redirect(url_for('index'))
     
     return render_template('admin_challenges.html')
 
 @app.route('/api/admin/challenges', methods=['POST'])
+@api_admin_required
 def create_challenge():
     """Create a new challenge (admin only)"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
-    user = User.query.get(session['user_id'])
-    if not user.is_admin:
-        return jsonify({'error': 'Admin access required'}), 403
-    
     data = request.get_json()
     
     challenge = Challenge(
@@ -1049,15 +3496,9 @@ def create_challenge():
     return jsonify({'success': True, 'id': challenge.id})
 
 @app.route('/api/admin/challenges/<int:challenge_id>', methods=['PUT'])
+@api_admin_required
 def update_challenge(challenge_id):
     """Update a challenge (admin only)"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
-    user = User.query.get(session['user_id'])
-    if not user.is_admin:
-        return jsonify({'error': 'Admin access required'}), 403
-    
     challenge = Challenge.query.get(challenge_id)
     if not challenge:
         return jsonify({'error': 'Challenge not found'}), 404
@@ -1080,15 +3521,9 @@ def update_challenge(challenge_id):
     return jsonify({'success': True})
 
 @app.route('/api/admin/challenges/<int:challenge_id>', methods=['DELETE'])
+@api_admin_required
 def delete_challenge(challenge_id):
     """Delete a challenge (admin only)"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
-    user = User.query.get(session['user_id'])
-    if not user.is_admin:
-        return jsonify({'error': 'Admin access required'}), 403
-    
     challenge = Challenge.query.get(challenge_id)
     if not challenge:
         return jsonify({'error': 'Challenge not found'}), 404
@@ -1099,15 +3534,9 @@ def delete_challenge(challenge_id):
     return jsonify({'success': True})
 
 @app.route('/api/admin/challenges/all', methods=['GET'])
+@api_admin_required
 def get_all_challenges_admin():
     """Get all challenges including inactive (admin only)"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
-    user = User.query.get(session['user_id'])
-    if not user.is_admin:
-        return jsonify({'error': 'Admin access required'}), 403
-    
     challenges = Challenge.query.all()
     
     return jsonify([{
@@ -1123,34 +3552,308 @@ def get_all_challenges_admin():
         'created_at': c.created_at.isoformat()
     } for c in challenges])
 
+def user_stats_summary(user_id):
+    """Cached gamification totals for one user"""
+    def compute_user_stats():
+        stats = get_or_create_user_stats(user_id)
+        
+        # Count unlocked achievements
+        achievements_count = UserAchievement.query.filter(
+            UserAchievement.user_id == user_id, UserAchievement.unlocked_at.isnot(None)
+        ).count()
+        total_achievements = Achievement.query.count()
+        
+        # Count completed challenges
+        completed_challenges = UserChallenge.query.filter_by(
+            user_id=user_id,
+            completed=True
+        ).count()
+        
+        return {
+            'total_points': stats.total_points,
+            'level': stats.level,
+            'current_streak': stats.current_streak,
+            'longest_streak': stats.longest_streak,
+            'total_encounters': stats.total_encounters,
+            'achievements_unlocked': achievements_count,
+            'total_achievements': total_achievements,
+            'challenges_completed': completed_challenges,
+            'last_encounter_date': stats.last_encounter_date
+        }
+    
+    return cached_response('user-stats', compute_user_stats, [user_id])
+
 @app.route('/api/user-stats')
+@api_login_required
 def get_user_stats():
     """Get user's gamification stats"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
+    return jsonify(user_stats_summary(g.identity.id))
+
+# ============================================================================
+# API ROUTES - Calendar
+# ============================================================================
+
+@app.route('/api/calendar/bootstrap')
+@api_login_required
+def calendar_bootstrap():
+    """Everything the calendar page draws on load, in one round trip"""
+    identity = g.identity
+    user_ids = couple_user_ids(identity)
+    today = date.today()
+    args = {
+        'month': request.args.get('month', str(today.month)),
+        'year': request.args.get('year', str(today.year)),
+        'fields': 'date,position,position_name'
+    }
+    try:
+        encounters = encounter_listing(identity, user_ids, MultiDict(args))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # The catalog is left out when the page already holds this version
+    catalog = position_catalog(identity.id)
+    positions = None
+    if request.args.get('positions_version') != catalog.version:
+        positions = catalog.to_json()
+    
+    return jsonify({
+        'positions': positions,
+        'encounters': encounters,
+        'stats': couple_stats(identity, user_ids),
+        'user_stats': user_stats_summary(identity.id)
+    })
+
+def ics_escape(value):
+    return (value or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+def ics_fold(line):
+    """Fold a content line at 75 octets (RFC 5545) without splitting a character"""
+    folded, current, size = [], '', 0
+    for char in line:
+        width = len(char.encode())
+        if size + width > 75:
+            folded.append(current)
+            current, size = ' ', 1
+        current += char
+        size += width
+    folded.append(current)
+    return '\r\n'.join(folded)
+
+def ics_stamp(moment):
+    return (moment or datetime.utcnow()).strftime('%Y%m%dT%H%M%SZ')
+
+# Rendered VEVENTs keyed by the row id, its updated_at and whatever else goes
+# into the text, so a feed rebuilt after one write renders only what changed
+_calendar_event_cache = LocalCacheBackend(app.config['CALENDAR_EVENT_CACHE_SIZE'], 86400)
+
+def cached_vevent(key, render):
+    """The folded VEVENT text for key, calling render() for its lines on a miss"""
+    fragment = _calendar_event_cache.get(key)
+    if fragment is None:
+        fragment = '\r\n'.join(ics_fold(line) for line in render())
+        _calendar_event_cache.set(key, fragment)
+    return fragment
+
+def proposal_vevent(proposal_id, proposed_date, notes, created_at):
+    return [
+        'BEGIN:VEVENT',
+        f'UID:proposal-{proposal_id}@intimate-moments',
+        f'DTSTAMP:{ics_stamp(created_at)}',
+        f"DTSTART:{proposed_date.strftime('%Y%m%dT%H%M%S')}",
+        'DURATION:PT1H',
+        'SUMMARY:📅 Planned date',
+        f'DESCRIPTION:{ics_escape(notes)}',
+        'STATUS:CONFIRMED',
+        'END:VEVENT',
+    ]
+
+def encounter_vevent(encounter_id, day, at, duration, created_at, description):
+    lines = ['BEGIN:VEVENT', f'UID:encounter-{encounter_id}@intimate-moments', f'DTSTAMP:{ics_stamp(created_at)}']
+    if at:
+        # Floating local time: shown at the same clock time wherever the phone is
+        lines += [f"DTSTART:{datetime.combine(day, at).strftime('%Y%m%dT%H%M%S')}", f'DURATION:PT{duration or 30}M']
+    else:
+        lines += [f"DTSTART;VALUE=DATE:{day.strftime('%Y%m%d')}", f"DTEND;VALUE=DATE:{(day + timedelta(days=1)).strftime('%Y%m%d')}"]
+    return lines + ['SUMMARY:❤️ Together', f'DESCRIPTION:{ics_escape(description)}', 'TRANSP:TRANSPARENT', 'END:VEVENT']
+
+def calendar_feed_body(user_id, user_ids):
+    """iCalendar text for the user's accepted proposals and the couple's recent encounters"""
+    since = date.today() - timedelta(days=app.config['CALENDAR_FEED_DAYS'])
+    parts = ['\r\n'.join(ics_fold(line) for line in [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//Intimate Moments//Calendar Feed//EN',
+        'CALSCALE:GREGORIAN',
+        'X-WR-CALNAME:Intimate Moments',
+        'X-PUBLISHED-TTL:PT1H',
+    ])]
+    
+    proposals = db.session.query(
+        ProposedEncounter.id, ProposedEncounter.proposer_id, ProposedEncounter.proposed_date,
+        ProposedEncounter.notes, ProposedEncounter.created_at, ProposedEncounter.updated_at
+    ).filter(
+        or_(ProposedEncounter.proposer_id == user_id, ProposedEncounter.recipient_id == user_id),
+        ProposedEncounter.status == 'accepted',
+        ProposedEncounter.proposed_date >= datetime.combine(since, dt_time())
+    ).order_by(ProposedEncounter.proposed_date).all()
+    for proposal_id, _, proposed_date, notes, created_at, updated_at in proposals:
+        parts.append(cached_vevent(
+            f'proposal:{proposal_id}:{updated_at}',
+            lambda: proposal_vevent(proposal_id, proposed_date, notes, created_at)
+        ))
+    # Accepting a proposal also logs an encounter at that moment; show it once
+    planned = {(proposer_id, proposed_date) for _, proposer_id, proposed_date, _, _, _ in proposals}
+    
+    usernames = dict(db.session.query(User.id, User.username).filter(User.id.in_(user_ids)))
+    catalogs = {owner_id: position_catalog(owner_id) for owner_id in user_ids}
+    encounters = db.session.query(
+        Encounter.id, Encounter.user_id, Encounter.date, Encounter.time,
+        Encounter.position, Encounter.duration, Encounter.created_at, Encounter.updated_at
+    ).filter(Encounter.user_id.in_(user_ids), Encounter.date >= since).order_by(Encounter.date, Encounter.id)
+    for encounter_id, owner_id, day, at, position, duration, created_at, updated_at in encounters:
+        if at and (owner_id, datetime.combine(day, at)) in planned:
+            continue
+        # The description also depends on the owner's position names and username
+        catalog, username = catalogs[owner_id], usernames.get(owner_id, '?')
+        parts.append(cached_vevent(
+            f'encounter:{encounter_id}:{updated_at}:{catalog.version}:{username}',
+            lambda: encounter_vevent(
+                encounter_id, day, at, duration, created_at, f'{catalog.name_of(position)}, logged by {username}'
+            )
+        ))
     
-    stats = get_or_create_user_stats(session['user_id'])
+    parts.append('END:VCALENDAR')
+    return '\r\n'.join(parts) + '\r\n'
+
+@app.route('/calendar/<token>.ics')
+def calendar_feed(token):
+    """Subscribable feed; the secret token in the URL stands in for a login"""
+    row = db.session.query(User.id, User.partner_id).filter(
+        User.calendar_token == token
+    ).first() if len(token) >= 32 else None
+    if row is None:
+        return jsonify({'error': 'Feed not found'}), 404
+    user_id, partner_id = row
+    user_ids = [user_id, partner_id] if partner_id else [user_id]
+    
+    def render_feed():
+        body = calendar_feed_body(user_id, user_ids)
+        return {
+            'body': body,
+            'etag': hashlib.sha1(body.encode()).hexdigest(),
+            'generated_at': int(time.time())
+        }
     
-    # Count unlocked achievements
-    achievements_count = UserAchievement.query.filter_by(user_id=session['user_id']).count()
-    total_achievements = Achievement.query.count()
+    # Cached until a write to the couple's encounters or proposals, so a poll
+    # costs the token lookup, and a 304 when nothing changed
+    feed = cached_response('calendar-feed', render_feed, user_ids, viewer_id=user_id)
+    response = app.response_class(feed['body'], mimetype='text/calendar')
+    response.set_etag(feed['etag'])
+    response.last_modified = datetime.fromtimestamp(feed['generated_at'], tz=timezone.utc)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+@app.route('/api/calendar/feed', methods=['POST', 'DELETE'])
+@api_login_required
+def calendar_feed_token():
+    """POST issues a new feed link, replacing any old one; DELETE turns the feed off"""
+    user = User.query.get(g.identity.id)
+    if request.method == 'DELETE':
+        user.calendar_token = None
+        db.session.commit()
+        return jsonify({'success': True})
     
-    # Count completed challenges
-    completed_challenges = UserChallenge.query.filter_by(
-        user_id=session['user_id'],
-        completed=True
-    ).count()
+    user.calendar_token = secrets.token_urlsafe(32)
+    db.session.commit()
+    return jsonify({'success': True, 'url': url_for('calendar_feed', token=user.calendar_token, _external=True)})
+
+# ============================================================================
+# API ROUTES - Sync
+# ============================================================================
+
+SYNC_EPOCH = datetime(1970, 1, 1)
+
+def sync_token(moment):
+    return str((moment - SYNC_EPOCH) // timedelta(microseconds=1))
+
+def parse_sync_token(token):
+    """The UTC moment a token stands for; raises ValueError"""
+    if not token.isdigit():
+        raise ValueError('Invalid sync token')
+    return SYNC_EPOCH + timedelta(microseconds=int(token))
+
+def sync_sources(identity, user_ids):
+    """entity -> (model, query of the rows the user may see)"""
+    return {
+        'encounters': (Encounter, Encounter.query.filter(Encounter.user_id.in_(user_ids))),
+        'comments': (Comment, Comment.query.join(Encounter, Encounter.id == Comment.encounter_id).filter(
+            Encounter.user_id.in_(user_ids)
+        )),
+        'ratings': (EncounterRating, EncounterRating.query.join(
+            Encounter, Encounter.id == EncounterRating.encounter_id
+        ).filter(Encounter.user_id.in_(user_ids))),
+        'messages': (Message, Message.query.filter(
+            or_(Message.sender_id == identity.id, Message.recipient_id == identity.id)
+        )),
+        'notifications': (Notification, Notification.query.filter(Notification.user_id == identity.id)),
+        'proposals': (ProposedEncounter, ProposedEncounter.query.filter(
+            or_(ProposedEncounter.proposer_id == identity.id, ProposedEncounter.recipient_id == identity.id)
+        )),
+    }
+
+def sync_row(model, row):
+    return {column.key: getattr(row, column.key) for column in model.__table__.columns}
+
+@app.route('/api/sync')
+@api_login_required
+def sync():
+    """Rows changed and ids deleted since the token; no token returns everything"""
+    identity = g.identity
+    user_ids = couple_user_ids(identity)
+    now = datetime.utcnow()
+    
+    since = None
+    token = request.args.get('since', '')
+    if token:
+        try:
+            since = parse_sync_token(token)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        # Older tombstones may have been pruned, so start the client over
+        if since < now - timedelta(days=app.config['TOMBSTONE_RETENTION_DAYS']):
+            since = None
+    
+    # Rows stamped just before a token can commit just after it, so each
+    # request reaches back SYNC_OVERLAP_SECONDS; clients upsert by id
+    changed_after = since - timedelta(seconds=app.config['SYNC_OVERLAP_SECONDS']) if since else None
+    
+    changes = {}
+    for entity, (model, query) in sync_sources(identity, user_ids).items():
+        if changed_after:
+            query = query.filter(model.updated_at > changed_after)
+        changes[entity] = [sync_row(model, row) for row in query.order_by(model.updated_at, model.id)]
+    
+    deleted = {entity: [] for entity in changes}
+    if changed_after:
+        tombstones = db.session.query(Tombstone.entity, Tombstone.entity_id).filter(
+            Tombstone.deleted_at > changed_after,
+            or_(
+                and_(Tombstone.entity.in_(COUPLE_SYNC_ENTITIES), Tombstone.user_id.in_(user_ids)),
+                and_(
+                    Tombstone.entity.notin_(COUPLE_SYNC_ENTITIES),
+                    or_(Tombstone.user_id == identity.id, Tombstone.other_user_id == identity.id)
+                )
+            )
+        ).order_by(Tombstone.deleted_at)
+        for entity, entity_id in tombstones:
+            deleted[entity].append(entity_id)
     
     return jsonify({
-        'total_points': stats.total_points,
-        'level': stats.level,
-        'current_streak': stats.current_streak,
-        'longest_streak': stats.longest_streak,
-        'total_encounters': stats.total_encounters,
-        'achievements_unlocked': achievements_count,
-        'total_achievements': total_achievements,
-        'challenges_completed': completed_challenges,
-        'last_encounter_date': stats.last_encounter_date.isoformat() if stats.last_encounter_date else None
+        'token': sync_token(now),
+        'full': since is None,
+        'changes': changes,
+        'deleted': deleted
     })
 
 # ============================================================================
@@ -1158,16 +3861,14 @@ def get_user_stats():
 # ============================================================================
 
 @app.route('/api/notifications', methods=['GET'])
+@api_login_required
 def get_notifications():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
     notifications = Notification.query.filter_by(
-        user_id=session['user_id']
+        user_id=g.identity.id
     ).order_by(Notification.created_at.desc()).limit(50).all()
     
     unread_count = Notification.query.filter_by(
-        user_id=session['user_id'],
+        user_id=g.identity.id,
         read=False
     ).count()
     
@@ -1186,24 +3887,22 @@ def get_notifications():
 
 @app.route('/api/notifications/unread_count', methods=['GET'])
 def get_unread_count():
-    if 'user_id' not in session:
+    if g.identity is None:
         return jsonify({'count': 0})
     
     unread_count = Notification.query.filter_by(
-        user_id=session['user_id'],
+        user_id=g.identity.id,
         read=False
     ).count()
     
     return jsonify({'count': unread_count})
 
 @app.route('/api/notifications/<int:notification_id>/mark-read', methods=['POST'])
+@api_login_required
 def mark_notification_read(notification_id):
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
     notification = Notification.query.get(notification_id)
     
-    if notification and notification.user_id == session['user_id']:
+    if notification and notification.user_id == g.identity.id:
         notification.read = True
         db.session.commit()
         return jsonify({'success': True})
@@ -1211,12 +3910,10 @@ def mark_notification_read(notification_id):
     return jsonify({'error': 'Notification not found'}), 404
 
 @app.route('/api/notifications/mark-all-read', methods=['POST'])
+@api_login_required
 def mark_all_read():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
     Notification.query.filter_by(
-        user_id=session['user_id'],
+        user_id=g.identity.id,
         read=False
     ).update({'read': True})
     
@@ -1229,13 +3926,11 @@ def mark_all_read():
 # ============================================================================
 
 @app.route('/api/proposals', methods=['GET', 'POST'])
+@api_login_required
 def proposals():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
     if request.method == 'GET':
-        sent = ProposedEncounter.query.filter_by(proposer_id=session['user_id']).all()
-        received = ProposedEncounter.query.filter_by(recipient_id=session['user_id']).all()
+        sent = ProposedEncounter.query.filter_by(proposer_id=g.identity.id).all()
+        received = ProposedEncounter.query.filter_by(recipient_id=g.identity.id).all()
         
         return jsonify({
             'sent': [{
@@ -1252,53 +3947,55 @@ def proposals():
                 'position': p.position,
                 'notes': p.notes,
                 'status': p.status,
-                'proposer': User.query.get(p.proposer_id).username,
+                'proposer': g.identity.username_of(p.proposer_id),
                 'created_at': p.created_at.isoformat()
             } for p in received]
         })
     
     else:  # POST
         data = request.get_json()
-        user = User.query.get(session['user_id'])
+        identity = g.identity
         
-        if not user.partner_id:
+        if not identity.partner_id:
             return jsonify({'error': 'No partner connected'}), 400
         
         proposal = ProposedEncounter(
-            proposer_id=session['user_id'],
-            recipient_id=user.partner_id,
+            proposer_id=identity.id,
+            recipient_id=identity.partner_id,
             proposed_date=datetime.fromisoformat(data['proposed_date']),
             position=data.get('position'),
             notes=data.get('notes', '')
         )
         
         db.session.add(proposal)
+        invalidate_responses(identity.partner_id, endpoints=('stats',))
         db.session.commit()
+        schedule_proposal(proposal)
         
         # Notify partner
-        notification_msg = f"💌 {user.username} proposed an intimate encounter"
+        notification_msg = f"💌 {identity.username} proposed an intimate encounter"
         create_notification(
-            user.partner_id,
+            identity.partner_id,
             'new_proposal',
             notification_msg
         )
         
-        partner = User.query.get(user.partner_id)
-        if partner.sms_notifications and partner.phone_number:
-            send_notification_message(partner.phone_number, notification_msg)
+        if identity.partner_notifiable:
+            send_notification_message(identity.partner_phone_number, notification_msg)
         
         return jsonify({'success': True})
 
 @app.route('/api/proposals/<int:proposal_id>/<action>', methods=['POST'])
+@api_login_required
 def respond_to_proposal(proposal_id, action):
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
     proposal = ProposedEncounter.query.get(proposal_id)
     
-    if not proposal or proposal.recipient_id != session['user_id']:
+    if not proposal or proposal.recipient_id != g.identity.id:
         return jsonify({'error': 'Proposal not found'}), 404
     
+    if proposal.status != 'pending':
+        return jsonify({'error': f'Proposal is already {proposal.status}'}), 409
+    
     if action == 'accept':
         proposal.status = 'accepted'
         
@@ -1313,8 +4010,7 @@ def respond_to_proposal(proposal_id, action):
         db.session.add(encounter)
         
         # Notify proposer
-        user = User.query.get(session['user_id'])
-        notification_msg = f"✅ {user.username} accepted your proposal"
+        notification_msg = f"✅ {g.identity.username} accepted your proposal"
         create_notification(
             proposal.proposer_id,
             'proposal_accepted',
@@ -1325,16 +4021,28 @@ def respond_to_proposal(proposal_id, action):
         proposal.status = 'declined'
         
         # Notify proposer
-        user = User.query.get(session['user_id'])
-        notification_msg = f"❌ {user.username} declined your proposal"
+        notification_msg = f"❌ {g.identity.username} declined your proposal"
         create_notification(
             proposal.proposer_id,
             'proposal_declined',
             notification_msg
         )
     
+    # Accepting adds an encounter; either answer changes the pending count
+    if action == 'accept':
+        invalidate_responses(proposal.proposer_id)
+    else:
+        invalidate_responses(g.identity.id, endpoints=('stats',))
     db.session.commit()
     
+    if action == 'accept':
+        schedule_proposal(proposal)
+        # The encounter counts like one the proposer logged, so the stats
+        # reconciliation finds nothing to correct
+        update_streak(encounter.user_id, encounter.date)
+        award_points(encounter.user_id, ENCOUNTER_POINTS, "Accepted proposal")
+        check_achievements(encounter.user_id)
+    
     return jsonify({'success': True})
 
 # ============================================================================
@@ -1343,10 +4051,10 @@ def respond_to_proposal(proposal_id, action):
 
 @app.route('/api/custom-icons', methods=['GET'])
 def get_custom_icons():
-    if 'user_id' not in session:
+    if g.identity is None:
         return jsonify([])
     
-    icons = CustomIcon.query.filter_by(user_id=session['user_id']).all()
+    icons = CustomIcon.query.filter_by(user_id=g.identity.id).all()
     
     return jsonify([{
         'id': icon.id,
@@ -1355,20 +4063,25 @@ def get_custom_icons():
         'created_at': icon.created_at.isoformat() if icon.created_at else None
     } for icon in icons])
 
+@app.route('/api/positions')
+@api_login_required
+def get_positions():
+    """The viewer's position catalog; clients keep it until its version changes"""
+    catalog = position_catalog(g.identity.id)
+    response = jsonify(catalog.to_json())
+    response.set_etag(catalog.version)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
 @app.route('/api/custom-icons', methods=['POST'])
+@api_admin_required
 def add_custom_icon():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
-    user = User.query.get(session['user_id'])
-    if not user.is_admin:
-        return jsonify({'error': 'Admin access required'}), 403
-    
     data = request.get_json()
     
     # Check if icon already exists
     existing = CustomIcon.query.filter_by(
-        user_id=session['user_id'],
+        user_id=g.identity.id,
         position_name=data['position_name']
     ).first()
     
@@ -1378,27 +4091,27 @@ def add_custom_icon():
     else:
         # Create new
         icon = CustomIcon(
-            user_id=session['user_id'],
+            user_id=g.identity.id,
             position_name=data['position_name'],
             svg_content=data['svg_content']
         )
         db.session.add(icon)
     
+    invalidate_positions(g.identity.id)
     db.session.commit()
     
     return jsonify({'success': True})
 
 @app.route('/api/custom-icons/<int:icon_id>', methods=['DELETE'])
+@api_login_required
 def delete_custom_icon(icon_id):
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
     icon = CustomIcon.query.get(icon_id)
     
-    if not icon or icon.user_id != session['user_id']:
+    if not icon or icon.user_id != g.identity.id:
         return jsonify({'error': 'Icon not found'}), 404
     
     db.session.delete(icon)
+    invalidate_positions(g.identity.id)
     db.session.commit()
     
     return jsonify({'success': True})
@@ -1408,20 +4121,18 @@ def delete_custom_icon(icon_id):
 # ============================================================================
 
 @app.route('/api/messages', methods=['GET'])
+@api_login_required
 def get_messages():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
     # Get all messages where user is sender or recipient
-    sent_messages = Message.query.filter_by(sender_id=session['user_id']).all()
-    received_messages = Message.query.filter_by(recipient_id=session['user_id']).all()
+    sent_messages = Message.query.filter_by(sender_id=g.identity.id).all()
+    received_messages = Message.query.filter_by(recipient_id=g.identity.id).all()
     
     def format_message(msg, is_sent=False):
         if is_sent:
-            other_user = User.query.get(msg.recipient_id)
+            other_username = g.identity.username_of(msg.recipient_id)
             other_label = 'To'
         else:
-            other_user = User.query.get(msg.sender_id)
+            other_username = g.identity.username_of(msg.sender_id)
             other_label = 'From'
         
         return {
@@ -1429,9 +4140,9 @@ def get_messages():
             'subject': msg.subject or '(No subject)',
             'message': msg.message_text,
             'read': msg.read,
-            'created_at': msg.created_at.isoformat(),
+            'created_at': msg.created_at,
             'is_sent': is_sent,
-            'other_user': other_user.username if other_user else 'Unknown',
+            'other_user': other_username or 'Unknown',
             'other_label': other_label
         }
     
@@ -1444,7 +4155,7 @@ def get_messages():
     
     # Count unread
     unread_count = Message.query.filter_by(
-        recipient_id=session['user_id'],
+        recipient_id=g.identity.id,
         read=False
     ).count()
     
@@ -1454,19 +4165,17 @@ def get_messages():
     })
 
 @app.route('/api/messages', methods=['POST'])
+@api_login_required
 def send_message():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
-    user = User.query.get(session['user_id'])
-    if not user.partner_id:
+    identity = g.identity
+    if not identity.partner_id:
         return jsonify({'error': 'No partner connected'}), 400
     
     data = request.get_json()
     
     new_message = Message(
-        sender_id=session['user_id'],
-        recipient_id=user.partner_id,
+        sender_id=identity.id,
+        recipient_id=identity.partner_id,
         subject=data.get('subject', ''),
         message_text=data.get('message', '')
     )
@@ -1475,32 +4184,28 @@ def send_message():
     db.session.commit()
     
     # Create notification for recipient
-    sender = User.query.get(session['user_id'])
-    notification_msg = f"💌 New message from {sender.username}"
+    notification_msg = f"💌 New message from {identity.username}"
     if data.get('subject'):
         notification_msg += f": {data.get('subject')}"
     
     create_notification(
-        user.partner_id,
+        identity.partner_id,
         'new_message',
         notification_msg
     )
     
     # Send external notification if enabled
-    partner = User.query.get(user.partner_id)
-    if partner.sms_notifications and partner.phone_number:
-        send_notification_message(partner.phone_number, notification_msg)
+    if identity.partner_notifiable:
+        send_notification_message(identity.partner_phone_number, notification_msg)
     
     return jsonify({'success': True, 'id': new_message.id})
 
 @app.route('/api/messages/<int:message_id>/mark-read', methods=['POST'])
+@api_login_required
 def mark_message_read(message_id):
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
     message = Message.query.get(message_id)
     
-    if message and message.recipient_id == session['user_id']:
+    if message and message.recipient_id == g.identity.id:
         message.read = True
         db.session.commit()
         return jsonify({'success': True})
@@ -1508,23 +4213,230 @@ def mark_message_read(message_id):
     return jsonify({'error': 'Message not found'}), 404
 
 @app.route('/api/messages/<int:message_id>', methods=['DELETE'])
+@api_login_required
 def delete_message(message_id):
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
     message = Message.query.get(message_id)
     
     # Only sender or recipient can delete
-    if message and (message.sender_id == session['user_id'] or message.recipient_id == session['user_id']):
+    if message and (message.sender_id == g.identity.id or message.recipient_id == g.identity.id):
         db.session.delete(message)
         db.session.commit()
         return jsonify({'success': True})
     
     return jsonify({'error': 'Message not found'}), 404
 
+# ============================================================================
+# API ROUTES - Search
+# ============================================================================
+
+# ts_headline marks matches with these; the page escapes the text and then
+# turns them into <mark> tags, so user content is never parsed as HTML
+SNIPPET_START = '\x02'
+SNIPPET_STOP = '\x03'
+SEARCH_KINDS = ('message', 'encounter', 'comment')
+
+# Ranked search over the generated search_vector columns and their GIN indexes
+# (migrations/002_full_text_search.sql). Only the top rows get a headline.
+_search_sql = text("""
+    WITH q AS (SELECT websearch_to_tsquery('english', :query) AS query),
+    hits AS (
+        SELECT 'message' AS kind, m.id, NULL::integer AS encounter_id, m.created_at AS happened_at,
+               concat_ws(' - ', m.subject, m.message_text) AS body,
+               ts_rank(m.search_vector, q.query) AS rank
+        FROM message m, q
+        WHERE 'message' IN :kinds AND m.search_vector @@ q.query
+          AND (m.sender_id = :user_id OR m.recipient_id = :user_id)
+        UNION ALL
+        SELECT 'encounter', e.id, e.id, e.date::timestamp, e.notes,
+               ts_rank(e.search_vector, q.query)
+        FROM encounter e, q
+        WHERE 'encounter' IN :kinds AND e.search_vector @@ q.query
+          AND e.user_id IN :user_ids
+        UNION ALL
+        SELECT 'comment', c.id, c.encounter_id, c.created_at, c.text,
+               ts_rank(c.search_vector, q.query)
+        FROM comment c JOIN encounter e ON e.id = c.encounter_id, q
+        WHERE 'comment' IN :kinds AND c.search_vector @@ q.query
+          AND e.user_id IN :user_ids
+        ORDER BY rank DESC, happened_at DESC
+        LIMIT :limit
+    )
+    SELECT hits.kind, hits.id, hits.encounter_id, hits.happened_at, hits.rank,
+           ts_headline('english', hits.body, q.query,
+                       'StartSel=' || chr(2) || ', StopSel=' || chr(3) || ', MaxWords=25, MinWords=8, MaxFragments=1')
+    FROM hits, q
+    ORDER BY hits.rank DESC, hits.happened_at DESC
+""").bindparams(
+    bindparam('kinds', expanding=True),
+    bindparam('user_ids', expanding=True)
+)
+
+def search_postgres(query, identity, kinds, limit):
+    rows = db.session.execute(_search_sql, {
+        'query': query,
+        'kinds': list(kinds),
+        'user_id': identity.id,
+        'user_ids': couple_user_ids(identity),
+        'limit': limit
+    })
+    return [{
+        'type': kind,
+        'id': row_id,
+        'encounter_id': encounter_id,
+        'date': happened_at,
+        'rank': round(rank, 4),
+        'snippet': snippet
+    } for kind, row_id, encounter_id, happened_at, rank, snippet in rows]
+
+def plain_snippet(body, terms, width=80):
+    """Excerpt around the first matching term, matches wrapped like ts_headline"""
+    body = body or ''
+    lowered = body.lower()
+    first = min((lowered.find(t) for t in terms if t in lowered), default=0)
+    start = max(first - width // 2, 0)
+    excerpt = body[start:start + width]
+    for term in terms:
+        excerpt = re.sub(
+            re.escape(term), lambda m: f'{SNIPPET_START}{m.group(0)}{SNIPPET_STOP}', excerpt, flags=re.IGNORECASE
+        )
+    return ('…' if start else '') + excerpt + ('…' if start + width < len(body) else '')
+
+def search_fallback(query, identity, kinds, limit):
+    """Substring search for databases without tsvector (SQLite in development)"""
+    terms = [t.lower() for t in query.split() if t]
+    user_ids = couple_user_ids(identity)
+    results = []
+    
+    def matches(*columns):
+        patterns = ['%' + re.sub(r'([\\%_])', r'\\\1', term) + '%' for term in terms]
+        return and_(*(or_(*(column.ilike(p, escape='\\') for column in columns)) for p in patterns))
+    
+    if 'message' in kinds:
+        for m in Message.query.filter(
+            or_(Message.sender_id == identity.id, Message.recipient_id == identity.id),
+            matches(Message.subject, Message.message_text)
+        ).order_by(Message.created_at.desc()).limit(limit):
+            body = ' - '.join(part for part in (m.subject, m.message_text) if part)
+            results.append(('message', m.id, None, m.created_at, body))
+    if 'encounter' in kinds:
+        for e in Encounter.query.filter(
+            Encounter.user_id.in_(user_ids), matches(Encounter.notes)
+        ).order_by(Encounter.date.desc()).limit(limit):
+            results.append(('encounter', e.id, e.id, datetime.combine(e.date, dt_time()), e.notes))
+    if 'comment' in kinds:
+        for c in Comment.query.join(Encounter, Encounter.id == Comment.encounter_id).filter(
+            Encounter.user_id.in_(user_ids), matches(Comment.text)
+        ).order_by(Comment.created_at.desc()).limit(limit):
+            results.append(('comment', c.id, c.encounter_id, c.created_at, c.text))
+    
+    results.sort(key=lambda r: r[3], reverse=True)
+    return [{
+        'type': kind,
+        'id': row_id,
+        'encounter_id': encounter_id,
+        'date': happened_at,
+        'rank': 0,
+        'snippet': plain_snippet(body, terms)
+    } for kind, row_id, encounter_id, happened_at, body in results[:limit]]
+
+@app.route('/search')
+@login_required
+def search_page():
+    return render_template('search.html')
+
+@app.route('/api/search')
+@api_login_required
+def search():
+    """Ranked search over the couple's messages, encounter notes and comments"""
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'query': query, 'results': []})
+    if len(query) > 200:
+        return jsonify({'error': 'Search is limited to 200 characters'}), 400
+    
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 50)
+    kinds = [k for k in request.args.get('types', ','.join(SEARCH_KINDS)).split(',') if k in SEARCH_KINDS]
+    if not kinds:
+        return jsonify({'error': f"types must be among {', '.join(SEARCH_KINDS)}"}), 400
+    
+    if is_postgres():
+        results = search_postgres(query, g.identity, kinds, limit)
+    else:
+        results = search_fallback(query, g.identity, kinds, limit)
+    
+    return jsonify({'query': query, 'results': results})
+
+# ============================================================================
+# API ROUTES - Admin Users
+# ============================================================================
+
+@app.route('/api/admin/users/<int:user_id>', methods=['DELETE'])
+@api_admin_required
+def purge_user_admin(user_id):
+    """Delete a user, or with ?couple=1 the user and their partner"""
+    user = User.query.get(user_id)
+    if not user:
+        return jsonify({'error': 'User not found'}), 404
+    
+    user_ids = [user.id]
+    if request.args.get('couple') == '1' and user.partner_id:
+        user_ids.append(user.partner_id)
+    
+    purge_users(user_ids)
+    
+    return jsonify({'success': True, 'purged': user_ids})
+
+# ============================================================================
+# API ROUTES - Admin Profiles
+# ============================================================================
+
+@app.route('/admin/profiles')
+@login_required
+def admin_profiles():
+    """Admin page listing saved slow-request profiles"""
+    if not g.identity.is_admin:
+        return redirect(url_for('index'))
+    
+    return render_template('admin_profiles.html')
+
+@app.route('/api/admin/profiles', methods=['GET'])
+@api_admin_required
+def get_profiles():
+    """List saved profiles (admin only)"""
+    return jsonify({
+        'enabled': app.config['PROFILING_ENABLED'],
+        'threshold_ms': app.config['PROFILE_THRESHOLD_MS'],
+        'profiles': list_profiles()
+    })
+
+@app.route('/api/admin/profiles/<name>', methods=['GET'])
+@api_admin_required
+def download_profile(name):
+    """Download a raw .prof file for snakeviz/pstats (admin only)"""
+    if not _profile_name_pattern.match(name):
+        return jsonify({'error': 'Profile not found'}), 404
+    
+    return send_from_directory(app.config['PROFILE_DIR'], name, as_attachment=True)
+
+@app.route('/api/admin/profiles/<name>/summary', methods=['GET'])
+@api_admin_required
+def profile_summary(name):
+    """Top functions by cumulative time (admin only)"""
+    path = os.path.join(app.config['PROFILE_DIR'], name)
+    if not _profile_name_pattern.match(name) or not os.path.isfile(path):
+        return jsonify({'error': 'Profile not found'}), 404
+    
+    output = io.StringIO()
+    pstats.Stats(path, stream=output).sort_stats('cumulative').print_stats(40)
+    return output.getvalue(), 200, {'Content-Type': 'text/plain; charset=utf-8'}
+
 # ============================================================================
 # MAIN
 # ============================================================================
 
 if __name__ == '__main__':
+    # Start the background threads with the server instead of on its first
+    # request; under the reloader only the child process that serves runs them
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_services()
     app.run(host='0.0.0.0', debug=True)
@@ -0,0 +1,153 @@
+"""
+Serialization and compression benchmark for the tracker API.
+
+Builds payloads shaped like the largest API responses (a couple's full
+encounter history, a long message inbox, the achievements list), then times
+the stdlib JSON provider against the orjson provider and reports bytes on
+the wire for identity, gzip and brotli encodings at the configured level.
+
+Usage:
+    python bench/bench_serialization.py
+    python bench/bench_serialization.py --encounters 5000 --repeat 50 --output serialization.json
+
+No database is needed; the payloads are synthetic.
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, datetime, time as dt_time, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+POSITIONS = ['missionary', 'doggy', 'cowgirl', 'reverse_cowgirl', 'spoon', 'standing', 'oral', '69', 'other']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--encounters', type=int, default=1500, help='Encounters in the history payload')
+    parser.add_argument('--messages', type=int, default=500, help='Messages in the inbox payload')
+    parser.add_argument('--repeat', type=int, default=30, help='Timed serializations per payload and provider')
+    parser.add_argument('--level', type=int, default=6, help='Compression level (gzip 1-9, brotli quality)')
+    parser.add_argument('--seed', type=int, default=1234, help='Random seed for payloads')
+    parser.add_argument('--output', help='Write results JSON here')
+    return parser.parse_args()
+
+
+def load_app():
+    """Import the app against a throwaway SQLite URL; only its providers are used"""
+    path = os.path.join(tempfile.mkdtemp(prefix='stracker-bench-'), 'bench.db')
+    os.environ.setdefault('DATABASE_URL', f'sqlite:///{path}')
+    sys.path.insert(0, ROOT)
+    import app as app_module
+    return app_module
+
+
+def build_payloads(args):
+    rng = random.Random(args.seed)
+    start = date.today() - timedelta(days=args.encounters)
+
+    encounters = [{
+        'id': i,
+        'date': start + timedelta(days=i),
+        'time': dt_time(rng.randint(0, 23), rng.choice([0, 15, 30, 45])),
+        'position': (position := rng.choice(POSITIONS)),
+        'position_name': position.replace('_', ' ').title(),
+        'duration': rng.randint(5, 90),
+        'rating': rng.randint(1, 5),
+        'notes': rng.choice([None, 'Lovely evening', 'Tried something new', 'Lazy Sunday morning']),
+        'user_id': rng.choice([1, 2]),
+        'is_own': rng.random() < 0.5,
+        'username': rng.choice(['alice', 'bob'])
+    } for i in range(args.encounters)]
+
+    messages = [{
+        'id': i,
+        'subject': f'Message {i}',
+        'message': 'See you tonight? ' * rng.randint(1, 8),
+        'read': rng.random() < 0.8,
+        'created_at': datetime(2024, 1, 1, 12) + timedelta(minutes=37 * i),
+        'is_sent': rng.random() < 0.5,
+        'other_user': 'bob',
+        'other_label': 'From'
+    } for i in range(args.messages)]
+
+    achievements = [{
+        'id': i,
+        'code': f'achievement_{i}',
+        'name': f'Achievement {i}',
+        'description': 'Unlock this by doing the thing enough times',
+        'icon': '🏆',
+        'category': rng.choice(['frequency', 'streak', 'variety', 'rating', 'social', 'time', 'special']),
+        'tier': rng.choice(['bronze', 'silver', 'gold', 'platinum']),
+        'unlocked': (unlocked := rng.random() < 0.5),
+        'unlocked_at': datetime(2024, 3, 1, 9, 30) + timedelta(days=i) if unlocked else None
+    } for i in range(30)]
+
+    return {'encounters': encounters, 'messages': messages, 'achievements': achievements}
+
+
+def time_provider(provider, payload, repeat):
+    """Median milliseconds to turn payload into response bytes"""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = provider.dumps(payload).encode()
+        samples.append((time.perf_counter() - started) * 1000)
+    return round(statistics.median(samples), 3), body
+
+
+def wire_sizes(body, level, brotli):
+    sizes = {'identity': len(body), 'gzip': len(gzip.compress(body, compresslevel=level))}
+    if brotli:
+        sizes['br'] = len(brotli.compress(body, quality=min(level, 11)))
+    return sizes
+
+
+def run(args):
+    app_module = load_app()
+    providers = {'stdlib': app_module.IsoJSONProvider(app_module.app)}
+    if app_module.orjson:
+        providers['orjson'] = app_module.OrjsonProvider(app_module.app)
+    else:
+        print('orjson is not installed; timing the stdlib provider only')
+
+    results = []
+    for name, payload in build_payloads(args).items():
+        row = {'payload': name}
+        for provider_name, provider in providers.items():
+            row[f'{provider_name}_ms'], body = time_provider(provider, payload, args.repeat)
+        row.update(wire_sizes(body, args.level, app_module.brotli))
+        results.append(row)
+    return {'level': args.level, 'repeat': args.repeat, 'results': results}
+
+
+def print_report(report):
+    header = f"{'payload':<15}{'stdlib ms':>11}{'orjson ms':>11}{'speedup':>9}{'bytes':>10}{'gzip':>9}{'br':>9}"
+    print(header)
+    print('-' * len(header))
+    for row in report['results']:
+        orjson_ms = row.get('orjson_ms')
+        speedup = f"{row['stdlib_ms'] / orjson_ms:.1f}x" if orjson_ms else '-'
+        print(f"{row['payload']:<15}{row['stdlib_ms']:>11}{orjson_ms or '-':>11}{speedup:>9}"
+              f"{row['identity']:>10}{row['gzip']:>9}{row.get('br', '-'):>9}")
+
+
+def main():
+    args = parse_args()
+    report = run(args)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Wrote {args.output}')
+
+
+if __name__ == '__main__':
+    main()
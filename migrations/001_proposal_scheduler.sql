@@ -0,0 +1,40 @@
+-- ============================================================================
+-- Database Migration: Proposal Expiry and Reminders
+-- ============================================================================
+-- Run this if you have an EXISTING database
+-- Adds the reminder marker and the (status, proposed_date) index the
+-- proposal scheduler uses for its range scans
+
+-- ============================================================================
+-- POSTGRESQL VERSION
+-- ============================================================================
+
+ALTER TABLE proposed_encounter
+ADD COLUMN IF NOT EXISTS reminder_sent_at TIMESTAMP;
+
+-- CONCURRENTLY avoids blocking writes while the index builds;
+-- run this statement outside a transaction block
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_proposed_encounter_status_date
+ON proposed_encounter(status, proposed_date);
+
+-- ============================================================================
+-- SQLITE VERSION
+-- ============================================================================
+
+-- For SQLite, use this instead:
+/*
+ALTER TABLE proposed_encounter ADD COLUMN reminder_sent_at TIMESTAMP;
+
+CREATE INDEX IF NOT EXISTS idx_proposed_encounter_status_date
+ON proposed_encounter(status, proposed_date);
+*/
+
+-- ============================================================================
+-- VERIFICATION QUERIES
+-- ============================================================================
+
+SELECT column_name FROM information_schema.columns
+WHERE table_name = 'proposed_encounter' AND column_name = 'reminder_sent_at';
+
+SELECT indexname FROM pg_indexes
+WHERE tablename = 'proposed_encounter' AND indexname = 'idx_proposed_encounter_status_date';
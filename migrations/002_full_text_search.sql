@@ -0,0 +1,43 @@
+-- ============================================================================
+-- Database Migration: Full-Text Search
+-- ============================================================================
+-- Run this if you have an EXISTING PostgreSQL database (12 or newer)
+-- Adds generated tsvector columns, which PostgreSQL keeps current on every
+-- INSERT/UPDATE, and GIN indexes for /api/search. SQLite installs skip this;
+-- the app falls back to substring matching there.
+
+-- ============================================================================
+-- POSTGRESQL VERSION
+-- ============================================================================
+
+ALTER TABLE message
+ADD COLUMN IF NOT EXISTS search_vector tsvector
+GENERATED ALWAYS AS (
+    setweight(to_tsvector('english', coalesce(subject, '')), 'A') ||
+    setweight(to_tsvector('english', coalesce(message_text, '')), 'B')
+) STORED;
+
+ALTER TABLE encounter
+ADD COLUMN IF NOT EXISTS search_vector tsvector
+GENERATED ALWAYS AS (to_tsvector('english', coalesce(notes, ''))) STORED;
+
+ALTER TABLE comment
+ADD COLUMN IF NOT EXISTS search_vector tsvector
+GENERATED ALWAYS AS (to_tsvector('english', coalesce(text, ''))) STORED;
+
+-- CONCURRENTLY avoids blocking writes while the indexes build;
+-- run these statements outside a transaction block
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_message_search ON message USING GIN (search_vector);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_encounter_search ON encounter USING GIN (search_vector);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_comment_search ON comment USING GIN (search_vector);
+
+-- ============================================================================
+-- VERIFICATION QUERIES
+-- ============================================================================
+
+SELECT table_name, column_name FROM information_schema.columns
+WHERE column_name = 'search_vector';
+
+-- Should show a Bitmap Index Scan on idx_encounter_search
+EXPLAIN SELECT id FROM encounter
+WHERE search_vector @@ websearch_to_tsquery('english', 'sunday morning');
@@ -0,0 +1,48 @@
+-- ============================================================================
+-- Database Migration: Encounter Filters
+-- ============================================================================
+-- Run this if you have an EXISTING database
+-- Adds the indexes behind the GET /api/encounters filters: the couple's
+-- history by date, by position and date, and ratings by encounter
+
+-- ============================================================================
+-- POSTGRESQL VERSION
+-- ============================================================================
+
+-- CONCURRENTLY avoids blocking writes while the indexes build;
+-- run each statement outside a transaction block
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_encounter_user_date
+ON encounter(user_id, date);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_encounter_user_position_date
+ON encounter(user_id, position, date);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_encounter_rating_encounter_rating
+ON encounter_rating(encounter_id, rating);
+
+-- ============================================================================
+-- SQLITE VERSION
+-- ============================================================================
+
+-- For SQLite, use this instead:
+/*
+CREATE INDEX IF NOT EXISTS idx_encounter_user_date
+ON encounter(user_id, date);
+
+CREATE INDEX IF NOT EXISTS idx_encounter_user_position_date
+ON encounter(user_id, position, date);
+
+CREATE INDEX IF NOT EXISTS idx_encounter_rating_encounter_rating
+ON encounter_rating(encounter_id, rating);
+*/
+
+-- ============================================================================
+-- VERIFICATION QUERIES
+-- ============================================================================
+
+SELECT indexname FROM pg_indexes
+WHERE indexname IN (
+    'idx_encounter_user_date',
+    'idx_encounter_user_position_date',
+    'idx_encounter_rating_encounter_rating'
+);
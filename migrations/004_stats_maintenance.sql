@@ -0,0 +1,37 @@
+-- ============================================================================
+-- Database Migration: Nightly Stats Maintenance
+-- ============================================================================
+-- Run this if you have an EXISTING database
+-- Adds job_run, where workers claim the nightly streak decay and stats
+-- reconciliation so only one of them runs it each day
+
+-- ============================================================================
+-- POSTGRESQL VERSION
+-- ============================================================================
+
+CREATE TABLE IF NOT EXISTS job_run (
+    job VARCHAR(50) PRIMARY KEY,
+    last_run_on DATE,
+    started_at TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+-- ============================================================================
+-- SQLITE VERSION
+-- ============================================================================
+
+-- For SQLite, use this instead:
+/*
+CREATE TABLE IF NOT EXISTS job_run (
+    job VARCHAR(50) PRIMARY KEY,
+    last_run_on DATE,
+    started_at DATETIME,
+    finished_at DATETIME
+);
+*/
+
+-- ============================================================================
+-- VERIFICATION QUERIES
+-- ============================================================================
+
+SELECT job, last_run_on, started_at, finished_at FROM job_run;
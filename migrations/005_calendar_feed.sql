@@ -0,0 +1,36 @@
+-- ============================================================================
+-- Database Migration: Calendar Feed Tokens
+-- ============================================================================
+-- Run this if you have an EXISTING database
+-- Adds the secret token behind each user's subscribable .ics feed
+
+-- ============================================================================
+-- POSTGRESQL VERSION
+-- ============================================================================
+
+ALTER TABLE "user"
+ADD COLUMN IF NOT EXISTS calendar_token VARCHAR(64);
+
+-- CONCURRENTLY avoids blocking writes while the index builds;
+-- run this statement outside a transaction block
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS idx_user_calendar_token
+ON "user"(calendar_token);
+
+-- ============================================================================
+-- SQLITE VERSION
+-- ============================================================================
+
+-- For SQLite, use this instead:
+/*
+ALTER TABLE user ADD COLUMN calendar_token VARCHAR(64);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_user_calendar_token
+ON user(calendar_token);
+*/
+
+-- ============================================================================
+-- VERIFICATION QUERIES
+-- ============================================================================
+
+SELECT column_name FROM information_schema.columns
+WHERE table_name = 'user' AND column_name = 'calendar_token';
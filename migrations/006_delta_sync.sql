@@ -0,0 +1,99 @@
+-- ============================================================================
+-- Database Migration: Delta Sync
+-- ============================================================================
+-- Run this if you have an EXISTING database
+-- Adds updated_at (backfilled from created_at) to the synced tables, the
+-- tombstone table that records deletes, and the indexes /api/sync scans
+
+-- ============================================================================
+-- POSTGRESQL VERSION
+-- ============================================================================
+
+ALTER TABLE encounter ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP;
+UPDATE encounter SET updated_at = COALESCE(created_at, NOW()) WHERE updated_at IS NULL;
+
+ALTER TABLE comment ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP;
+UPDATE comment SET updated_at = COALESCE(created_at, NOW()) WHERE updated_at IS NULL;
+
+ALTER TABLE encounter_rating ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP;
+UPDATE encounter_rating SET updated_at = COALESCE(created_at, NOW()) WHERE updated_at IS NULL;
+
+ALTER TABLE message ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP;
+UPDATE message SET updated_at = COALESCE(created_at, NOW()) WHERE updated_at IS NULL;
+
+ALTER TABLE notification ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP;
+UPDATE notification SET updated_at = COALESCE(created_at, NOW()) WHERE updated_at IS NULL;
+
+ALTER TABLE proposed_encounter ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP;
+UPDATE proposed_encounter SET updated_at = COALESCE(created_at, NOW()) WHERE updated_at IS NULL;
+
+CREATE TABLE IF NOT EXISTS tombstone (
+    id SERIAL PRIMARY KEY,
+    entity VARCHAR(20) NOT NULL,
+    entity_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    other_user_id INTEGER,
+    deleted_at TIMESTAMP NOT NULL
+);
+
+-- CONCURRENTLY avoids blocking writes while the indexes build;
+-- run each statement outside a transaction block
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_encounter_updated_at ON encounter(updated_at);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_comment_updated_at ON comment(updated_at);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_encounter_rating_updated_at ON encounter_rating(updated_at);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_message_updated_at ON message(updated_at);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_notification_updated_at ON notification(updated_at);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_proposed_encounter_updated_at ON proposed_encounter(updated_at);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_tombstone_deleted_at ON tombstone(deleted_at);
+
+-- ============================================================================
+-- SQLITE VERSION
+-- ============================================================================
+
+-- For SQLite, use this instead:
+/*
+ALTER TABLE encounter ADD COLUMN updated_at DATETIME;
+UPDATE encounter SET updated_at = COALESCE(created_at, CURRENT_TIMESTAMP) WHERE updated_at IS NULL;
+
+ALTER TABLE comment ADD COLUMN updated_at DATETIME;
+UPDATE comment SET updated_at = COALESCE(created_at, CURRENT_TIMESTAMP) WHERE updated_at IS NULL;
+
+ALTER TABLE encounter_rating ADD COLUMN updated_at DATETIME;
+UPDATE encounter_rating SET updated_at = COALESCE(created_at, CURRENT_TIMESTAMP) WHERE updated_at IS NULL;
+
+ALTER TABLE message ADD COLUMN updated_at DATETIME;
+UPDATE message SET updated_at = COALESCE(created_at, CURRENT_TIMESTAMP) WHERE updated_at IS NULL;
+
+ALTER TABLE notification ADD COLUMN updated_at DATETIME;
+UPDATE notification SET updated_at = COALESCE(created_at, CURRENT_TIMESTAMP) WHERE updated_at IS NULL;
+
+ALTER TABLE proposed_encounter ADD COLUMN updated_at DATETIME;
+UPDATE proposed_encounter SET updated_at = COALESCE(created_at, CURRENT_TIMESTAMP) WHERE updated_at IS NULL;
+
+CREATE TABLE IF NOT EXISTS tombstone (
+    id INTEGER PRIMARY KEY,
+    entity VARCHAR(20) NOT NULL,
+    entity_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    other_user_id INTEGER,
+    deleted_at DATETIME NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS ix_encounter_updated_at ON encounter(updated_at);
+CREATE INDEX IF NOT EXISTS ix_comment_updated_at ON comment(updated_at);
+CREATE INDEX IF NOT EXISTS ix_encounter_rating_updated_at ON encounter_rating(updated_at);
+CREATE INDEX IF NOT EXISTS ix_message_updated_at ON message(updated_at);
+CREATE INDEX IF NOT EXISTS ix_notification_updated_at ON notification(updated_at);
+CREATE INDEX IF NOT EXISTS ix_proposed_encounter_updated_at ON proposed_encounter(updated_at);
+CREATE INDEX IF NOT EXISTS ix_tombstone_deleted_at ON tombstone(deleted_at);
+*/
+
+-- ============================================================================
+-- VERIFICATION QUERIES
+-- ============================================================================
+
+SELECT table_name FROM information_schema.columns
+WHERE column_name = 'updated_at'
+  AND table_name IN ('encounter', 'comment', 'encounter_rating', 'message', 'notification', 'proposed_encounter');
+
+SELECT COUNT(*) FROM tombstone;
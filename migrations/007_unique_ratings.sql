@@ -0,0 +1,66 @@
+-- ============================================================================
+-- Database Migration: One Rating Per User Per Encounter
+-- ============================================================================
+-- Run this if you have an EXISTING database
+-- Keeps each user's newest rating of an encounter, records the older copies
+-- as deleted for /api/sync, and adds the unique index the rating upserts
+-- (ON CONFLICT (encounter_id, user_id)) rely on
+
+-- ============================================================================
+-- POSTGRESQL VERSION
+-- ============================================================================
+
+BEGIN;
+
+CREATE TEMPORARY TABLE duplicate_rating ON COMMIT DROP AS
+SELECT r.id, e.user_id AS owner_id
+FROM encounter_rating r
+JOIN encounter e ON e.id = r.encounter_id
+WHERE r.id NOT IN (
+    SELECT MAX(id) FROM encounter_rating GROUP BY encounter_id, user_id
+);
+
+INSERT INTO tombstone (entity, entity_id, user_id, other_user_id, deleted_at)
+SELECT 'ratings', id, owner_id, NULL, NOW() AT TIME ZONE 'UTC' FROM duplicate_rating;
+
+DELETE FROM encounter_rating WHERE id IN (SELECT id FROM duplicate_rating);
+
+COMMIT;
+
+-- CONCURRENTLY avoids blocking writes while the index builds;
+-- run this statement outside a transaction block
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_encounter_rating_encounter_user
+ON encounter_rating(encounter_id, user_id);
+
+-- ============================================================================
+-- SQLITE VERSION
+-- ============================================================================
+
+-- For SQLite, use this instead:
+/*
+INSERT INTO tombstone (entity, entity_id, user_id, other_user_id, deleted_at)
+SELECT 'ratings', r.id, e.user_id, NULL, CURRENT_TIMESTAMP
+FROM encounter_rating r
+JOIN encounter e ON e.id = r.encounter_id
+WHERE r.id NOT IN (
+    SELECT MAX(id) FROM encounter_rating GROUP BY encounter_id, user_id
+);
+
+DELETE FROM encounter_rating WHERE id NOT IN (
+    SELECT MAX(id) FROM encounter_rating GROUP BY encounter_id, user_id
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS uq_encounter_rating_encounter_user
+ON encounter_rating(encounter_id, user_id);
+*/
+
+-- ============================================================================
+-- VERIFICATION QUERIES
+-- ============================================================================
+
+-- Should return no rows
+SELECT encounter_id, user_id, COUNT(*) FROM encounter_rating
+GROUP BY encounter_id, user_id HAVING COUNT(*) > 1;
+
+SELECT indexname FROM pg_indexes
+WHERE tablename = 'encounter_rating' AND indexname = 'uq_encounter_rating_encounter_user';
@@ -0,0 +1,47 @@
+-- ============================================================================
+-- Database Migration: Achievement Progress
+-- ============================================================================
+-- Run this if you have an EXISTING database
+-- user_achievement rows now also exist for locked achievements (unlocked_at
+-- NULL) to hold progress toward them. This keeps each user's first unlock of
+-- an achievement and adds the unique index the progress upserts rely on.
+-- Afterwards run `flask achievement-progress` once to fill in progress for
+-- existing users; from then on it is kept up to date as they use the app.
+
+-- ============================================================================
+-- POSTGRESQL VERSION
+-- ============================================================================
+
+DELETE FROM user_achievement WHERE id NOT IN (
+    SELECT MIN(id) FROM user_achievement GROUP BY user_id, achievement_id
+);
+
+-- CONCURRENTLY avoids blocking writes while the index builds;
+-- run this statement outside a transaction block
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_user_achievement_user_achievement
+ON user_achievement(user_id, achievement_id);
+
+-- ============================================================================
+-- SQLITE VERSION
+-- ============================================================================
+
+-- For SQLite, use this instead:
+/*
+DELETE FROM user_achievement WHERE id NOT IN (
+    SELECT MIN(id) FROM user_achievement GROUP BY user_id, achievement_id
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS uq_user_achievement_user_achievement
+ON user_achievement(user_id, achievement_id);
+*/
+
+-- ============================================================================
+-- VERIFICATION QUERIES
+-- ============================================================================
+
+-- Should return no rows
+SELECT user_id, achievement_id, COUNT(*) FROM user_achievement
+GROUP BY user_id, achievement_id HAVING COUNT(*) > 1;
+
+SELECT indexname FROM pg_indexes
+WHERE tablename = 'user_achievement' AND indexname = 'uq_user_achievement_user_achievement';
@@ -0,0 +1,349 @@
+// Service worker rendered by /sw.js. VERSION changes whenever a precached
+// template does, which installs a fresh worker with a fresh shell cache.
+const VERSION = {{ version|tojson }};
+const SHELL_CACHE = `shells-${VERSION}`;
+// Cached API reads are kept per user: api-reads-<user id>
+const API_CACHE_PREFIX = 'api-reads-';
+const PAGES = {{ pages|tojson }};
+const READ_APIS = {{ read_apis|tojson }};
+const QUEUE_DB = 'offline-writes';
+const QUEUE_STORE = 'writes';
+const META_STORE = 'meta';
+const SYNC_TAG = 'replay-writes';
+// Replayed writes answered with these would fail the same way on every retry
+const REJECTED_STATUSES = [400, 404, 409, 422];
+
+// ============================================================================
+// LIFECYCLE
+// ============================================================================
+
+self.addEventListener('install', event => {
+    event.waitUntil(
+        caches.open(SHELL_CACHE)
+            .then(cache => Promise.all(PAGES.map(page => precache(cache, page))))
+            .then(() => self.skipWaiting())
+    );
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil(
+        caches.keys()
+            .then(names => Promise.all(
+                // 'api-reads' is the shared cache of earlier versions
+                names.filter(name => (name.startsWith('shells-') && name !== SHELL_CACHE) || name === 'api-reads')
+                    .map(name => caches.delete(name))
+            ))
+            .then(() => self.clients.claim())
+            .then(() => replayQueue())
+    );
+});
+
+async function precache(cache, page) {
+    // Signed-out visitors are redirected to /login; only real shells are kept
+    try {
+        const response = await fetch(page, { credentials: 'include', redirect: 'manual' });
+        if (response.ok) {
+            await cache.put(page, response);
+        }
+    } catch (error) {
+        // Offline during install; the page is cached on its first visit instead
+    }
+}
+
+// ============================================================================
+// ROUTING
+// ============================================================================
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    const url = new URL(request.url);
+    if (url.origin !== self.location.origin) {
+        return;
+    }
+
+    if (request.method === 'GET') {
+        if (request.mode === 'navigate' && url.pathname === '/logout') {
+            event.respondWith(signOut(request));
+        } else if (request.mode === 'navigate' && PAGES.includes(url.pathname)) {
+            // ?encounter=<id> and the like share the one shell
+            event.respondWith(staleWhileRevalidate(event, SHELL_CACHE, url.pathname));
+        } else if (READ_APIS.includes(url.pathname)) {
+            event.respondWith(networkFirst(request));
+        }
+    } else if (url.pathname === '/login' || url.pathname === '/register') {
+        event.respondWith(signIn(request));
+    } else if (url.pathname.startsWith('/api/')) {
+        event.respondWith(sendOrQueue(request));
+    }
+});
+
+async function staleWhileRevalidate(event, cacheName, key) {
+    const cache = await caches.open(cacheName);
+    const cached = await cache.match(key);
+
+    const refresh = fetch(event.request).then(async response => {
+        if (response.status === 401 || response.redirected) {
+            // The session is gone; nothing cached for it may be shown again
+            await clearCaches();
+        } else if (response.ok) {
+            await cache.put(key, response.clone());
+            if (cached && await cached.text() !== await response.clone().text()) {
+                notifyClients({ type: 'updated', url: event.request.url });
+            }
+        }
+        return response;
+    });
+
+    if (cached) {
+        event.waitUntil(refresh.catch(() => {}));
+        return cached.clone();
+    }
+    return refresh;
+}
+
+async function networkFirst(request) {
+    // Private data: only fall back to this user's copy when the network is down
+    const user = await storedUser();
+    const cache = await caches.open(API_CACHE_PREFIX + user);
+    let response;
+    try {
+        response = await fetch(request);
+    } catch (error) {
+        const cached = user === null ? null : await cache.match(request);
+        if (cached) {
+            return cached;
+        }
+        throw error;
+    }
+    if (response.status === 401 || response.redirected) {
+        // The session is gone; nothing cached for it may be shown again
+        await clearApiCaches();
+    } else if (response.ok && user !== null) {
+        await cache.put(request, response.clone());
+    }
+    return response;
+}
+
+async function clearCaches() {
+    const names = await caches.keys();
+    await Promise.all(names.map(name => caches.delete(name)));
+}
+
+async function clearApiCaches() {
+    const names = await caches.keys();
+    await Promise.all(names.filter(name => name.startsWith(API_CACHE_PREFIX)).map(name => caches.delete(name)));
+}
+
+async function signIn(request) {
+    const response = await fetch(request);
+    if (response.ok) {
+        // Before the new session's first page can come from the caches
+        const user = await sessionUser();
+        if (user && user !== await storedUser()) {
+            await switchUser(user);
+        }
+    }
+    return response;
+}
+
+async function signOut(request) {
+    // Clear-Site-Data does this too, where the browser supports it
+    await clearCaches();
+    await queueRequest('readwrite', store => store.clear());
+    await storeRequest(META_STORE, 'readwrite', store => store.delete('user'));
+    return fetch(request);
+}
+
+async function notifyClients(message) {
+    const clients = await self.clients.matchAll({ type: 'window' });
+    clients.forEach(client => client.postMessage(message));
+}
+
+// ============================================================================
+// SESSION
+// ============================================================================
+
+// The last user the server confirmed as signed in. It is kept in IndexedDB
+// because the browser may stop the worker between events.
+async function storedUser() {
+    const user = await storeRequest(META_STORE, 'readonly', store => store.get('user'));
+    return user === undefined ? null : user;
+}
+
+async function sessionUser() {
+    // The signed-in user's id, false when signed out, null when offline
+    try {
+        const response = await fetch('/api/session', { credentials: 'include' });
+        return response.ok ? (await response.json()).user_id : false;
+    } catch (error) {
+        return null;
+    }
+}
+
+async function switchUser(user) {
+    // Nothing cached or queued for someone else on this device may reach this
+    // user: their pages and reads are dropped, and their writes never sent
+    await clearCaches();
+    await queueRequest('readwrite', store => {
+        store.openCursor().onsuccess = event => {
+            const cursor = event.target.result;
+            if (cursor) {
+                if (cursor.value.userId !== user) {
+                    cursor.delete();
+                }
+                cursor.continue();
+            }
+        };
+    });
+    await storeRequest(META_STORE, 'readwrite', store => store.put(user, 'user'));
+}
+
+// ============================================================================
+// OFFLINE WRITE QUEUE
+// ============================================================================
+
+async function sendOrQueue(request) {
+    // Read the body first; fetch() consumes the request
+    const body = request.method === 'DELETE' ? null : await request.clone().arrayBuffer();
+    try {
+        const response = await fetch(request);
+        // Reads made after this write must not come back stale
+        await clearApiCaches();
+        replayQueue();
+        return response;
+    } catch (error) {
+        await queueWrite({
+            userId: await storedUser(),
+            url: request.url,
+            method: request.method,
+            contentType: request.headers.get('Content-Type'),
+            body,
+            queuedAt: Date.now()
+        });
+        if (self.registration.sync) {
+            self.registration.sync.register(SYNC_TAG).catch(() => {});
+        }
+        return new Response(JSON.stringify({ queued: true }), {
+            status: 202,
+            headers: { 'Content-Type': 'application/json' }
+        });
+    }
+}
+
+self.addEventListener('sync', event => {
+    if (event.tag === SYNC_TAG) {
+        event.waitUntil(replayQueue());
+    }
+});
+
+self.addEventListener('message', event => {
+    // Pages send this on load and when the browser comes back online
+    if (event.data && event.data.type === 'replay') {
+        event.waitUntil(replayQueue());
+    }
+});
+
+let replaying = null;
+
+function replayQueue() {
+    // One replay at a time keeps the writes in the order they were made
+    if (!replaying) {
+        replaying = replayWrites().finally(() => {
+            replaying = null;
+        });
+    }
+    return replaying;
+}
+
+async function replayWrites() {
+    const user = await sessionUser();
+    if (user === null) {
+        return;  // Still offline
+    }
+    if (user === false) {
+        // Signed out meanwhile; the writes wait for the user to sign back in
+        if (await queueRequest('readonly', store => store.count())) {
+            notifyClients({ type: 'reauth' });
+        }
+        return;
+    }
+    if (await storedUser() !== user) {
+        await switchUser(user);
+    }
+
+    const writes = await queueRequest('readonly', store => store.getAll());
+    let replayed = 0;
+    for (const write of writes) {
+        if (write.userId !== user) {
+            await queueRequest('readwrite', store => store.delete(write.id));
+            continue;
+        }
+        let response;
+        try {
+            response = await fetch(write.url, {
+                method: write.method,
+                headers: write.contentType ? { 'Content-Type': write.contentType } : {},
+                body: write.body,
+                credentials: 'include'
+            });
+        } catch (error) {
+            break;  // Still offline; keep this write and everything after it
+        }
+        if (response.status === 401 || response.status === 403) {
+            const session = response.status === 401 ? false : await sessionUser();
+            if (session === null) {
+                break;  // Offline again
+            }
+            if (!session) {
+                // Signed out meanwhile; keep this write and everything after it
+                // for when the user has signed back in
+                notifyClients({ type: 'reauth' });
+                break;
+            }
+            // A signed-in user refused this write would be refused every time
+        } else if (!response.ok && !REJECTED_STATUSES.includes(response.status)) {
+            break;  // 5xx, 429 and the like may pass later
+        }
+        await queueRequest('readwrite', store => store.delete(write.id));
+        replayed++;
+    }
+    if (replayed) {
+        await clearApiCaches();
+        notifyClients({ type: 'replayed', count: replayed });
+    }
+}
+
+function openQueue() {
+    return new Promise((resolve, reject) => {
+        const open = indexedDB.open(QUEUE_DB, 2);
+        open.onupgradeneeded = () => {
+            const db = open.result;
+            if (!db.objectStoreNames.contains(QUEUE_STORE)) {
+                db.createObjectStore(QUEUE_STORE, { keyPath: 'id', autoIncrement: true });
+            }
+            if (!db.objectStoreNames.contains(META_STORE)) {
+                db.createObjectStore(META_STORE);
+            }
+        };
+        open.onsuccess = () => resolve(open.result);
+        open.onerror = () => reject(open.error);
+    });
+}
+
+async function storeRequest(storeName, mode, action) {
+    const db = await openQueue();
+    return new Promise((resolve, reject) => {
+        const transaction = db.transaction(storeName, mode);
+        const request = action(transaction.objectStore(storeName));
+        transaction.oncomplete = () => resolve(request && request.result);
+        transaction.onerror = () => reject(transaction.error);
+    });
+}
+
+function queueRequest(mode, action) {
+    return storeRequest(QUEUE_STORE, mode, action);
+}
+
+function queueWrite(write) {
+    return queueRequest('readwrite', store => store.add(write));
+}
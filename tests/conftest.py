@@ -0,0 +1,52 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app.py reads its configuration when imported
+_db_dir = tempfile.mkdtemp()
+os.environ.setdefault('DATABASE_URL', f'sqlite:///{_db_dir}/test.db')
+os.environ.setdefault('SCHEDULER_ENABLED', '0')
+os.environ.setdefault('STATS_MAINTENANCE_ENABLED', '0')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as stracker  # noqa: E402
+
+BASE_URL = 'https://localhost'
+
+
+@pytest.fixture
+def app():
+    stracker.app.config['TESTING'] = True
+    with stracker.app.app_context():
+        stracker.db.drop_all()
+        stracker.db.create_all()
+    # Module-level caches and throttles outlive a test
+    stracker.clear_local_caches()
+    stracker.login_attempts = stracker.create_attempt_store()
+    yield stracker.app
+
+
+def register(app, username):
+    client = app.test_client()
+    response = client.post('/register', json={'username': username, 'password': 'pw'}, base_url=BASE_URL)
+    assert response.status_code == 200, response.get_json()
+    return client
+
+
+@pytest.fixture
+def couple(app):
+    """Two registered users connected as partners: (alice, bob) test clients"""
+    alice = register(app, 'alice')
+    bob = register(app, 'bob')
+    with app.app_context():
+        code = stracker.User.query.filter_by(username='bob').one().partner_code
+    response = alice.post('/api/connect-partner', json={'partner_code': code}, base_url=BASE_URL)
+    assert response.status_code == 200
+    return alice, bob
+
+
+def user_id(app, username):
+    with app.app_context():
+        return stracker.User.query.filter_by(username=username).one().id
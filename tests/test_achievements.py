@@ -0,0 +1,43 @@
+import pytest
+
+import app as stracker
+from conftest import BASE_URL
+
+
+@pytest.fixture
+def team_player(app):
+    with app.app_context():
+        stracker.db.session.add(stracker.Achievement(
+            code='team_player', name='Team Player', description='d', icon='x', category='c', tier='bronze'
+        ))
+        stracker.db.session.commit()
+
+
+def progress(client, code):
+    achievements = client.get('/api/achievements', base_url=BASE_URL).get_json()
+    return next(achievement['progress'] for achievement in achievements if achievement['code'] == code)
+
+
+def test_partner_ratings_progress_follows_partner_writes(app, team_player, couple):
+    alice, bob = couple
+    assert progress(alice, 'team_player') == 0
+    alice.post('/api/encounters', json={'date': '2026-10-01', 'position': 'spoon'}, base_url=BASE_URL)
+    encounter_id = alice.get('/api/encounters', base_url=BASE_URL).get_json()[0]['id']
+    
+    # Bob's rating counts toward Alice's team_player, though Alice wrote nothing
+    bob.post(f'/api/encounters/{encounter_id}/rating', json={'rating': 5}, base_url=BASE_URL)
+    assert progress(alice, 'team_player') == 1
+    
+    assert alice.post('/api/disconnect-partner', base_url=BASE_URL).status_code == 200
+    assert progress(alice, 'team_player') == 0
+
+
+def test_deleting_a_rated_encounter_updates_the_partners_progress(app, team_player, couple):
+    alice, bob = couple
+    alice.post('/api/encounters', json={'date': '2026-10-01', 'position': 'spoon'}, base_url=BASE_URL)
+    encounter_id = alice.get('/api/encounters', base_url=BASE_URL).get_json()[0]['id']
+    alice.post(f'/api/encounters/{encounter_id}/rating', json={'rating': 5}, base_url=BASE_URL)
+    assert progress(bob, 'team_player') == 1
+    
+    assert alice.delete(f'/api/encounters/{encounter_id}', base_url=BASE_URL).status_code == 200
+    assert progress(bob, 'team_player') == 0
@@ -0,0 +1,76 @@
+import pytest
+
+import app as stracker
+from conftest import BASE_URL, register
+
+
+def log_encounters(client, *days):
+    for day in days:
+        response = client.post('/api/encounters', json={'date': day, 'position': 'spoon'}, base_url=BASE_URL)
+        assert response.status_code == 200
+    return sorted(encounter['id'] for encounter in client.get('/api/encounters', base_url=BASE_URL).get_json())
+
+
+def rate(client, *pairs):
+    ratings = [{'encounter_id': encounter_id, 'rating': rating} for encounter_id, rating in pairs]
+    return client.post('/api/encounters/ratings', json={'ratings': ratings}, base_url=BASE_URL)
+
+
+def stored_ratings(app):
+    with app.app_context():
+        return {row.encounter_id: row.rating for row in stracker.EncounterRating.query.all()}
+
+
+def test_batch_rating_saves_every_pair(app, couple):
+    alice, bob = couple
+    first, second = log_encounters(alice, '2026-10-01', '2026-10-02')
+    
+    response = rate(bob, (first, 5), (second, 3))
+    assert response.status_code == 200
+    assert response.get_json() == {'success': True, 'rated': 2, 'new': 2}
+    assert stored_ratings(app) == {first: 5, second: 3}
+    
+    # Updating a rating is not a new one, and a later pair for the same encounter wins
+    response = rate(bob, (first, 2), (first, 4))
+    assert response.get_json() == {'success': True, 'rated': 1, 'new': 0}
+    assert stored_ratings(app) == {first: 4, second: 3}
+
+
+@pytest.mark.parametrize('encounter_id', [True, False, '1', 1.0, None])
+def test_batch_rating_rejects_non_integer_ids(app, couple, encounter_id):
+    alice, bob = couple
+    log_encounters(alice, '2026-10-01')
+    
+    assert rate(bob, (encounter_id, 5)).status_code == 400
+    assert stored_ratings(app) == {}
+
+
+@pytest.mark.parametrize('rating', [0, 6, True, '5', None])
+def test_batch_rating_rejects_invalid_ratings(app, couple, rating):
+    alice, bob = couple
+    encounter_id, = log_encounters(alice, '2026-10-01')
+    
+    assert rate(bob, (encounter_id, rating)).status_code == 400
+    assert stored_ratings(app) == {}
+
+
+def test_batch_rating_is_limited_to_the_couple(app, couple):
+    alice, bob = couple
+    encounter_id, = log_encounters(alice, '2026-10-01')
+    stranger = register(app, 'carol')
+    
+    response = rate(stranger, (encounter_id, 5))
+    assert response.status_code == 404
+    assert response.get_json()['encounter_ids'] == [encounter_id]
+    # Nothing in the batch is saved when one encounter is out of reach
+    assert rate(bob, (encounter_id, 5), (encounter_id + 100, 5)).status_code == 404
+    assert stored_ratings(app) == {}
+
+
+def test_batch_rating_size_is_limited(app, couple):
+    alice, bob = couple
+    encounter_id, = log_encounters(alice, '2026-10-01')
+    limit = app.config['RATING_BATCH_LIMIT']
+    
+    assert rate(bob, *[(encounter_id, 5)] * (limit + 1)).status_code == 400
+    assert bob.post('/api/encounters/ratings', json={'ratings': []}, base_url=BASE_URL).status_code == 400
@@ -0,0 +1,31 @@
+from datetime import datetime, timedelta
+
+import app as stracker
+from conftest import BASE_URL, user_id
+
+
+def stats_row(app, username):
+    with app.app_context():
+        stats = stracker.UserStats.query.filter_by(user_id=user_id(app, username)).one()
+        return stats.total_points, stats.level, stats.total_encounters
+
+
+def test_reconcile_after_normal_writes_changes_nothing(app, couple):
+    alice, bob = couple
+    for day in ('2026-10-01', '2026-10-02'):
+        assert alice.post('/api/encounters', json={'date': day, 'position': 'spoon'}, base_url=BASE_URL).status_code == 200
+    encounter_id = alice.get('/api/encounters', base_url=BASE_URL).get_json()[0]['id']
+    bob.post(f'/api/encounters/{encounter_id}/rating', json={'rating': 5}, base_url=BASE_URL)
+    bob.post(f'/api/encounters/{encounter_id}/comments', json={'text': 'lovely'}, base_url=BASE_URL)
+    
+    # An accepted proposal logs an encounter for the proposer
+    proposed = (datetime.now() + timedelta(days=2)).strftime('%Y-%m-%dT%H:%M:%S')
+    alice.post('/api/proposals', json={'proposed_date': proposed}, base_url=BASE_URL)
+    proposal_id = bob.get('/api/proposals', base_url=BASE_URL).get_json()['received'][0]['id']
+    assert bob.post(f'/api/proposals/{proposal_id}/accept', base_url=BASE_URL).status_code == 200
+    
+    before = {name: stats_row(app, name) for name in ('alice', 'bob')}
+    assert before['alice'][2] == 3
+    with app.app_context():
+        assert stracker.reconcile_user_stats() == 0
+    assert {name: stats_row(app, name) for name in ('alice', 'bob')} == before
@@ -0,0 +1,35 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import app as stracker
+from conftest import register, user_id
+
+THREADS = 8
+CALLS = 25
+
+
+def test_concurrent_counter_updates_are_not_lost(app):
+    register(app, 'alice')
+    alice_id = user_id(app, 'alice')
+    
+    def worker(index):
+        for call in range(CALLS):
+            with app.app_context():
+                if (index + call) % 2:
+                    stracker.award_points(alice_id, stracker.RATING_POINTS, 'test')
+                else:
+                    stracker.adjust_user_stats(alice_id, points=stracker.ENCOUNTER_POINTS, encounters=1)
+                    stracker.db.session.commit()
+                stracker.db.session.remove()
+    
+    with ThreadPoolExecutor(max_workers=THREADS) as pool:
+        # list() re-raises anything a worker raised
+        list(pool.map(worker, range(THREADS)))
+    
+    # Half of each thread's calls go each way
+    awards = THREADS * CALLS // 2
+    expected_points = awards * (stracker.RATING_POINTS + stracker.ENCOUNTER_POINTS)
+    with app.app_context():
+        stats = stracker.db.session.get(stracker.UserStats, alice_id)
+        assert stats.total_points == expected_points
+        assert stats.level == stracker.calculate_level(expected_points)
+        assert stats.total_encounters == awards